@@ -1,100 +1,436 @@
 #!/usr/bin/env python
 
-from math import floor
-from datetime import date, datetime, timedelta, tzinfo
-import icalendar as ical
+import argparse
+from bisect import bisect_left, bisect_right
+from calendar import isleap, monthrange
+import contextlib
+import functools
+import gzip
+from math import floor, gcd
+from operator import itemgetter
+from datetime import date, datetime, timedelta, timezone, tzinfo
+import hashlib
+import heapq
+import itertools
+import io
+import json
+import mmap
 import os
-from pytz import timezone, utc
+import re
+import shutil
+import sqlite3
+from string import Formatter
 import sys
+import tempfile
+import time
+from urllib.parse import urljoin, urlsplit
 
 # Default attendee: for checkout status of the participant.
 DEFAULT_ATTENDEE = "jwpalmieri@gmail.com"
 
+# Other addresses (aliases, delegates) under which you may be invited (see
+# --identity). Your participation status is read from any of them.
+IDENTITIES = []
+
 # Default local timezone. This needs to follow what timezone emacs is
-# in. Or you can pull it from a file.
-LOCAL_TZ = timezone("America/Los_Angeles")
+# in. Or you can pull it from a file. Give its name, or a tzinfo such as
+# ZoneInfo("Europe/Paris") (from zoneinfo import ZoneInfo); timezone here is
+# datetime.timezone, not the pytz function.
+LOCAL_TZ = "America/Los_Angeles"
 TIMEZONE_FILE = "~/tmp/calendar/timezone"
 
+# Library the timezones are loaded with: "zoneinfo" (the standard library,
+# quicker to start) or "pytz".
+TZ_BACKEND = "zoneinfo"
+
 # Window length in days (left & right from current time). Has to be positive.
 WINDOW = 90
 
 # leave empty if you don't want to attach any tag to recurring events
 RECUR_TAG = "" #":RECURRING::"
 
+# Layout of an org entry (see --template). Fields: {summary}, {tags} (the
+# RECUR_TAG of recurring events), {timestamp}, {description}, {location},
+# {partstat} (your PARTSTAT, such as TENTATIVE, if you are invited) and
+# {partstats} (the PARTSTAT of each of your invited addresses, such as
+# {partstats[alias@example.com]}).
+# A line whose fields are all empty is left out.
+ORG_TEMPLATE = """\
+* {summary}{tags}
+{timestamp}
+
+- {description}
+- {location}
+
+"""
+
+# Maximum number of events kept in the render cache (see --cache).
+CACHE_SIZE = 10000
+
+# Days around now (left & right) over which the occurrence index stores the
+# occurrences of the events (see the index and query commands).
+INDEX_WINDOW = 366
+
+# Expansion budgets, so that a runaway recurrence rule (or a huge WINDOW)
+# cannot stall a conversion: a recurring event is cut short after this many
+# occurrences, or seconds spent expanding it, and the recurring events of a
+# calendar after these totals. None lifts a budget. The time budgets depend
+# on the load of the machine, and so does the output when they are used.
+EVENT_OCCURRENCES = 10000
+EVENT_SECONDS = None
+CALENDAR_OCCURRENCES = 200000
+CALENDAR_SECONDS = None
+
+# Number of most expensive recurring events reported by --stats.
+STATS_TOP = 10
+
+# Seconds between two checks of the input files in --watch mode.
+WATCH_INTERVAL = 60
+
+# Maximum number of feeds fetched at once from the same host, and seconds
+# to wait for a feed before giving up.
+FETCH_PER_HOST = 4
+FETCH_TIMEOUT = 30
+
 # Do not change anything below
 
-def orgDatetime(dt):
-    '''Given a datetime in his own timezone, return YYYY-MM-DD DayofWeek HH:MM in local timezone'''
-    return dt.astimezone(LOCAL_TZ).strftime("<%Y-%m-%d %a %H:%M>")
+FEED_SCHEMES = ("http://", "https://", "webcal://")
+FETCH_REDIRECTS = 5
+
+# Events are pruned from their raw times, compared as UTC, when they end this
+# long before the window or start this long after it. It covers any timezone
+# offset and the window being rounded to whole days by the render cache.
+PRUNE_SLACK = timedelta(days = 3)
+
+RAW_NAME = re.compile(r"[^;:]*")
+
+# Property drawer identifying the entries of an org file kept up to date in
+# place (see --update), and the headlines splitting such a file into entries.
+ENTRY_DRAWER = ":PROPERTIES:\n:ICAL_UID: {}\n:ICAL_START: {}\n:ICAL_HASH: {}\n:END:\n"
+ENTRY_DRAWER_LINES = re.compile(rb"\n:PROPERTIES:\n:ICAL_UID: ([^\n]*)\n"
+                                rb":ICAL_START: ([^\n]*)\n:ICAL_HASH: ([0-9a-f]+)\n"
+                                rb":END:\n")
+ORG_HEADLINE = re.compile(rb"\n\*+ ")
+ENTRY_HASH_LENGTH = 16
+
+# Shard file names: unsafe characters of calendar names are replaced, and
+# the shards of the previous run are read from the index file.
+SHARD_KINDS = ("month", "calendar")
+SHARD_UNSAFE = re.compile(r"[^\w.-]+")
+SHARD_INCLUDE = re.compile(r'^#\+INCLUDE: "([^"]*)"$', re.M)
+
+# Properties read from the raw lines of a VEVENT before parsing it.
+RAW_PROPS = ('DTSTART', 'DTEND', 'RRULE', 'UID', 'RECURRENCE-ID', 'SEQUENCE')
+
+# The range of the occurrence index moves by this many days at a time, so
+# that it only has to be expanded again once in a while.
+INDEX_STEP = 28
+
+# Seconds a process waits for another one writing to a shared render cache.
+CACHE_TIMEOUT = 60
+
+# Bytes of a calendar that cannot be read twice, such as stdin, kept in
+# memory; a larger one is copied to a temporary file.
+SPOOL_SIZE = 16 << 20
+
+# Raw lines looked at when walking a calendar in memory: the BEGIN and END
+# lines, and the (possibly folded) lines needed to prune an event, to find
+# an override or to tell copies of an event apart. They are matched from the
+# newline before them, which is much faster than with re.M; the first line
+# of a buffer is matched on its own.
+FIRST_COMPONENT_LINE = re.compile(rb"(BEGIN|END):[ \t]*([A-Za-z0-9-]+)[^\n]*", re.I)
+COMPONENT_LINE = re.compile(rb"\n(BEGIN|END):[ \t]*([A-Za-z0-9-]+)[^\n]*", re.I)
+RAW_VALUE_LINE = re.compile(rb"\n(DTSTART|DTEND|RRULE|UID|RECURRENCE-ID|SEQUENCE)"
+                            rb"([;:][^\n]*(?:\n[ \t][^\n]*)*)", re.I)
+OVERRIDE_LINE = re.compile(rb"\nRECURRENCE-ID[;:]", re.I)
+FOLD = re.compile(rb"\r?\n[ \t]")
+
+TEMPLATE_FIELDS = ('summary', 'tags', 'timestamp', 'description', 'location',
+                   'partstat', 'partstats')
+TEMPLATE_FIELD_NAME = re.compile(r"[^.[]*")
+
+# Participation statuses: no reply, then the replies from the least to the
+# most engaged.
+PARTSTATS = ['NEEDS-ACTION', 'DECLINED', 'TENTATIVE', 'DELEGATED', 'ACCEPTED']
+
+DAY_TAGS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+BYDAY_VALUE = re.compile(r"[+-]?([1-9]|[1-4][0-9]|5[0-3])?(MO|TU|WE|TH|FR|SA|SU)\Z", re.I)
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
-def orgDate(dt):
-    '''Given a date in his own timezone, return YYYY-MM-DD DayofWeek in local timezone'''
-    return dt.astimezone(LOCAL_TZ).strftime("<%Y-%m-%d %a>")
+utc = timezone.utc
 
-def get_datetime(dt):
-    '''Given a datetime, return it. If argument is date, convert it to a local datetime'''
+def wall_seconds(naive_dt):
+    '''Given a naive datetime, return its whole seconds since the epoch
+    as if it were UTC.'''
+    return (naive_dt.toordinal() - EPOCH_ORDINAL) * 86400 + \
+        naive_dt.hour * 3600 + naive_dt.minute * 60 + naive_dt.second
+
+class TzTable:
+    '''UTC offsets of a pytz timezone, taken once from its DST transition
+    table as sorted integer intervals, so converting and localizing times
+    is a bisection plus integer math. Results are the same as the pytz
+    astimezone and localize (is_dst=False) calls they replace.'''
+    def __init__(self, tz):
+        if hasattr(tz, '_utc_transition_times'):
+            self.times = [wall_seconds(t) for t in tz._utc_transition_times]
+            infos = tz._transition_info
+            self.tzinfos = [tz._tzinfos[inf] for inf in infos]
+            self.offsets = [int(inf[0].total_seconds()) for inf in infos]
+            self.dst = [bool(inf[1]) for inf in infos]
+        else:
+            self.times = [0]
+            self.tzinfos = [tz]
+            self.offsets = [int(tz.utcoffset(None).total_seconds())]
+            self.dst = [False]
+        self.day_prefixes = dict()
+
+    def index_at(self, utc_seconds):
+        '''Return the index of the interval holding a UTC time.'''
+        return max(0, bisect_right(self.times, utc_seconds) - 1)
+
+    def day_prefix(self, day_ord):
+        '''Return the memoized "<YYYY-MM-DD Dow" string of an ordinal day.'''
+        prefix = self.day_prefixes.get(day_ord)
+        if prefix is None:
+            prefix = date.fromordinal(day_ord).strftime("<%Y-%m-%d %a")
+            self.day_prefixes[day_ord] = prefix
+        return prefix
+
+    def local_seconds(self, dt):
+        '''Given an aware datetime, or UTC seconds since the epoch, return
+        its local whole seconds since the epoch.'''
+        if isinstance(dt, datetime):
+            dt = dt.timestamp()
+        utc_seconds = int(dt // 1)
+        return utc_seconds + self.offsets[self.index_at(utc_seconds)]
+
+    def wall_index(self, wall):
+        '''Return the index of the interval in effect at a local wall time
+        in seconds, preferring standard time when it is ambiguous.'''
+        found = dict()
+        for guess in (wall - 86400, wall + 86400):
+            utc_seconds = wall - self.offsets[self.index_at(guess)]
+            i = self.index_at(utc_seconds)
+            if utc_seconds + self.offsets[i] == wall:
+                found[utc_seconds] = i
+        if not found:
+            # Skipped over by a transition: keep the wall time with the
+            # offset in effect before it.
+            return self.wall_index(wall - 6 * 3600)
+        if len(found) > 1:
+            standard = dict((t, i) for t, i in found.items() if not self.dst[i])
+            found = standard or found
+        return found[max(found)]
+
+    def localize(self, naive_dt):
+        '''Given a naive local datetime, attach the tzinfo in effect at that
+        wall time.'''
+        return naive_dt.replace(tzinfo = self.tzinfos[self.wall_index(wall_seconds(naive_dt))])
+
+    def utc_seconds(self, naive_dt):
+        '''Given a naive local datetime, return the UTC seconds since the
+        epoch of the time localize gives, without building it.'''
+        wall = wall_seconds(naive_dt)
+        return wall - self.offsets[self.wall_index(wall)]
+
+class ZoneTable(TzTable):
+    '''UTC offsets of a tzinfo without a pytz transition table, such as a
+    zoneinfo timezone, asked of the tzinfo itself, with the same results
+    and memoized day prefixes as a TzTable.'''
+    def __init__(self, tz):
+        self.tz = tz
+        self.day_prefixes = dict()
+
+    def local_seconds(self, dt):
+        '''Given an aware datetime, or UTC seconds since the epoch, return
+        its local whole seconds since the epoch.'''
+        if isinstance(dt, datetime):
+            dt = dt.timestamp()
+        return wall_seconds(datetime.fromtimestamp(int(dt // 1), self.tz))
+
+    def localize(self, naive_dt):
+        '''Given a naive local datetime, attach the tzinfo. A wall time that
+        is ambiguous, or skipped over by a DST change, is taken in standard
+        time, as pytz localize (is_dst=False) does.'''
+        dt = naive_dt.replace(tzinfo = self.tz)
+        other = dt.replace(fold = 1)
+        if dt.utcoffset() != other.utcoffset() and dt.dst():
+            return other
+        return dt
+
+    def utc_seconds(self, naive_dt):
+        '''Given a naive local datetime, return the UTC seconds since the
+        epoch of the time localize gives.'''
+        return int(self.localize(naive_dt).timestamp())
+
+TZ_TABLES = dict()
+
+def tz_table(tz):
+    '''Return the TzTable of a pytz timezone, or the ZoneTable of another
+    tzinfo.'''
+    key = getattr(tz, 'zone', None) or tz
+    table = TZ_TABLES.get(key)
+    if table is None:
+        table = TZ_TABLES[key] = TzTable(tz) if hasattr(tz, 'localize') else ZoneTable(tz)
+    return table
+
+TIMEZONES = dict()
+
+def get_timezone(tz):
+    '''Given a timezone, or its name, return the timezone, loaded with
+    TZ_BACKEND.'''
+    if not isinstance(tz, str):
+        return tz
+    key = (TZ_BACKEND, tz)
+    found = TIMEZONES.get(key)
+    if found is None:
+        if TZ_BACKEND == "pytz":
+            from pytz import timezone as pytz_timezone
+            found = pytz_timezone(tz)
+        else:
+            from zoneinfo import ZoneInfo
+            found = ZoneInfo(tz)
+        TIMEZONES[key] = found
+    return found
+
+def orgDatetime(dt, local_tz = None):
+    '''Given a datetime in his own timezone, or UTC seconds since the epoch,
+    return YYYY-MM-DD DayofWeek HH:MM in local timezone (default: LOCAL_TZ)'''
+    if local_tz is None:
+        local_tz = get_timezone(LOCAL_TZ)
+    table = tz_table(local_tz)
+    local = table.local_seconds(dt)
+    day, seconds = divmod(local, 86400)
+    return "{} {:02d}:{:02d}>".format(table.day_prefix(day + EPOCH_ORDINAL),
+                                      seconds // 3600, seconds // 60 % 60)
+
+def orgDate(dt, days = 0, local_tz = None):
+    '''Given a date in his own timezone, or UTC seconds since the epoch,
+    return YYYY-MM-DD DayofWeek in local timezone (default: LOCAL_TZ), days
+    later'''
+    if local_tz is None:
+        local_tz = get_timezone(LOCAL_TZ)
+    table = tz_table(local_tz)
+    return table.day_prefix(table.local_seconds(dt) // 86400 + EPOCH_ORDINAL + days) + ">"
+
+def local_ordinal(seconds, local_tz = None):
+    '''Given UTC seconds since the epoch, return the ordinal of the date in
+    local timezone (default: LOCAL_TZ).'''
+    if local_tz is None:
+        local_tz = get_timezone(LOCAL_TZ)
+    return tz_table(local_tz).local_seconds(seconds) // 86400 + EPOCH_ORDINAL
+
+def get_datetime(dt, local_tz = None):
+    '''Given a datetime, return it. If argument is date, convert it to a local datetime
+    in local_tz (default: LOCAL_TZ)'''
+    if local_tz is None:
+        local_tz = get_timezone(LOCAL_TZ)
     if isinstance(dt, datetime):
         return dt
     elif isinstance(dt, date):
-        return datetime(year = dt.year, month = dt.month, day = dt.day, tzinfo = LOCAL_TZ)
+        # Localize rather than pass tzinfo, which would take the first
+        # (local mean time) offset of the timezone.
+        return tz_table(local_tz).localize(datetime(year = dt.year, month = dt.month, day = dt.day))
     else:
         # The given ical date may have a timezone. If not, use the
         # default for the calendar.
         if "TZID" in dt.params:
-            tz = timezine(dt.params["TZID"])
+            tz = get_timezone(dt.params["TZID"])
         else:
-            tz = LOCAL_TZ
+            tz = local_tz
 
         aux_dt = datetime(year = dt.year, month = dt.month, day = dt.day, tzinfo = tz)
         return aux_dt
 
-def add_delta_dst(dt, delta):
-    '''Add a timedelta to a datetime, adjusting DST when appropriate'''
-    # convert datetime to naive, add delta and convert again to his own timezone
-    naive_dt = dt.replace(tzinfo = None)
-    return dt.tzinfo.localize(naive_dt + delta)
+def shifted_seconds(dt, days):
+    '''Return the UTC seconds since the epoch of an aware datetime moved by
+    whole days in its own timezone, adjusting DST when appropriate'''
+    naive_dt = dt.replace(tzinfo = None) + timedelta(days = days)
+    return tz_table(dt.tzinfo).utc_seconds(naive_dt)
+
+class Occurrence:
+    '''One occurrence of an event: its start and end as UTC seconds since
+    the epoch, and whether it comes from a recurring event.'''
+    __slots__ = ('start', 'end', 'recurring')
+
+    def __init__(self, start, end, recurring):
+        self.start = start
+        self.end = end
+        self.recurring = recurring
 
-def advance_just_before(start_dt, timeframe_start, delta_days):
-    '''Advance an start_dt datetime to the first date just before
-    timeframe_start. Use delta_days for advancing the event. Precond:
-    start_dt < timeframe_start'''
-    delta = timedelta(days = delta_days)
-    delta_ord = floor( (timeframe_start.toordinal() - start_dt.toordinal() - 1) / delta_days )
-    return (add_delta_dst(start_dt, timedelta(days = delta_days * int(delta_ord))), int(delta_ord))
+    def __eq__(self, other):
+        return isinstance(other, Occurrence) and \
+            (self.start, self.end, self.recurring) == (other.start, other.end, other.recurring)
 
+    def __repr__(self):
+        return "Occurrence({}, {}, {})".format(self.start, self.end, self.recurring)
 
-def generate_event_iterator(comp, timeframe_start, timeframe_end):
-    ''' Given an VEVENT object return an iterator with the proper delta (days, weeks, etc)'''
+def generate_event_iterator(comp, timeframe_start, timeframe_end, local_tz = None,
+                            budget = None):
+    ''' Given an VEVENT object return an iterator with the proper delta (days, weeks, etc)
+    over its Occurrences. All day events are taken in local_tz (default: LOCAL_TZ).
+    Recurring events are expanded within budget, the ExpansionBudget of their
+    calendar (default: one of their own)'''
     # Note: timeframe_start and timeframe_end are in UTC
     if comp.name != 'VEVENT': return []
-    if 'RRULE' in comp:
-        if comp['RRULE']['FREQ'][0] == 'WEEKLY':
-            return EventRecurDaysIter(7, comp, timeframe_start, timeframe_end)
-        elif comp['RRULE']['FREQ'][0] == 'DAILY':
-            return EventRecurDaysIter(1, comp, timeframe_start, timeframe_end)
-        elif comp['RRULE']['FREQ'][0] == 'MONTHLY':
-            return list()
-        elif comp['RRULE']['FREQ'][0] == 'YEARLY':
-            return EventRecurYearlyIter(comp, timeframe_start, timeframe_end)
+    if 'RRULE' not in comp:
+        return EventSingleIter(comp, timeframe_start, timeframe_end, local_tz)
+    if budget is None:
+        budget = ExpansionBudget()
+    uid = str(comp.get('UID', ''))
+    problem = rule_problem(comp['RRULE'])
+    if problem is not None:
+        budget.skip(uid, "malformed RRULE, {}".format(problem), 'malformed')
+        return []
+    if comp['RRULE']['FREQ'][0] == 'WEEKLY':
+        event_iter = EventRecurDaysIter(7, comp, timeframe_start, timeframe_end, local_tz)
+    elif comp['RRULE']['FREQ'][0] == 'DAILY':
+        event_iter = EventRecurDaysIter(1, comp, timeframe_start, timeframe_end, local_tz)
+    elif comp['RRULE']['FREQ'][0] == 'MONTHLY':
+        event_iter = EventRecurMonthlyIter(comp, timeframe_start, timeframe_end, local_tz)
+    elif comp['RRULE']['FREQ'][0] == 'YEARLY':
+        event_iter = EventRecurYearlyIter(comp, timeframe_start, timeframe_end, local_tz)
     else:
-        return EventSingleIter(comp, timeframe_start, timeframe_end)
+        budget.skip(uid, "unsupported FREQ={}".format(comp['RRULE']['FREQ'][0]),
+                    'unsupported')
+        return []
+    return event_iter.limit(uid, budget)
+
+def rule_problem(rrule):
+    '''Return what makes a parsed RRULE malformed, or None if it can be
+    expanded. icalendar leaves the rules it cannot read as None.'''
+    if rrule is None:
+        return "unreadable"
+    if not rrule.get('FREQ'):
+        return "no FREQ"
+    if rrule.get('INTERVAL', [1])[0] < 1:
+        return "INTERVAL below 1"
+    if 'COUNT' in rrule and 'UNTIL' in rrule:
+        return "both COUNT and UNTIL"
+    for day in rrule.get('BYDAY', []):
+        if not BYDAY_VALUE.match(str(day)):
+            return "unknown BYDAY {}".format(day)
+    if str(rrule.get('WKST', ['MO'])[0]).upper() not in DAY_TAGS:
+        return "unknown WKST"
+    return None
 
 class EventSingleIter:
     '''Iterator for non-recurring single events.'''
-    def __init__(self, comp, timeframe_start, timeframe_end):
-        self.ev_start = get_datetime(comp['DTSTART'].dt)
+    def __init__(self, comp, timeframe_start, timeframe_end, local_tz = None):
+        self.ev_start = get_datetime(comp['DTSTART'].dt, local_tz)
 
         # Events with the same begin/end time same do not include
         # "DTEND".
         if "DTEND" not in comp:
             self.ev_end = self.ev_start
         else:
-            self.ev_end = get_datetime(comp['DTEND'].dt)
+            self.ev_end = get_datetime(comp['DTEND'].dt, local_tz)
 
-        self.duration = self.ev_end - self.ev_start
-        self.result = ()
+        self.result = None
         if (self.ev_start < timeframe_end and self.ev_end > timeframe_start):
-            self.result = ( self.ev_start, self.ev_end, 0)
+            self.result = Occurrence(int(self.ev_start.timestamp()),
+                                     int(self.ev_end.timestamp()), False)
 
     def __iter__(self):
         return self
@@ -103,267 +439,2884 @@ class EventSingleIter:
     def __next__(self):
         if self.result:
             aux = self.result
-            self.result = ()
+            self.result = None
         else:
             raise StopIteration
         return aux
 
-class EventRecurDaysIter:
-    '''Iterator for daily-based recurring events (daily, weekly).'''
-    def __init__(self, days, comp, timeframe_start, timeframe_end):
-        self.ev_start = get_datetime(comp['DTSTART'].dt)
+class ExpansionBudget:
+    '''The occurrences and time that the recurring events of a calendar may
+    take to expand, per event and in total (see EVENT_OCCURRENCES,
+    EVENT_SECONDS, CALENDAR_OCCURRENCES and CALENDAR_SECONDS). The events
+    cut short are warned about on stderr, and counted in the optional
+    ConvertStats.'''
+    def __init__(self, stats = None):
+        self.event_occurrences = EVENT_OCCURRENCES
+        self.event_seconds = EVENT_SECONDS
+        self.calendar_occurrences = CALENDAR_OCCURRENCES
+        self.calendar_seconds = CALENDAR_SECONDS
+        self.stats = stats
+        self.occurrences = 0
+        self.seconds = 0.0
+        self.truncated = 0
+
+    def over(self, count, seconds):
+        '''Return True if an event that took seconds to give count
+        occurrences, or the calendar, has used up its budget.'''
+        return (self.event_occurrences is not None and count >= self.event_occurrences) or \
+            (self.event_seconds is not None and seconds > self.event_seconds) or \
+            (self.calendar_occurrences is not None and
+             self.occurrences >= self.calendar_occurrences) or \
+            (self.calendar_seconds is not None and self.seconds > self.calendar_seconds)
+
+    def out_of_time(self, seconds, pending):
+        '''Return True if an event that took seconds, and the calendar, with
+        pending seconds not yet counted, are over their time budget.'''
+        return (self.event_seconds is not None and seconds + pending > self.event_seconds) or \
+            (self.calendar_seconds is not None and
+             self.seconds + pending > self.calendar_seconds)
+
+    def skip(self, uid, reason, counter):
+        '''Report a recurring event that is not expanded at all, for reason,
+        counting it under the counter of that name of the stats.'''
+        if self.stats is not None:
+            setattr(self.stats, counter, getattr(self.stats, counter) + 1)
+        print("WARNING skipped recurring event {}: {}".format(uid, reason),
+              file=sys.stderr)
+
+    def truncate(self, uid, count):
+        '''Report a recurring event cut short after count occurrences.'''
+        self.truncated += 1
+        if self.stats is not None:
+            self.stats.truncated += 1
+        print("WARNING truncated recurring event {} after {} occurrences: "
+              "over the expansion budget".format(uid, count), file=sys.stderr)
+
+class RecurIter:
+    '''Base of the recurring event iterators, which give their occurrences
+    from next_occurrence. Once limited to an ExpansionBudget, the iterator
+    stops early, and the event is reported truncated, when one more
+    occurrence would put the event or its calendar over budget. The loops of
+    next_occurrence that skip over non-matching days check out_of_time, and
+    give up with None, so that a single call is bounded too.'''
+    budget = None
+    truncated = False
+    t0 = 0.0
+    # Length of an all-day event in days, None for one with a time.
+    day_span = None
+
+    def limit(self, uid, budget):
+        '''Expand the event of the given UID within budget, returning the
+        iterator.'''
+        self.uid = uid
+        self.budget = budget
+        self.emitted = 0
+        self.spent = 0.0
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        budget = self.budget
+        if budget is None:
+            return self.next_occurrence()
+        if self.truncated:
+            raise StopIteration
+        self.t0 = time.perf_counter()
+        try:
+            occurrence = self.next_occurrence()
+        finally:
+            elapsed = time.perf_counter() - self.t0
+            self.spent += elapsed
+            budget.seconds += elapsed
+        if occurrence is None or budget.over(self.emitted, self.spent):
+            self.truncated = True
+            budget.truncate(self.uid, self.emitted)
+            raise StopIteration
+        self.emitted += 1
+        budget.occurrences += 1
+        return occurrence
+
+    def out_of_time(self):
+        '''Return True if the current next_occurrence call has put the event
+        or its calendar over its time budget.'''
+        return self.budget is not None and \
+            self.budget.out_of_time(self.spent, time.perf_counter() - self.t0)
+
+    def span(self, comp):
+        '''Take the duration of the event from its ev_start and ev_end, and
+        its length in days if it lasts whole days.'''
+        self.duration = int(self.ev_end.timestamp() - self.ev_start.timestamp())
+        if not isinstance(comp['DTSTART'].dt, datetime):
+            self.day_span = self.ev_end.toordinal() - self.ev_start.toordinal()
+
+    def occurrence_at(self, start):
+        '''Return the Occurrence starting at start, in UTC seconds since the
+        epoch. An all-day one ends at local midnight day_span days later, as
+        the length of those days changes with DST.'''
+        if self.day_span is None:
+            return Occurrence(start, start + self.duration, True)
+        days = local_ordinal(start, self.ev_start.tzinfo) - self.start_ord + self.day_span
+        return Occurrence(start, shifted_seconds(self.ev_start, days), True)
 
-        self.ev_end = get_datetime(comp['DTEND'].dt)
-        self.duration = self.ev_end - self.ev_start
+class EventRecurDaysIter(RecurIter):
+    '''Iterator for daily-based recurring events (daily, weekly).
+
+    The rule is reduced to a period of whole days plus the sorted day
+    offsets that match it inside each period, so the n-th occurrence is
+    found arithmetically and only the emitted ones get localized.'''
+    def __init__(self, days, comp, timeframe_start, timeframe_end, local_tz = None):
+        rrule = comp['RRULE']
+        self.ev_start = get_datetime(comp['DTSTART'].dt, local_tz)
+
+        self.ev_end = get_datetime(comp['DTEND'].dt, local_tz)
+        self.span(comp)
+        self.start = timeframe_start.timestamp()
         self.is_count = False
-        self.day_list = list()
-
-        if 'BYDAY' in comp['RRULE']:
-            day_num = self.set_day_num(comp['RRULE'])
-            self.day_list = [ day_num[day_name] for day_name in comp['RRULE']['BYDAY'] ]
-            delta_days = 1
-        elif comp['RRULE']['FREQ'][0] == 'WEEKLY':
-            self.day_list = [0, 1, 2, 3, 4, 5, 6]
-            delta_days = 7
+        self.n = 0
+
+        interval = rrule.get('INTERVAL', [1])[0]
+        self.start_ord = self.ev_start.toordinal()
+        self.anchor = self.start_ord
+        self.offsets = [0]
+        if days == 7:
+            self.period = 7 * interval
+            if 'BYDAY' in rrule:
+                wkst = DAY_TAGS.index(rrule.get('WKST', ['MO'])[0])
+                self.anchor -= (self.ev_start.weekday() - wkst) % 7
+                self.offsets = sorted(set((DAY_TAGS.index(day[-2:]) - wkst) % 7
+                                          for day in rrule['BYDAY']))
         else:
-            self.day_list = [self.ev_start.weekday()]
-            delta_days = 1
+            self.period = interval
+            if 'BYDAY' in rrule:
+                # Filter the days by weekday: the pattern repeats once both
+                # the interval and the week come round again.
+                day_list = [DAY_TAGS.index(day[-2:]) for day in rrule['BYDAY']]
+                self.period = interval * 7 // gcd(interval, 7)
+                self.offsets = [off for off in range(0, self.period, interval)
+                                if (self.ev_start.weekday() + off) % 7 in day_list]
 
-        if 'COUNT' in comp['RRULE']:
+        # Occurrences are numbered from DTSTART, which always counts as the
+        # first one even when it does not match the rule.
+        self.first_slot = bisect_left(self.offsets, self.start_ord - self.anchor)
+        self.extra = 1
+        if self.first_slot < len(self.offsets) and \
+           self.anchor + self.offsets[self.first_slot] == self.start_ord:
+            self.extra = 0
+
+        if 'COUNT' in rrule:
             self.is_count = True
-            self.count = comp['RRULE']['COUNT'][0]
-        if 'INTERVAL' in comp['RRULE']:
-            delta_days *= comp['RRULE']['INTERVAL'][0]
-        self.delta = timedelta(delta_days)
-        if 'UNTIL' in comp['RRULE']:
+            self.count = rrule['COUNT'][0]
+        if 'UNTIL' in rrule:
             if self.is_count:
-                raise "UNTIL and COUNT MUST NOT occur in the same 'recur'"
-            self.until_utc = get_datetime(comp['RRULE']['UNTIL'][0]).astimezone(utc)
+                raise ValueError("UNTIL and COUNT MUST NOT occur in the same 'recur'")
+            self.until_utc = get_datetime(rrule['UNTIL'][0], local_tz).astimezone(utc)
         else :
             self.until_utc = timeframe_end
+        self.until_utc = min(self.until_utc, timeframe_end)
+        self.until = self.until_utc.timestamp()
         if self.until_utc < timeframe_start:
-            self.current = self.until_utc + self.delta # Default value for no iteration
+            self.is_count = True
+            self.count = 0
             return
-        self.until_utc = min(self.until_utc, timeframe_end)
         if self.ev_start < timeframe_start:
-            # advance to timeframe start
-            (self.current, counts) = advance_just_before(self.ev_start, timeframe_start, delta_days)
+            # Seek to the day before the timeframe in the event timezone,
+            # the few occurrences left before it are skipped on iteration.
+            target = timeframe_start.astimezone(self.ev_start.tzinfo).toordinal() - 1
+            self.n = max(self.n, self.slot_at(target) - self.first_slot + self.extra)
+
+    def slot_at(self, day_ord):
+        '''Return the index of the first slot of the rule on or after the
+        given ordinal day.'''
+        if not self.offsets:
+            return 0
+        p = (day_ord - self.anchor) // self.period
+        j = bisect_left(self.offsets, day_ord - self.anchor - p * self.period)
+        return p * len(self.offsets) + j
+
+    def occurrence(self, n):
+        '''Return the start of the n-th occurrence as UTC seconds since the
+        epoch, or None if the rule has no such occurrence.'''
+        if n < self.extra:
+            return int(self.ev_start.timestamp())
+        if not self.offsets:
+            return None
+        p, j = divmod(self.first_slot + n - self.extra, len(self.offsets))
+        day_ord = self.anchor + p * self.period + self.offsets[j]
+        return shifted_seconds(self.ev_start, day_ord - self.start_ord)
+
+    def next_occurrence(self):
+        while True:
+            if self.out_of_time():
+                return None
+            if self.is_count and self.n >= self.count:
+                raise StopIteration
+            start = self.occurrence(self.n)
+            if start is None or start > self.until:
+                raise StopIteration
+            self.n += 1
+            if start >= self.start:
+                return self.occurrence_at(start)
+
+
+def weekday_days(first_weekday, length, byday):
+    '''Return the set of day numbers (from 1) matched by BYDAY values such
+    as (0, MO), (2, TU) or (-1, FR) in a month or year of the given length
+    whose first day falls on first_weekday.'''
+    days = set()
+    for ordinal, weekday in byday:
+        first = 1 + (weekday - first_weekday) % 7
+        if ordinal == 0:
+            days.update(range(first, length + 1, 7))
+        elif ordinal > 0:
+            day = first + 7 * (ordinal - 1)
+            if day <= length:
+                days.add(day)
+        else:
+            day = first + 7 * ((length - first) // 7 + ordinal + 1)
+            if day >= 1:
+                days.add(day)
+    return days
+
+def resolve_days(values, length):
+    '''Resolve BYMONTHDAY or BYYEARDAY values, negative ones counting from
+    the end, into the set of day numbers (from 1) of a period.'''
+    days = set()
+    for value in values:
+        day = value if value > 0 else length + 1 + value
+        if 1 <= day <= length:
+            days.add(day)
+    return days
+
+class RecurrencePlan:
+    '''A monthly or yearly RRULE compiled once into the days it matches in
+    each period.
+
+    A period is one month (MONTHLY) or one year (YEARLY), identified by the
+    index year * 12 + month - 1 of its first month. The days a rule matches
+    in a period only depend on the shape of the period (its month, length
+    and first weekday), so they are worked out once per shape. BYMONTH,
+    BYMONTHDAY, BYYEARDAY, BYDAY with or without ordinals, BYSETPOS and
+    INTERVAL are supported; WKST only matters to weekly rules, handled by
+    EventRecurDaysIter, and BYWEEKNO is ignored.'''
+    def __init__(self, rrule, dtstart):
+        self.yearly = rrule['FREQ'][0] == 'YEARLY'
+        self.step = rrule.get('INTERVAL', [1])[0] * (12 if self.yearly else 1)
+        self.bymonth = set(rrule.get('BYMONTH', []))
+        self.bymonthday = rrule.get('BYMONTHDAY', [])
+        self.byyearday = rrule.get('BYYEARDAY', [])
+        self.bysetpos = rrule.get('BYSETPOS', [])
+        self.byday = [(int(value[:-2] or 0), DAY_TAGS.index(value[-2:].upper()))
+                      for value in rrule.get('BYDAY', [])]
+        self.dtstart_month = dtstart.month
+        self.dtstart_day = dtstart.day
+        self.first = dtstart.year * 12 + (0 if self.yearly else dtstart.month - 1)
+        self.shapes = dict()
+
+    def start_ord(self, index):
+        '''Return the ordinal of the first day of a period.'''
+        year, month = divmod(index, 12)
+        return date(year, month + 1, 1).toordinal()
+
+    def days(self, index):
+        '''Return the sorted ordinals of the days matched in a period.'''
+        year, month = divmod(index, 12)
+        month += 1
+        first_ord = date(year, month, 1).toordinal()
+        if self.yearly:
+            shape = (isleap(year), first_ord % 7)
+        else:
+            shape = (month, monthrange(year, month)[1], first_ord % 7)
+        offsets = self.shapes.get(shape)
+        if offsets is None:
+            if self.yearly:
+                offsets = self.year_offsets(year)
+            elif self.bymonth and month not in self.bymonth:
+                offsets = []
+            else:
+                offsets = [day - 1 for day in self.month_days(year, month)]
+            offsets = self.shapes[shape] = self.set_positions(offsets)
+        return [first_ord + offset for offset in offsets]
+
+    def month_days(self, year, month):
+        '''Return the sorted day numbers matched in a month by BYMONTHDAY and
+        BYDAY (ordinals counting in the month), or the DTSTART day when
+        neither is given.'''
+        first_weekday, length = monthrange(year, month)
+        if self.bymonthday:
+            days = resolve_days(self.bymonthday, length)
+            if self.byday:
+                days &= weekday_days(first_weekday, length, self.byday)
+        elif self.byday:
+            days = weekday_days(first_weekday, length, self.byday)
+        elif self.dtstart_day <= length:
+            days = set([self.dtstart_day])
+        else:
+            days = set()
+        return sorted(days)
+
+    def year_offsets(self, year):
+        '''Return the sorted day offsets from January 1st matched in a year.'''
+        jan1 = date(year, 1, 1).toordinal()
+        length = 366 if isleap(year) else 365
+        if self.byyearday:
+            offsets = list()
+            for day in sorted(resolve_days(self.byyearday, length)):
+                day_date = date.fromordinal(jan1 + day - 1)
+                if self.bymonth and day_date.month not in self.bymonth:
+                    continue
+                if self.bymonthday and day_date.day not in resolve_days(
+                        self.bymonthday, monthrange(year, day_date.month)[1]):
+                    continue
+                if self.byday and day_date.weekday() not in \
+                   [weekday for _, weekday in self.byday]:
+                    continue
+                offsets.append(day - 1)
+            return offsets
+        if not self.bymonth and (self.byday or self.bymonthday):
+            # Without BYMONTH, BYDAY ordinals count in the whole year.
+            days = None
+            if self.bymonthday:
+                days = set()
+                for month in range(1, 13):
+                    month_offset = date(year, month, 1).toordinal() - jan1
+                    days.update(month_offset + day for day in resolve_days(
+                        self.bymonthday, monthrange(year, month)[1]))
+            if self.byday:
+                weekdays = weekday_days(date(year, 1, 1).weekday(), length, self.byday)
+                days = weekdays if days is None else days & weekdays
+            return [day - 1 for day in sorted(days)]
+        months = sorted(self.bymonth) or [self.dtstart_month]
+        offsets = list()
+        for month in months:
+            month_offset = date(year, month, 1).toordinal() - jan1
+            offsets.extend(month_offset + day - 1 for day in self.month_days(year, month))
+        return offsets
+
+    def set_positions(self, offsets):
+        '''Apply BYSETPOS to the sorted offsets of a period.'''
+        if not self.bysetpos:
+            return offsets
+        picked = set()
+        for pos in self.bysetpos:
+            if 0 < pos <= len(offsets):
+                picked.add(offsets[pos - 1])
+            elif 0 < -pos <= len(offsets):
+                picked.add(offsets[pos])
+        return sorted(picked)
+
+class EventRecurMonthsIter(RecurIter):
+    '''Iterator for month-based recurring events (monthly, yearly).
+
+    The RRULE is compiled into a RecurrencePlan and occurrences are expanded
+    one period at a time. Periods before the window are skipped
+    arithmetically, only counting their matches when there is a COUNT, and
+    only the emitted occurrences get localized.'''
+    def __init__(self, comp, timeframe_start, timeframe_end, local_tz = None):
+        rrule = comp['RRULE']
+        self.ev_start = get_datetime(comp['DTSTART'].dt, local_tz)
+        self.ev_end = get_datetime(comp['DTEND'].dt, local_tz)
+        self.span(comp)
+        self.start = timeframe_start.timestamp()
+        self.plan = RecurrencePlan(rrule, self.ev_start)
+        self.start_ord = self.ev_start.toordinal()
+        self.is_count = False
+        self.n = 0
+
+        if 'COUNT' in rrule:
+            self.is_count = True
+            self.count = rrule['COUNT'][0]
+        if 'UNTIL' in rrule:
             if self.is_count:
-                self.count -= counts
-                if self.count < 1: return
-            while self.current < timeframe_start:
-                self.current = add_delta_dst(self.current, self.delta)
+                raise ValueError("UNTIL and COUNT MUST NOT occur in the same 'recur'")
+            self.until_utc = get_datetime(rrule['UNTIL'][0], local_tz).astimezone(utc)
+        else :
+            self.until_utc = timeframe_end
+        self.until_utc = min(self.until_utc, timeframe_end)
+        self.until = self.until_utc.timestamp()
+        tzinfo = self.ev_start.tzinfo
+        self.until_ord = self.until_utc.astimezone(tzinfo).toordinal() + 1
+        self.target = timeframe_start.astimezone(tzinfo).toordinal() - 1
+
+        # Occurrences are numbered from DTSTART, which always counts as the
+        # first one even when it does not match the rule.
+        self.index = self.plan.first
+        self.batch = [self.start_ord] + [day_ord for day_ord in self.plan.days(self.index)
+                                         if day_ord > self.start_ord]
+        self.pos = 0
+        self.index += self.plan.step
+        if self.until_utc < timeframe_start:
+            self.batch = []
+            self.index = None
+            return
+
+        # Skip the periods starting before the one holding the day before
+        # the window: they end before it.
+        target = date.fromordinal(max(self.target, 1))
+        target_index = target.year * 12 + (0 if self.plan.yearly else target.month - 1)
+        skip = (target_index - self.plan.first) // self.plan.step
+        if skip < 1:
+            return
+        if self.is_count:
+            self.n = len(self.batch)
+            for i in range(1, skip):
+                self.n += len(self.plan.days(self.plan.first + i * self.plan.step))
+        self.index = self.plan.first + skip * self.plan.step
+        self.batch = self.plan.days(self.index)
+        self.index += self.plan.step
+
+    def next_occurrence(self):
+        while True:
+            if self.out_of_time():
+                return None
+            if self.is_count and self.n >= self.count:
+                raise StopIteration
+            if self.pos >= len(self.batch):
+                if self.index is None or self.plan.start_ord(self.index) > self.until_ord:
+                    raise StopIteration
+                self.batch = self.plan.days(self.index)
+                self.pos = 0
+                self.index += self.plan.step
+                continue
+            day_ord = self.batch[self.pos]
+            self.pos += 1
+            self.n += 1
+            if day_ord > self.until_ord:
+                raise StopIteration
+            if day_ord < self.target:
+                continue
+            start = shifted_seconds(self.ev_start, day_ord - self.start_ord)
+            if start > self.until:
+                raise StopIteration
+            if start >= self.start:
+                return self.occurrence_at(start)
+
+class EventRecurMonthlyIter(EventRecurMonthsIter):
+    '''Iterator for monthly recurring events.'''
+
+class EventRecurYearlyIter(EventRecurMonthsIter):
+    '''Iterator for yearly recurring events.'''
+
+def parse_raw_datetime(value):
+    '''Given a raw DATE or DATE-TIME value, return it as a naive datetime
+    ignoring its timezone, or None if it cannot be read.'''
+    try:
+        if len(value) == 8:
+            return datetime.strptime(value, "%Y%m%d")
+        return datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    except ValueError:
+        return None
+
+def may_intersect(dtstart, dtend, rrule, timeframe_start, timeframe_end):
+    '''Given the raw DTSTART, DTEND and RRULE values of an event (DTEND and
+    RRULE may be None), return False if none of its occurrences can fall in
+    the timeframe. Timezones are not resolved: times are compared as UTC
+    with PRUNE_SLACK to spare, so True only ever means "maybe".'''
+    ev_start = parse_raw_datetime(dtstart)
+    if ev_start is None:
+        return True
+    start = timeframe_start.astimezone(utc).replace(tzinfo = None) - PRUNE_SLACK
+    end = timeframe_end.astimezone(utc).replace(tzinfo = None) + PRUNE_SLACK
+    if ev_start > end:
+        return False
+    if rrule is None:
+        ev_end = ev_start if dtend is None else parse_raw_datetime(dtend)
+        return ev_end is None or ev_end >= start
+
+    parts = dict(part.upper().split("=", 1) for part in rrule.split(";") if "=" in part)
+    if 'UNTIL' in parts:
+        until = parse_raw_datetime(parts['UNTIL'])
+        if until is not None and until < start:
+            return False
+    if 'COUNT' in parts:
+        # Bound the last occurrence by the longest a rule of that frequency
+        # can take between two occurrences.
+        freq = parts.get('FREQ')
+        if freq == 'DAILY' and 'BYDAY' not in parts:
+            span = 1
+        elif freq in ('DAILY', 'WEEKLY'):
+            span = 7
+        elif freq in ('MONTHLY', 'YEARLY'):
+            span = 8 * 366
         else:
-            self.current = self.ev_start
+            return True
+        try:
+            days = int(parts['COUNT']) * int(parts.get('INTERVAL', 1)) * span
+            if ev_start + timedelta(days = days) < start:
+                return False
+        except (ValueError, OverflowError):
+            return True
+    return True
 
-    def __iter__(self):
-        return self
+def component_may_intersect(comp, timeframe_start, timeframe_end):
+    '''Run may_intersect on the raw values of a parsed VEVENT.'''
+    if 'DTSTART' not in comp or ('RRULE' in comp and comp['RRULE'] is None):
+        return True
+    values = [comp[prop].to_ical().decode("UTF-8") if prop in comp else None
+              for prop in ('DTSTART', 'DTEND', 'RRULE')]
+    return may_intersect(*values, timeframe_start, timeframe_end)
 
-    def next_until(self):
-        if self.current > self.until_utc:
-            raise StopIteration
-        event_aux = self.current
-        self.current = add_delta_dst(self.current, self.delta)
-        while self.current.weekday() not in self.day_list:
-            self.current = add_delta_dst(self.current, self.delta)
-        return (event_aux, event_aux.tzinfo.normalize(event_aux + self.duration), 1)
-
-    def next_count(self):
-        if self.count < 1:
-            raise StopIteration
-        self.count -= 1
-        event_aux = self.current
-        self.current = add_delta_dst(self.current, self.delta)
-        while self.current.weekday() not in self.day_list:
-            self.current = add_delta_dst(self.current, self.delta)
-        return (event_aux, event_aux.tzinfo.normalize(event_aux + self.duration), 1)
+def raw_value(line):
+    '''Return the value of an unfolded content line, after the first colon
+    that is not inside a quoted parameter.'''
+    quoted = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            quoted = not quoted
+        elif ch == ':' and not quoted:
+            return line[i + 1:]
+    return ""
 
-    def __next__(self):
-        if self.is_count: return self.next_count()
-        return self.next_until()
+def event_lines_values(event_lines):
+    '''Return the raw values of the RAW_PROPS of a VEVENT, given its
+    content lines, without parsing it.'''
+    values = dict()
+    for line in event_lines[1:]:
+        name = RAW_NAME.match(line).group(0).upper()
+        if name == 'BEGIN':
+            break
+        if name in RAW_PROPS and name not in values:
+            values[name] = raw_value(line)
+    return values
+
+def values_may_intersect(values, timeframe_start, timeframe_end):
+    '''Run may_intersect on the raw values of a VEVENT.'''
+    if 'DTSTART' not in values:
+        return True
+    return may_intersect(values['DTSTART'], values.get('DTEND'), values.get('RRULE'),
+                         timeframe_start, timeframe_end)
+
+def parse_component(kind, text):
+    '''Parse the text of an icalendar component of a kind ("Calendar",
+    "Event" or "Timezone"). icalendar is only imported here, once there is
+    something to parse. Parsing a VTIMEZONE makes icalendar remember its
+    TZID for the components parsed after it.'''
+    import icalendar
+    return getattr(icalendar, kind).from_ical(text)
+
+def unfold_ical_lines(fh):
+    '''Given a file object over an ics calendar, yield its content lines
+    with the RFC 5545 folding removed. Unfolding is done on the raw bytes
+    so that multi-byte characters split across folds are rejoined before
+    decoding.'''
+    parts = None
+    for raw in fh:
+        if isinstance(raw, str):
+            raw = raw.encode("UTF-8")
+        raw = raw.rstrip(b"\r\n")
+        if parts is not None and raw[:1] in (b" ", b"\t"):
+            parts.append(raw[1:])
+            continue
+        if parts:
+            yield b"".join(parts).decode("UTF-8", "replace")
+        parts = [raw] if raw else None
+    if parts:
+        yield b"".join(parts).decode("UTF-8", "replace")
+
+def walk_ical_stream(fh, timeframe = None, stats = None, duplicates = None):
+    '''Given a file object over an ics calendar, yield its components one
+    at a time, in the same order as Calendar.walk() would, without building
+    the whole calendar in memory. The VCALENDAR is yielded first, holding
+    only the properties found before its first sub-component; then every
+    VEVENT (with its VALARMs) is parsed and yielded on its own. Each
+    VTIMEZONE is parsed as it comes, so that icalendar knows its TZID when
+    the events after it are parsed, but is not yielded. Other components are
+    skipped, as convert_ical has no use for them.
+
+    If a (start, end) timeframe is given, VEVENTs that cannot fall in it
+    are dropped from their raw lines, before being parsed, and counted in
+    the optional ConvertStats. So are the copies of an event that a
+    DuplicateIndex does not keep.'''
+    depth = 0
+    cal_lines = None
+    event_lines = None
+    timezone_lines = None
+    for line in unfold_ical_lines(fh):
+        tag, _, value = line.partition(":")
+        tag = tag.upper()
+        if tag == "BEGIN":
+            depth += 1
+            if depth == 1:
+                cal_lines = [line]
+                continue
+            if depth == 2:
+                if cal_lines is not None:
+                    cal_lines.append("END:VCALENDAR")
+                    yield parse_component("Calendar", "\r\n".join(cal_lines))
+                    cal_lines = None
+                if value.strip().upper() == "VEVENT":
+                    event_lines = list()
+                elif value.strip().upper() == "VTIMEZONE":
+                    timezone_lines = list()
+        elif tag == "END":
+            depth -= 1
+            if depth == 0 and cal_lines is not None:
+                cal_lines.append(line)
+                yield parse_component("Calendar", "\r\n".join(cal_lines))
+                cal_lines = None
+                continue
+            if depth == 1 and event_lines is not None:
+                event_lines.append(line)
+                values = event_lines_values(event_lines)
+                if duplicates is not None and not duplicates.keep(values):
+                    if stats is not None:
+                        stats.duplicates += 1
+                elif timeframe is None or values_may_intersect(values, *timeframe):
+                    yield parse_component("Event", "\r\n".join(event_lines))
+                elif stats is not None:
+                    stats.pruned += 1
+                event_lines = None
+                continue
+            if depth == 1 and timezone_lines is not None:
+                timezone_lines.append(line)
+                parse_component("Timezone", "\r\n".join(timezone_lines))
+                timezone_lines = None
+                continue
+        if event_lines is not None:
+            event_lines.append(line)
+        elif timezone_lines is not None:
+            timezone_lines.append(line)
+        elif depth == 1 and cal_lines is not None:
+            cal_lines.append(line)
+
+def map_ical(fh):
+    '''Return (buffer, offset) over the rest of the binary file object fh,
+    without reading it: the value of a BytesIO, or a read-only memory map
+    of a regular file. Return None for other file objects, such as pipes,
+    text or empty files.'''
+    if isinstance(fh, io.BytesIO):
+        return (fh.getvalue(), fh.tell())
+    if not isinstance(fh, (io.BufferedIOBase, io.RawIOBase)):
+        return None
+    try:
+        return (mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ), fh.tell())
+    except (OSError, ValueError):
+        return None
+
+def buffer_components(buf, pos = 0):
+    '''Given a buffer over an ics calendar, yield (depth, name, start,
+    body_end, end) for each VCALENDAR and each of its direct
+    sub-components, as offsets into buf: the component spans buf[start:end],
+    and its own properties buf[start:body_end], up to its first
+    sub-component. Only the BEGIN and END lines are read, and nothing is
+    copied. A VCALENDAR is yielded as soon as its properties end, with end
+    equal to body_end.'''
+    stack = list()
+    first = FIRST_COMPONENT_LINE.match(buf, pos)
+    matches = COMPONENT_LINE.finditer(buf, pos)
+    if first is not None:
+        matches = itertools.chain([first], matches)
+    for m in matches:
+        line_start = m.start(1)
+        if m.group(1).upper() == b"BEGIN":
+            if stack and stack[-1][2] is None:
+                stack[-1][2] = line_start
+                if len(stack) == 1:
+                    yield (1, stack[0][0], stack[0][1], line_start, line_start)
+            stack.append([m.group(2).upper(), line_start, None])
+        elif stack:
+            name, start, body_end = stack.pop()
+            if body_end is None:
+                body_end = line_start
+                if not stack:
+                    yield (1, name, start, body_end, body_end)
+            if len(stack) == 1:
+                # Up to the end of the END line, with its newline.
+                yield (2, name, start, body_end, m.end() + 1)
+
+def buffer_event_values(buf, start, end):
+    '''Return the raw values of the RAW_PROPS of the VEVENT properties in
+    buf[start:end], only copying and unfolding those lines.'''
+    values = dict()
+    for m in RAW_VALUE_LINE.finditer(buf, start, end):
+        name = m.group(1).upper().decode("ascii")
+        if name not in values:
+            line = FOLD.sub(b"", m.group(2)).rstrip(b"\r").decode("UTF-8", "replace")
+            values[name] = raw_value(line)
+    return values
+
+def buffer_text(buf, start, end):
+    '''Return the content lines in buf[start:end] unfolded and decoded.
+    The slices between the folds are joined before decoding, so that
+    multi-byte characters split across folds are rejoined, and the bytes
+    are only copied once.'''
+    parts = list()
+    with memoryview(buf) as view:
+        for m in FOLD.finditer(buf, start, end):
+            parts.append(view[start:m.start()])
+            start = m.end()
+        parts.append(view[start:end])
+        data = b"".join(parts)
+        for part in parts:
+            part.release()
+    return data.decode("UTF-8", "replace")
+
+def walk_ical_buffer(buf, pos = 0, timeframe = None, stats = None, duplicates = None):
+    '''Like walk_ical_stream, over a buffer such as a memory map, from
+    offset pos. The components are found, and the VEVENTs outside the
+    timeframe dropped, from offsets into the buffer: only the VEVENTs that
+    are kept, and the properties of the VCALENDARs, are copied out of it to
+    be parsed, along with the VTIMEZONEs. A memory map is closed once
+    walked.'''
+    try:
+        for depth, name, start, body_end, end in buffer_components(buf, pos):
+            if depth == 1:
+                yield parse_component("Calendar", buffer_text(buf, start, body_end) +
+                                              "END:VCALENDAR\r\n")
+            elif name == b"VEVENT":
+                values = buffer_event_values(buf, start, body_end)
+                if duplicates is not None and not duplicates.keep(values):
+                    if stats is not None:
+                        stats.duplicates += 1
+                elif timeframe is None or values_may_intersect(values, *timeframe):
+                    yield parse_component("Event", buffer_text(buf, start, end))
+                elif stats is not None:
+                    stats.pruned += 1
+            elif name == b"VTIMEZONE":
+                parse_component("Timezone", buffer_text(buf, start, end))
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+def instant_key(dt):
+    '''Return a key identifying an occurrence by its start: the timestamp
+    of a datetime, or the ordinal of a date.'''
+    if isinstance(dt, datetime):
+        return dt.timestamp()
+    return dt.toordinal()
+
+def property_values(comp, prop):
+    '''Return the dates or datetimes of a list property such as EXDATE,
+    which may be given on several lines.'''
+    values = comp.get(prop, [])
+    if not isinstance(values, list):
+        values = [values]
+    return [value.dt for line in values for value in line.dts]
+
+class OverrideIndex:
+    '''Index of the VEVENTs overriding an instance of a recurring event.
+
+    Overrides are mapped by UID, then by the instant key of their
+    RECURRENCE-ID, so that expanding the recurring event can drop the
+    instances they replace (or the ones in its own EXDATE) with a set
+    lookup per occurrence. The overriding VEVENTs are rendered on their
+    own, at their new time.'''
+    def __init__(self, components = ()):
+        self.overrides = dict()
+        for comp in components:
+            self.add(comp)
+
+    def add(self, comp):
+        '''Index comp if it overrides an instance of a recurring event.'''
+        if comp.name != 'VEVENT' or 'UID' not in comp or 'RECURRENCE-ID' not in comp:
+            return
+        key = instant_key(comp['RECURRENCE-ID'].dt)
+        self.overrides.setdefault(str(comp['UID']), dict())[key] = comp
+
+    def excluded(self, comp):
+        '''Return the set of instant keys of the occurrences of a recurring
+        comp that are overridden or excluded, empty if there are none.'''
+        if 'RRULE' not in comp or 'RECURRENCE-ID' in comp:
+            return set()
+        keys = set(instant_key(dt) for dt in property_values(comp, 'EXDATE'))
+        keys.update(self.overrides.get(str(comp.get('UID', '')), ()))
+        return keys
+
+def raw_sequence(value):
+    '''Return a raw SEQUENCE value as an int, 0 if missing or invalid.'''
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+def component_values(comp):
+    '''Return the values of a parsed VEVENT a DuplicateIndex looks at, as
+    event_lines_values would.'''
+    return dict((prop, comp[prop].to_ical().decode("UTF-8"))
+                for prop in ('UID', 'RECURRENCE-ID', 'SEQUENCE') if prop in comp)
+
+class DuplicateIndex:
+    '''Index of the copies of the VEVENTs of calendars converted together.
+
+    The same event, or overridden instance, found in several calendars has
+    the same UID and RECURRENCE-ID. Copies are hashed on those, from their
+    raw values, keeping the highest SEQUENCE. Once every copy is added,
+    keep() only lets the first copy with that SEQUENCE through, before it
+    is parsed, expanded or rendered. Events without a UID are all kept.'''
+    def __init__(self):
+        self.sequences = dict()
+        self.kept = set()
+
+    def add(self, values):
+        '''Add a copy of an event, given its raw values.'''
+        if 'UID' not in values:
+            return
+        key = (values['UID'], values.get('RECURRENCE-ID'))
+        sequence = raw_sequence(values.get('SEQUENCE'))
+        if sequence > self.sequences.get(key, -1):
+            self.sequences[key] = sequence
+
+    def keep(self, values):
+        '''Return True if the copy of an event with these raw values is the
+        one to convert.'''
+        if 'UID' not in values:
+            return True
+        key = (values['UID'], values.get('RECURRENCE-ID'))
+        sequence = raw_sequence(values.get('SEQUENCE'))
+        if key in self.kept or sequence < self.sequences.get(key, sequence):
+            return False
+        self.kept.add(key)
+        return True
+
+def scan_overrides(fh, overrides, duplicates = None):
+    '''Add the VEVENTs of an ics file that have a RECURRENCE-ID to an
+    OverrideIndex, only parsing those, and every VEVENT to the optional
+    DuplicateIndex from its raw lines.'''
+    depth = 0
+    event_lines = None
+    is_override = False
+    for line in unfold_ical_lines(fh):
+        name = RAW_NAME.match(line).group(0).upper()
+        if name == "BEGIN":
+            depth += 1
+            if depth == 2 and raw_value(line).strip().upper() == "VEVENT":
+                event_lines = list()
+                is_override = False
+        elif name == "END":
+            depth -= 1
+            if depth == 1 and event_lines is not None:
+                if duplicates is not None:
+                    duplicates.add(event_lines_values(event_lines))
+                if is_override:
+                    event_lines.append(line)
+                    overrides.add(parse_component("Event", "\r\n".join(event_lines)))
+                event_lines = None
+                continue
+        elif name == "RECURRENCE-ID" and depth == 2:
+            is_override = True
+        if event_lines is not None:
+            event_lines.append(line)
 
-    def set_day_num(self, rrule):
-        """The week may start on a different day for each RRULE, so number the
-        days accordingly.
+def scan_buffer_overrides(buf, pos, overrides, duplicates = None):
+    '''Like scan_overrides, over a buffer from offset pos.'''
+    for depth, name, start, body_end, end in buffer_components(buf, pos):
+        if depth != 2 or name != b"VEVENT":
+            continue
+        if duplicates is not None:
+            duplicates.add(buffer_event_values(buf, start, body_end))
+        if OVERRIDE_LINE.search(buf, start, body_end):
+            overrides.add(parse_component("Event", buffer_text(buf, start, end)))
+
+def skip_excluded(event_iter, excluded, all_day, stats = None, local_tz = None):
+    '''Yield the occurrences of event_iter whose start is not in the
+    excluded set of instant keys.'''
+    for occurrence in event_iter:
+        key = local_ordinal(occurrence.start, local_tz) if all_day else occurrence.start
+        if key in excluded:
+            if stats is not None:
+                stats.excluded += 1
+            continue
+        yield occurrence
+
+def spool_ical(fh):
+    '''Return a copy of the binary file object fh that can be read twice:
+    a BytesIO if it holds at most SPOOL_SIZE bytes, else an anonymous
+    temporary file, so that memory stays bounded.'''
+    data = fh.read(SPOOL_SIZE + 1)
+    if len(data) <= SPOOL_SIZE:
+        return io.BytesIO(data)
+    spool = tempfile.TemporaryFile()
+    spool.write(data)
+    del data
+    shutil.copyfileobj(fh, spool)
+    spool.seek(0)
+    return spool
+
+def walk_ical_sources(fh, timeframe = None, stats = None, deduplicate = False):
+    '''Given a file object over an ics calendar, or a list of them, return
+    (components, overrides): an iterator over their components as
+    walk_ical_stream yields them, and the OverrideIndex of their VEVENTs.
+    When there are several calendars, or with deduplicate, only one copy of
+    the events they share is kept.'''
+    if not isinstance(fh, (list, tuple)):
+        fh = [fh]
+    duplicates = DuplicateIndex() if deduplicate or len(fh) > 1 else None
+    # Overrides may come after the event they override: index them in a
+    # first pass over files, buffering the ones that cannot be read
+    # twice. Other iterables over lines are read once, and only get the
+    # overrides found before the event. Regular files are memory mapped
+    # and walked in place rather than read line by line.
+    overrides = OverrideIndex()
+    sources = list()
+    for f in fh:
+        if hasattr(f, "seekable"):
+            if not f.seekable():
+                f = spool_ical(f)
+            mapped = map_ical(f)
+            if mapped is not None:
+                scan_buffer_overrides(*mapped, overrides, duplicates)
+                sources.append(mapped)
+                continue
+            position = f.tell()
+            scan_overrides(f, overrides, duplicates)
+            f.seek(position)
+        sources.append(f)
+    components = itertools.chain.from_iterable(
+        walk_ical_buffer(*f, timeframe, stats, duplicates) if isinstance(f, tuple)
+        else walk_ical_stream(f, timeframe, stats, duplicates) for f in sources)
+    return (components, overrides)
+
+def parse_ical_sources(ics, stats = None):
+    '''Given an ics calendar, or a list of them, parse them whole and return
+    (components, overrides, duplicates): the list of their components, the
+    OverrideIndex of their VEVENTs and, when there are several calendars,
+    the DuplicateIndex of their VEVENTs, else None.'''
+    if isinstance(ics, (str, bytes)):
+        ics = [ics]
+    components = list()
+    for data in ics:
+        t0 = time.perf_counter()
+        try:
+            cal = parse_component("Calendar", data)
+        except Exception as e:
+            print("ERROR parsing ical file", file=sys.stderr)
+            raise(e)
+        if stats is not None:
+            stats.parse += time.perf_counter() - t0
+        components.extend(cal.walk())
+
+    # Calendars converted together may share events: keep one copy.
+    duplicates = None
+    if len(ics) > 1:
+        duplicates = DuplicateIndex()
+        for comp in components:
+            if comp.name == 'VEVENT':
+                duplicates.add(component_values(comp))
+    return (components, OverrideIndex(components), duplicates)
+
+def read_local_tz():
+    '''Return the timezone named in TIMEZONE_FILE, if it exists, else
+    LOCAL_TZ.'''
+    if os.path.exists(TIMEZONE_FILE):
+        with open(TIMEZONE_FILE, "r") as f:
+            return get_timezone(f.read().strip())
+    return get_timezone(LOCAL_TZ)
+
+class RenderCache:
+    '''On-disk cache of the org text rendered for each component.
+
+    Entries are keyed on UID, RECURRENCE-ID, SEQUENCE, LAST-MODIFIED, the
+    Converter settings and the window rounded out to whole UTC days, and hold
+    the rendered text of every occurrence in that rounded window. Lookups
+    then only filter the occurrences down to the exact window. Once the
+    window moves to another day the key changes, and stale entries are
+    evicted least recently used first when the cache grows past size.
+
+    Several processes, such as batch workers, can share a cache: it is kept
+    in WAL mode, each entry is committed as soon as it is put, and a writer
+    waits up to CACHE_TIMEOUT seconds for the others.'''
+    def __init__(self, path, size = CACHE_SIZE):
+        self.db = sqlite3.connect(os.path.expanduser(path), timeout = CACHE_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache "
+                        "(key TEXT PRIMARY KEY, value TEXT, used INTEGER)")
+        self.size = size
+        self.used = set()
+        self.clock = int(time.time())
+
+    def window(self, start, end):
+        '''Round the [start, end] window out to whole UTC days.'''
+        day = timedelta(days = 1)
+        cache_start = datetime(start.year, start.month, start.day, tzinfo = utc)
+        cache_end = datetime(end.year, end.month, end.day, tzinfo = utc) + day
+        return (cache_start, cache_end)
+
+    def key(self, comp, *args):
+        '''Return the cache key of a component rendered with the given
+        settings, window and participation values, or None if it cannot be
+        cached.'''
+        if comp.name != 'VEVENT' or 'UID' not in comp:
+            return None
+        parts = [comp['UID']]
+        for prop in ('RECURRENCE-ID', 'SEQUENCE', 'LAST-MODIFIED'):
+            if prop in comp:
+                parts.append(comp[prop].to_ical().decode("UTF-8"))
+            else:
+                parts.append("")
+        parts.extend(str(arg) for arg in args)
+        return hashlib.sha1("\x00".join(parts).encode("UTF-8")).hexdigest()
+
+    def get(self, key):
+        '''Return the cached occurrences for key, or None.'''
+        row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.used.add(key)
+        return json.loads(row[0])
+
+    def put(self, key, occurrences):
+        '''Store the occurrences of a component, as a list of (start
+        timestamp, end timestamp, recurring flag, org text) tuples.'''
+        self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                        (key, json.dumps(occurrences), self.clock))
+        self.db.commit()
+
+    def close(self):
+        '''Record the entries used in this run, evict the least recently
+        used ones beyond size and save the cache.'''
+        self.db.executemany("UPDATE cache SET used = ? WHERE key = ?",
+                            [(self.clock, key) for key in self.used])
+        self.db.execute("DELETE FROM cache WHERE key NOT IN "
+                        "(SELECT key FROM cache ORDER BY used DESC LIMIT ?)",
+                        (self.size,))
+        self.db.commit()
+        self.db.close()
+
+class OccurrenceIndex:
+    '''On-disk index of the occurrences of the events of several calendars.
+
+    Each VEVENT is stored once, with its version and the entry_fields its
+    org entry is made of, and each of its occurrences in the index range
+    as a (start, end, recurring) row in UTC seconds, indexed by start.
+    Updating a calendar only expands the events whose version changed:
+    SEQUENCE, LAST-MODIFIED, their excluded instances and your status. The
+    whole index is expanded again when the range moves on, every
+    INDEX_STEP days, or when the timezone changes. Any [start, end] range
+    within the index range can then be rendered without expanding
+    anything.'''
+    def __init__(self, path):
+        self.db = sqlite3.connect(os.path.expanduser(path))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY, calendar TEXT, uid TEXT,
+                recurrence TEXT, version TEXT, fields TEXT,
+                UNIQUE (calendar, uid, recurrence));
+            CREATE INDEX IF NOT EXISTS events_uid ON events (uid);
+            CREATE TABLE IF NOT EXISTS occurrences (
+                event INTEGER, start INTEGER, end INTEGER, recurring INTEGER);
+            CREATE INDEX IF NOT EXISTS occurrences_start ON occurrences (start, end);
+            CREATE INDEX IF NOT EXISTS occurrences_event ON occurrences (event);
+            """)
+        self.meta = dict(self.db.execute("SELECT key, value FROM meta"))
+
+    def set_meta(self, key, value):
+        '''Store a value of the index settings.'''
+        self.meta[key] = str(value)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+    def range(self):
+        '''Return the (start, end) range of the index in UTC seconds, or None
+        if it is empty.'''
+        if 'start' not in self.meta:
+            return None
+        return (int(self.meta['start']), int(self.meta['end']))
+
+    def prepare(self, local_tz):
+        '''Make the index range cover INDEX_WINDOW days around now, in
+        local_tz, dropping every occurrence when they change.'''
+        today = floor(datetime.now(utc).timestamp() / 86400)
+        first = (today - INDEX_WINDOW) // INDEX_STEP * INDEX_STEP
+        start = first * 86400
+        end = (first + 2 * INDEX_WINDOW + INDEX_STEP) * 86400
+        if self.range() != (start, end) or self.meta.get('tz') != str(local_tz):
+            self.db.execute("DELETE FROM occurrences")
+            self.db.execute("UPDATE events SET version = NULL")
+            self.set_meta('start', start)
+            self.set_meta('end', end)
+            self.set_meta('tz', local_tz)
+            self.set_meta('longest', 0)
+        return (datetime.fromtimestamp(start, utc), datetime.fromtimestamp(end, utc))
+
+    def update(self, calendar, fh, converter = None, stats = None):
+        """Index the events of an ics calendar, replacing the ones indexed
+        before under the same calendar name.
 
         Arguments:
-        - rrule -- RRULE line.
+        - calendar -- name of the calendar in the index.
+        - fh -- file object over the ics file.
+        - converter -- Converter whose timezone and identities to use
+          (default: one on the module settings).
+        - stats -- optional ConvertStats to collect timings and counters in.
 
         Returns:
-        - day_num -- dict of day tags to day number.
+        - count -- number of events expanded again.
+
         """
-        # comp['RRULE']['WKST']
-        day_tags = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
-
-        wkst_s = 'MO' #rrule.get('WKST', ['MO'])[0]
-        n = 0
-        for i, tag in enumerate(day_tags):
-            if tag == wkst_s:
-                n = i
+        if converter is None:
+            converter = Converter()
+        local_tz = converter.local_tz
+        start, end = self.prepare(local_tz)
+        # An event is stored once per calendar: keep one copy of the events
+        # given more than once, the one with the highest SEQUENCE.
+        components, overrides = walk_ical_sources(fh, (start, end), stats,
+                                                  deduplicate = True)
+        expand = generate_event_iterator
+        if stats is not None:
+            components = stats.walk(components)
+            expand = stats.expand
+        known = dict(((uid, recurrence), (event_id, version))
+                     for event_id, uid, recurrence, version in self.db.execute(
+                         "SELECT id, uid, recurrence, version FROM events "
+                         "WHERE calendar = ?", (calendar,)))
+        identities = calendar_identities(None, converter.default_attendee,
+                                         converter.identities)
+        longest = int(self.meta['longest'])
+        budget = ExpansionBudget(stats)
+        count = 0
+        seen = set()
+        for comp in components:
+            if comp.name == 'VCALENDAR':
+                identities = calendar_identities(comp, converter.default_attendee,
+                                                 converter.identities)
+                budget = ExpansionBudget(stats)
+            if comp.name != 'VEVENT':
+                continue
+            overrides.add(comp)
+            uid = str(comp.get('UID', '')) or hashlib.sha1(comp.to_ical()).hexdigest()
+            recurrence = comp['RECURRENCE-ID'].to_ical().decode("UTF-8") \
+                if 'RECURRENCE-ID' in comp else ""
+            if (uid, recurrence) in seen:
+                # A copy the DuplicateIndex could not tell apart, such as
+                # the same event twice without a UID.
+                if stats is not None:
+                    stats.duplicates += 1
+                continue
+            seen.add((uid, recurrence))
+            partstats = attendee_partstats(comp, identities)
+            excluded = overrides.excluded(comp)
+            version = "\x00".join(
+                [comp[prop].to_ical().decode("UTF-8") if prop in comp else ""
+                 for prop in ('SEQUENCE', 'LAST-MODIFIED')] +
+                [str(sorted(partstats.items())), str(sorted(excluded))])
+            event_id, old_version = known.pop((uid, recurrence), (None, None))
+            if old_version == version:
+                continue
+            # The row replaced below takes its occurrences with it.
+            self.db.execute("DELETE FROM occurrences WHERE event IN (SELECT id FROM events "
+                            "WHERE calendar = ? AND uid = ? AND recurrence = ?)",
+                            (calendar, uid, recurrence))
+            self.db.execute("INSERT OR REPLACE INTO events (calendar, uid, recurrence, "
+                            "version, fields) VALUES (?, ?, ?, ?, ?)",
+                            (calendar, uid, recurrence, version,
+                             json.dumps(entry_fields(comp, partstats))))
+            event_id = self.db.execute("SELECT last_insert_rowid()").fetchone()[0]
+            truncated = budget.truncated
+            event_iter = expand(comp, start, end, local_tz, budget)
+            if excluded:
+                all_day = not isinstance(comp['DTSTART'].dt, datetime)
+                event_iter = skip_excluded(event_iter, excluded, all_day, stats, local_tz)
+            rows = [(event_id, occurrence.start, occurrence.end, occurrence.recurring)
+                    for occurrence in event_iter]
+            if budget.truncated != truncated:
+                # Cut short by the budget: expand it again next time.
+                self.db.execute("UPDATE events SET version = ? WHERE id = ?",
+                                (version + "\x00truncated", event_id))
+            self.db.executemany("INSERT INTO occurrences VALUES (?, ?, ?, ?)", rows)
+            for _, occ_start, occ_end, _ in rows:
+                longest = max(longest, occ_end - occ_start)
+            count += 1
+        # The events left were removed from the calendar, or now fall out of
+        # the index range.
+        for event_id, _ in known.values():
+            self.db.execute("DELETE FROM occurrences WHERE event = ?", (event_id,))
+            self.db.execute("DELETE FROM events WHERE id = ?", (event_id,))
+        self.set_meta('longest', longest)
+        self.db.commit()
+        return count
+
+    def query(self, start, end, calendars = None):
+        '''Yield (start, end, recurring, event id) for the occurrences in the
+        [start, end] range of UTC seconds, in chronological order, as the
+        event iterators would return them for that window, optionally only
+        for the given calendar names. Raise ValueError if the range is not
+        within the index range.'''
+        index_range = self.range()
+        if index_range is None:
+            raise ValueError("the index is empty")
+        if start < index_range[0] or end > index_range[1]:
+            raise ValueError("the range is outside of the index, from {} to {}".format(
+                datetime.fromtimestamp(index_range[0], utc).date(),
+                datetime.fromtimestamp(index_range[1], utc).date()))
+        sql = ("SELECT start, end, recurring, event FROM occurrences "
+               "WHERE start BETWEEN ? AND ? AND "
+               "(CASE WHEN recurring THEN start >= ? ELSE start < ? AND end > ? END)")
+        args = [start - int(self.meta['longest']), end, start, end, start]
+        if calendars:
+            sql += (" AND event IN (SELECT id FROM events WHERE calendar IN ({}))"
+                    .format(", ".join("?" * len(calendars))))
+            args.extend(calendars)
+        sql += " ORDER BY start, event"
+        return self.db.execute(sql, args)
+
+    def render(self, start, end, calendars = None, converter = None):
+        '''Yield the org text of the occurrences in the [start, end] range of
+        UTC seconds, in chronological order. The settings of converter are
+        used, but for its timezone, which is the one of the index.'''
+        if converter is None:
+            converter = Converter(local_tz = self.meta.get('tz'))
+        elif self.meta.get('tz') not in (None, str(converter.local_tz)):
+            converter = Converter(self.meta['tz'], converter.window, converter.recur_tag,
+                                  converter.template_text, converter.default_attendee,
+                                  converter.identities)
+        entries = dict()
+        for occ_start, occ_end, recurring, event_id in self.query(start, end, calendars):
+            entry = entries.get(event_id)
+            if entry is None:
+                fields, = self.db.execute("SELECT fields FROM events WHERE id = ?",
+                                          (event_id,)).fetchone()
+                entry = entries[event_id] = OrgEntry.from_fields(json.loads(fields),
+                                                                 converter)
+            yield from entry.render(Occurrence(occ_start, occ_end, bool(recurring)))
+
+    def close(self):
+        '''Save and close the index.'''
+        self.db.commit()
+        self.db.close()
+
+class ConvertStats:
+    '''Timings and counters collected while converting a calendar.'''
+    def __init__(self, top = STATS_TOP):
+        self.top = top
+        self.parse = 0.0
+        self.render = 0.0
+        self.iterators = dict()
+        self.components = 0
+        self.occurrences = 0
+        self.skipped = 0
+        self.pruned = 0
+        self.excluded = 0
+        self.duplicates = 0
+        self.truncated = 0
+        self.malformed = 0
+        self.unsupported = 0
+        self.cache_hits = 0
+        self.recurring = list()
+
+    def walk(self, components):
+        '''Yield from components, counting them and timing how long they
+        take to come: for a stream this is the parsing time.'''
+        clock = time.perf_counter
+        components = iter(components)
+        while True:
+            t0 = clock()
+            comp = next(components, None)
+            self.parse += clock() - t0
+            if comp is None:
+                return
+            self.components += 1
+            yield comp
+
+    def expand(self, comp, timeframe_start, timeframe_end, local_tz = None, budget = None):
+        '''Yield the occurrences of generate_event_iterator for comp,
+        timing the iterator under its class name.'''
+        clock = time.perf_counter
+        t0 = clock()
+        event_iter = iter(generate_event_iterator(comp, timeframe_start, timeframe_end,
+                                                  local_tz, budget))
+        elapsed = clock() - t0
+        count = 0
+        while True:
+            t0 = clock()
+            occurrence = next(event_iter, None)
+            elapsed += clock() - t0
+            if occurrence is None:
                 break
+            count += 1
+            yield occurrence
 
-        day_num = dict()
-        for i in range(7):
-            day_num[day_tags[n]] = i
-            n = (n + 1) % 7
-
-        return day_num
-
-
-class EventRecurMonthlyIter:
-    pass
-
-class EventRecurYearlyIter:
-    def __init__(self, comp, timeframe_start, timeframe_end):
-        self.ev_start = get_datetime(comp['DTSTART'].dt)
-        self.ev_end = get_datetime(comp['DTEND'].dt)
-        self.start = timeframe_start
-        self.end = timeframe_end
-        self.is_until = False
-        if 'UNTIL' in comp['RRULE']:
-            self.is_until = True
-            self.end = min(self.end, get_datetime(comp['RRULE']['UNTIL'][0]).astimezone(utc))
-        if self.end < self.start:
-            # Default values for no iteration
-            self.i = 0
-            self.n = 0
-            return
-        if 'BYMONTH' in comp['RRULE']:
-            self.bymonth = comp['RRULE']['BYMONTH'][0]
-        else:
-            self.bymonth = self.ev_start.month
-        if 'BYMONTHDAY' in comp['RRULE']:
-            self.bymonthday = comp['RRULE']['BYMONTHDAY'][0]
-        else:
-            self.bymonthday = self.ev_start.day
-        self.duration = self.ev_end - self.ev_start
-        self.years = range(self.start.year, self.end.year + 1)
-        if 'COUNT' in comp['RRULE']:
-            if self.is_until:
-                raise "UNTIL and COUNT MUST NOT occur in the same 'recur'"
-            self.years = range(self.ev_start.year, self.end.year + 1)
-            del self.years[comp['RRULE']['COUNT'][0]:]
-        self.i = 0
-        self.n = len(self.years)
+        name = type(event_iter).__name__
+        totals = self.iterators.setdefault(name, {"seconds": 0.0, "events": 0, "occurrences": 0})
+        totals["seconds"] += elapsed
+        totals["events"] += 1
+        totals["occurrences"] += count
+        if 'RRULE' in comp:
+            entry = (elapsed, str(comp.get('UID', '')), count)
+            if len(self.recurring) < self.top:
+                heapq.heappush(self.recurring, entry)
+            else:
+                heapq.heappushpop(self.recurring, entry)
 
-    def __iter__(self):
-        return self
+    def as_dict(self):
+        '''Return the stats as a dict ready to be written as JSON.'''
+        return {
+            "parse_seconds": self.parse,
+            "render_seconds": self.render,
+            "iterators": self.iterators,
+            "components": self.components,
+            "occurrences": self.occurrences,
+            "skipped": self.skipped,
+            "pruned": self.pruned,
+            "excluded": self.excluded,
+            "duplicates": self.duplicates,
+            "truncated": self.truncated,
+            "malformed": self.malformed,
+            "unsupported": self.unsupported,
+            "cache_hits": self.cache_hits,
+            "top_recurring": [
+                {"uid": uid, "seconds": elapsed, "occurrences": count}
+                for elapsed, uid, count in sorted(self.recurring, reverse = True)],
+        }
 
-    def __next__(self):
-        if self.i >= self.n: raise StopIteration
-        event_aux = self.ev_start.replace(year = self.years[self.i])
-        event_aux = event_aux.replace(month = self.bymonth)
-        event_aux = event_aux.replace(day = self.bymonthday)
-        self.i = self.i + 1;
-        if event_aux > self.end: raise StopIteration
-        if event_aux < self.start: return self.__next__()
-        return (event_aux, event_aux.tzinfo.normalize(event_aux + self.duration), 1)
-
-def convert_ical(ics):
-    """Convert icalendar export to org-mode.
+def write_stats(stats, path):
+    '''Write stats as JSON to path, or to stderr if path is "-".'''
+    if path == "-":
+        json.dump(stats, sys.stderr, indent = 2)
+        print(file=sys.stderr)
+    else:
+        with open(path, 'w') as fh:
+            json.dump(stats, fh, indent = 2)
+
+def convert_ical(ics, cache = None, stats = None, ordered = False):
+    """Convert icalendar export to org-mode, with a Converter on the module
+    settings.
 
     Arguments:
-    - ics -- the slup'd ics file.
+    - ics -- the slup'd ics file, or a list of them to convert together.
+    - cache -- optional RenderCache to reuse rendered events from.
+    - stats -- optional ConvertStats to collect timings and counters in.
+    - ordered -- emit occurrences in chronological order.
 
     Returns:
     - org -- org-mode text.
 
     """
-    # Set the default timezone based on a file.
-    if os.path.exists(TIMEZONE_FILE):
-        with open(TIMEZONE_FILE, "r") as f:
-            tz = f.read().strip()
-            global LOCAL_TZ
-            LOCAL_TZ = timezone(tz)
+    return Converter().convert_ical(ics, cache, stats, ordered)
+
+def iter_ical(ics, cache = None, stats = None, ordered = False):
+    '''Like convert_ical, yielding the org text as it is rendered.'''
+    return Converter().iter_ical(ics, cache, stats, ordered)
+
+def convert_ical_stream(fh, cache = None, stats = None, ordered = False):
+    '''Convert icalendar export to org-mode, reading one VEVENT at a time,
+    with a Converter on the module settings. See Converter.convert_ical_stream.'''
+    return Converter().convert_ical_stream(fh, cache, stats, ordered)
+
+def iter_ical_stream(fh, cache = None, stats = None, ordered = False):
+    '''Like convert_ical_stream, yielding the org text as it is rendered.'''
+    return Converter().iter_ical_stream(fh, cache, stats, ordered)
+
+def org_entries(buf):
+    '''Split the org text in buf into regions at its headlines, yielding
+    (start, end, drawer) for each, drawer being the match of
+    ENTRY_DRAWER_LINES if the region is an entry written with a drawer,
+    else None.'''
+    starts = [0] + [m.start() + 1 for m in ORG_HEADLINE.finditer(buf)]
+    for start, end in zip(starts, starts[1:] + [len(buf)]):
+        if start == end:
+            continue
+        headline_end = buf.find(b"\n", start, end)
+        drawer = None
+        if headline_end >= 0:
+            drawer = ENTRY_DRAWER_LINES.match(buf, headline_end, end)
+        yield (start, end, drawer)
+
+def generated_end(buf, start, drawer, end):
+    '''Return where the text generated for an entry written with a drawer
+    ends, before any note added under it, or None if it was edited: the
+    first line end after which the text hashes as the drawer says.'''
+    digest = drawer.group(3).decode("ascii")
+    hasher = hashlib.sha1(buf[start:drawer.start() + 1])
+    pos = drawer.end()
+    while True:
+        if hasher.hexdigest()[:len(digest)] == digest:
+            return pos
+        if pos >= end:
+            return None
+        line_end = buf.find(b"\n", pos, end)
+        line_end = end if line_end < 0 else line_end + 1
+        hasher.update(buf[pos:line_end])
+        pos = line_end
+
+def update_org_file(entries, path):
+    """Update an org file holding entries written with drawers, from the
+    entries of a new conversion. The file is memory mapped and its entries
+    are indexed by UID and occurrence start. Entries that did not change,
+    and any other text of the file, are left as they are, and the notes
+    added under an entry are kept when it changes. Entries no longer there
+    are removed, and new ones added at the end.
+
+    When only new entries are added they are appended to the file in place.
+    Any other change writes the whole file again to a temporary file renamed
+    over it, so that a crash never leaves it half written: a single change
+    near the top of a large file costs as much as writing it all.
+
+    A file with org entries, none of them with a drawer, such as the output
+    of a conversion without drawers, raises ValueError rather than get all
+    its entries again.
 
+    Arguments:
+    - entries -- org text of the entries, as rendered by a Converter with
+      drawers, one entry per fragment.
+    - path -- org file to update, created if missing.
+
+    Returns:
+    - counts -- dict of the number of entries added, changed, removed and
+      unchanged, and of bytes written.
+
+    """
+    new = dict()
+    for text in entries:
+        data = text.encode("UTF-8")
+        drawer = ENTRY_DRAWER_LINES.match(data, max(data.find(b"\n"), 0))
+        key = drawer.group(1, 2) if drawer is not None else None
+        new.setdefault(key, list()).append((data, drawer and drawer.group(3)))
+
+    counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0, "written": 0}
     try:
-        cal = ical.Calendar.from_ical(ics)
-    except Exception as e:
-        print("ERROR parsing ical file", file=sys.stderr)
-        raise(e)
+        fh = open(path, 'rb')
+    except FileNotFoundError:
+        fh = contextlib.nullcontext()
+    with fh as fh_r:
+        size = os.fstat(fh_r.fileno()).st_size if fh_r is not None else 0
+        buf = mmap.mmap(fh_r.fileno(), 0, access = mmap.ACCESS_READ) if size else b""
+        try:
+            # Decide what becomes of each region of the file, None meaning
+            # it stays as it is.
+            regions = list()
+            plain = drawn = 0
+            for start, end, drawer in org_entries(buf):
+                replacement = None
+                if drawer is None:
+                    plain += buf[start:start + 1] == b"*"
+                else:
+                    drawn += 1
+                    copies = new.get(drawer.group(1, 2))
+                    if not copies:
+                        replacement = b""
+                        counts["removed"] += 1
+                    else:
+                        data, digest = copies.pop(0)
+                        if digest == drawer.group(3):
+                            counts["unchanged"] += 1
+                        else:
+                            notes_start = generated_end(buf, start, drawer, end)
+                            notes = b"" if notes_start is None else buf[notes_start:end]
+                            replacement = data + notes
+                            counts["changed"] += 1
+                regions.append((start, end, replacement))
+            if plain and not drawn:
+                # Written without drawers: its entries cannot be told apart,
+                # and would all be added again.
+                raise ValueError("{} has org entries not written by --update: "
+                                 "remove it, or move it away, before updating "
+                                 "it".format(path))
+            added = [data for copies in new.values() for data, _ in copies]
+            counts["added"] = len(added)
+
+            if any(replacement is not None for _, _, replacement in regions):
+                out = atomic_output(path, mode = 'wb', keep_mode = True)
+                last = b""
+            elif added:
+                out = open(path, 'ab')
+                regions = list()
+                last = buf[-1:]
+            else:
+                return counts
+            with out as fh_w:
+                for start, end, replacement in regions:
+                    part = buf[start:end] if replacement is None else replacement
+                    fh_w.write(part)
+                    counts["written"] += len(part)
+                    last = part[-1:] or last
+                if added and last not in (b"", b"\n"):
+                    added.insert(0, b"\n")
+                for data in added:
+                    fh_w.write(data)
+                    counts["written"] += len(data)
+        finally:
+            if size:
+                buf.close()
+    return counts
+
+def write_org(fragments, out):
+    '''Write org text fragments to a text file object as they come.'''
+    out.writelines(fragments)
+
+def text_value(comp, prop):
+    '''Return the text of a property of comp, or "". icalendar already
+    unescaped it when parsing.'''
+    if prop not in comp:
+        return ""
+    return str(comp[prop])
+
+class OrgTemplate:
+    '''An org entry layout, compiled once from a str.format template.
+
+    Each line of the template gives one fragment of org text, split further
+    where a field directly follows another one, so that consumers get the
+    text a line at a time. Binding a component renders every fragment but
+    the ones holding the {timestamp}, which are left to fill in for each
+    occurrence.'''
+    def __init__(self, template):
+        self.lines = list()
+        for line in template.splitlines(True):
+            fields = set()
+            fragments = list()
+            current = ""
+            has_timestamp = False
+            for literal, name, spec, conversion in Formatter().parse(line):
+                if name is not None and not literal and current:
+                    fragments.append((current, has_timestamp))
+                    current = ""
+                    has_timestamp = False
+                current += literal.replace("{", "{{").replace("}", "}}")
+                if name is None:
+                    continue
+                if TEMPLATE_FIELD_NAME.match(name).group() not in TEMPLATE_FIELDS:
+                    raise ValueError("unknown org template field: {{{}}}".format(name))
+                fields.add(TEMPLATE_FIELD_NAME.match(name).group())
+                has_timestamp = has_timestamp or name == 'timestamp'
+                current += "{" + name + ("!" + conversion if conversion else "") + \
+                    (":" + spec if spec else "") + "}"
+            fragments.append((current, has_timestamp))
+            self.lines.append((fields, fragments))
+
+    def bind(self, values):
+        '''Given the values of all fields but timestamp, return the list of
+        fragments, holding for each {timestamp} fragment a function taking
+        the timestamp.'''
+        parts = list()
+        for fields, fragments in self.lines:
+            if fields and 'timestamp' not in fields and \
+               not any(values[name] for name in fields):
+                continue
+            for fragment, has_timestamp in fragments:
+                if has_timestamp:
+                    parts.append(functools.partial(fragment.format, **values))
+                else:
+                    parts.append(fragment.format(**values))
+        return parts
+
+ORG_TEMPLATES = dict()
+
+def org_template(template):
+    '''Return the OrgTemplate of a template, compiled once.'''
+    compiled = ORG_TEMPLATES.get(template)
+    if compiled is None:
+        compiled = ORG_TEMPLATES[template] = OrgTemplate(template)
+    return compiled
+
+def normalize_address(address):
+    '''Return a calendar user address case-folded, as mailto:user@host.'''
+    address = str(address).strip().casefold()
+    if address.startswith("mailto:"):
+        address = address[len("mailto:"):]
+    return "mailto:" + address
+
+def calendar_identities(cal, default_attendee = None, identities = None):
+    '''Return the set of normalized addresses of the user in a VCALENDAR:
+    its X-WR-CALNAME if it is an address, else default_attendee (default:
+    DEFAULT_ATTENDEE), and the other identities (default: IDENTITIES).'''
+    attendee = DEFAULT_ATTENDEE if default_attendee is None else default_attendee
+    if identities is None:
+        identities = IDENTITIES
+    if cal is not None and "X-WR-CALNAME" in cal and "@" in cal["X-WR-CALNAME"]:
+        attendee = cal["X-WR-CALNAME"]
+    return frozenset(normalize_address(address) for address in [attendee] + list(identities))
+
+def attendee_partstats(comp, identities):
+    '''Return a dict of the identities found in the ATTENDEE list of comp
+    to their PARTSTAT, looking each attendee up once in the identities
+    set.'''
+    attendees = comp.get('ATTENDEE', [])
+    if not isinstance(attendees, list):
+        attendees = [attendees]
+    partstats = dict()
+    for attendee in attendees:
+        address = normalize_address(attendee)
+        if address in identities:
+            partstats[address] = attendee.params.get('PARTSTAT', 'NEEDS-ACTION').upper()
+    return partstats
+
+def user_partstat(partstats):
+    '''Return the PARTSTAT of the user from the one of each identity: the
+    most engaged of the replies, so that a reply from any identity wins over
+    NEEDS-ACTION from another, or None if the user is not invited.'''
+    if not partstats:
+        return None
+    return max(partstats.values(),
+               key = lambda partstat: PARTSTATS.index(partstat) if partstat in PARTSTATS else 0)
+
+class Partstats(dict):
+    '''The PARTSTAT of each of the user's invited addresses, keyed by the
+    address without mailto:, as the {partstats} template field. Looking up
+    an address that is not invited gives "", and the field alone lists
+    them all.'''
+    def __missing__(self, address):
+        key = normalize_address(address)[len("mailto:"):]
+        return self[key] if key != address and key in self else ""
+
+    def __format__(self, spec):
+        return format(", ".join("{} {}".format(address, partstat)
+                                for address, partstat in sorted(self.items())), spec)
+
+def entry_fields(comp, partstats = None):
+    '''Return what the org entry of comp is made of: its decoded text
+    properties, whether it recurs or lasts whole days, the PARTSTAT of each
+    of the user's invited addresses, as given by attendee_partstats, and
+    the user's own, as a dict of plain values that can be stored.'''
+    partstats = partstats or dict()
+    return {
+        'uid': str(comp.get('UID', '')),
+        'summary': text_value(comp, 'SUMMARY'),
+        'description': text_value(comp, 'DESCRIPTION'),
+        'location': text_value(comp, 'LOCATION'),
+        'recurring': 'RRULE' in comp,
+        'all_day': not isinstance(comp["DTSTART"].dt, datetime),
+        'partstat': user_partstat(partstats),
+        'partstats': dict((address[len("mailto:"):], partstat)
+                          for address, partstat in partstats.items()),
+    }
 
-    org_lines = list()
+class OrgEntry:
+    '''The org text of an event, with its properties decoded and unescaped
+    once, so that rendering an occurrence only fills in its timestamp. The
+    partstats are those of the user's addresses, as given by
+    attendee_partstats, and the layout and timezone are those of converter
+    (default: a Converter on the module settings).'''
+    def __init__(self, comp, partstats = None, converter = None):
+        self.bind(entry_fields(comp, partstats), converter)
 
+    @classmethod
+    def from_fields(cls, fields, converter = None):
+        '''Return the OrgEntry of an event from its entry_fields.'''
+        entry = cls.__new__(cls)
+        entry.bind(fields, converter)
+        return entry
+
+    def bind(self, fields, converter = None):
+        if converter is None:
+            converter = Converter()
+        self.local_tz = converter.local_tz
+        self.drawers = converter.drawers
+        self.uid = fields.get('uid', '')
+        summary = fields['summary']
+        if not len(summary):
+            summary = "(No title)"
+        partstat = fields['partstat']
+        if partstat == 'DECLINED':
+            summary = "Declined: {}".format(summary)
+        location = fields['location']
+        if location.startswith('http'):
+            location = "[[{}]]".format(location)
+        self.all_day = fields['all_day']
+        self.parts = converter.template.bind({
+            'summary': summary,
+            'tags': converter.recur_tag if fields['recurring'] else "",
+            'description': fields['description'],
+            'location': location,
+            'partstat': partstat or "",
+            'partstats': Partstats(fields.get('partstats', ())),
+        })
+
+    def render(self, occurrence):
+        '''Return the org text fragments of an Occurrence.'''
+        if self.all_day:
+            timestamp = "{}--{}".format(orgDate(occurrence.start, 0, self.local_tz),
+                                        orgDate(occurrence.end, -1, self.local_tz))
+        else:
+            timestamp = orgDatetime(occurrence.start, self.local_tz)
+            ev_end = orgDatetime(occurrence.end, self.local_tz)
+            if timestamp != ev_end:
+                timestamp = "{}--{}".format(timestamp, ev_end)
+        parts = [part if isinstance(part, str) else part(timestamp = timestamp)
+                 for part in self.parts]
+        if self.drawers:
+            return [add_entry_drawer(''.join(parts), self.uid, occurrence.start)]
+        return parts
+
+def add_entry_drawer(text, uid, start):
+    '''Return the org text of an entry with a property drawer after its
+    headline, holding the UID of its event, the start of its occurrence in
+    UTC and a hash of the text, by which update_org_file tells entries
+    apart and sees which ones changed.'''
+    digest = hashlib.sha1(text.encode("UTF-8")).hexdigest()[:ENTRY_HASH_LENGTH]
+    start = datetime.fromtimestamp(start, utc).strftime("%Y%m%dT%H%M%SZ")
+    headline_end = text.find("\n") + 1 or len(text)
+    return "{}{}{}".format(text[:headline_end], ENTRY_DRAWER.format(uid, start, digest),
+                           text[headline_end:])
+
+def get_window(window = None):
+    '''Return the (start, end) timeframe of window days (default: WINDOW)
+    around now.'''
+    if window is None:
+        window = WINDOW
     now = datetime.now(utc)
-    start = now - timedelta( days = WINDOW)
-    end = now + timedelta( days = WINDOW)
-
-    # Set default attendee
-    attendee = "mailto:" + DEFAULT_ATTENDEE
-    for comp in cal.walk():
-        if isinstance(comp, ical.Calendar):
-            if "X-WR-CALNAME" in comp:
-                calendar_name = comp["X-WR-CALNAME"]
-                if "@" in calendar_name:
-                    attendee = "mailto:" + calendar_name
-                    # print("Changed attendee to {}".format(attendee), file=sys.stderr)
-
-        # Check the attendee list -- if the attendee has declined
-        # the event then mark it so.
-        is_attending = True
-        if "ATTENDEE" in comp:
-            for event_attendee in comp["ATTENDEE"]:
-                if event_attendee == attendee and \
-                   event_attendee.params['partstat'] == "DECLINED":
-                    is_attending = False
-                    break
+    return (now - timedelta( days = window), now + timedelta( days = window))
+
+class Converter:
+    """Converts calendars to org-mode with settings resolved once.
+
+    A Converter keeps its own timezone, window, tag, template and
+    identities instead of reading the module settings and TIMEZONE_FILE on
+    every call, and does not change once built. One can then be reused for
+    many conversions, and be shared by threads; converters with different
+    settings can run side by side in one process.
+
+    Arguments:
+    - local_tz -- timezone, or its name (default: from TIMEZONE_FILE if it
+      exists, else LOCAL_TZ).
+    - window -- window length in days around now (default: WINDOW).
+    - recur_tag -- tag of recurring events (default: RECUR_TAG).
+    - template -- org entry layout (default: ORG_TEMPLATE).
+    - default_attendee -- address of the user (default: DEFAULT_ATTENDEE).
+    - identities -- other addresses of the user (default: IDENTITIES).
+    - drawers -- give each entry the property drawer of add_entry_drawer,
+      rendering it as a single fragment, so that the output can be kept up
+      to date with update_org_file.
+
+    """
+    def __init__(self, local_tz = None, window = None, recur_tag = None,
+                 template = None, default_attendee = None, identities = None,
+                 drawers = False):
+        if local_tz is None:
+            local_tz = read_local_tz()
+        else:
+            local_tz = get_timezone(local_tz)
+        self.local_tz = local_tz
+        self.window = WINDOW if window is None else window
+        self.recur_tag = RECUR_TAG if recur_tag is None else recur_tag
+        self.template_text = ORG_TEMPLATE if template is None else template
+        self.template = org_template(self.template_text)
+        self.default_attendee = DEFAULT_ATTENDEE if default_attendee is None \
+            else default_attendee
+        self.identities = tuple(IDENTITIES if identities is None else identities)
+        self.drawers = drawers
+        # Build the transition table up front rather than in the threads.
+        tz_table(self.local_tz)
+
+    def get_window(self):
+        '''Return the (start, end) timeframe of the window around now.'''
+        return get_window(self.window)
+
+    def settings_key(self):
+        '''Return the settings that change the rendered text, for the
+        render cache keys.'''
+        return (str(self.local_tz), self.recur_tag, self.template_text, self.drawers)
+
+    def convert_ical(self, ics, cache = None, stats = None, ordered = False):
+        """Convert icalendar export to org-mode.
+
+        Arguments:
+        - ics -- the slup'd ics file, or a list of them to convert together.
+        - cache -- optional RenderCache to reuse rendered events from.
+        - stats -- optional ConvertStats to collect timings and counters in.
+        - ordered -- emit occurrences in chronological order.
+
+        Returns:
+        - org -- org-mode text.
+
+        """
+        return list(self.iter_ical(ics, cache, stats, ordered))
+
+    def iter_ical(self, ics, cache = None, stats = None, ordered = False):
+        """Convert icalendar export to org-mode, yielding the org text as it
+        is rendered. Arguments are as for convert_ical.
+
+        Yields:
+        - org -- org-mode text fragments.
+
+        """
+        components, overrides, duplicates = parse_ical_sources(ics, stats)
+        return self.iter_org(components, cache, stats, ordered = ordered,
+                             overrides = overrides, duplicates = duplicates)
+
+    def convert_ical_stream(self, fh, cache = None, stats = None, ordered = False):
+        """Convert icalendar export to org-mode, reading one VEVENT at a time.
+
+        Arguments:
+        - fh -- file object over the ics file, preferably opened in binary
+          mode, or a list of them to convert together.
+        - cache -- optional RenderCache to reuse rendered events from.
+        - stats -- optional ConvertStats to collect timings and counters in.
+        - ordered -- emit occurrences in chronological order.
+
+        Returns:
+        - org -- org-mode text.
+
+        """
+        return list(self.iter_ical_stream(fh, cache, stats, ordered))
+
+    def iter_ical_stream(self, fh, cache = None, stats = None, ordered = False):
+        """Convert icalendar export to org-mode, reading one VEVENT at a time
+        and yielding the org text as it is rendered. Unless ordered, memory
+        use does not grow with the calendar. Arguments are as for
+        convert_ical_stream.
+
+        Yields:
+        - org -- org-mode text fragments.
+
+        """
+        components, overrides = walk_ical_sources(fh, self.get_window(), stats)
+        return self.iter_org(components, cache, stats, prune = False, ordered = ordered,
+                             overrides = overrides)
+
+    def convert_components(self, components, cache = None, stats = None, prune = True,
+                           ordered = False, overrides = None, duplicates = None):
+        """Render org-mode text for the given icalendar components.
+
+        Arguments:
+        - components -- iterable of components, each VCALENDAR before its own.
+        - cache -- optional RenderCache to reuse rendered events from.
+        - stats -- optional ConvertStats to collect timings and counters in.
+        - prune -- drop events that cannot fall in the window from their raw
+          values, before looking at them any further.
+        - ordered -- emit occurrences in chronological order, merging the
+          events lazily, instead of event by event.
+        - overrides -- OverrideIndex of the events overriding instances of
+          recurring ones (default: index the components, reading them all
+          first).
+        - duplicates -- optional DuplicateIndex of the events, holding every
+          copy of them, to only convert one copy of each.
+
+        Returns:
+        - org -- org-mode text.
+
+        """
+        return list(self.iter_org(components, cache, stats, prune, ordered, overrides,
+                                  duplicates))
+
+    def iter_org(self, components, cache = None, stats = None, prune = True,
+                 ordered = False, overrides = None, duplicates = None):
+        """Render org-mode text for the given icalendar components, yielding
+        it as it is rendered. Arguments are as for convert_components.
+
+        Yields:
+        - org -- org-mode text fragments.
+
+        """
+        if overrides is None:
+            components = list(components)
+            overrides = OverrideIndex(components)
+        streams = self.event_streams(components, cache, stats, prune, overrides,
+                                     duplicates)
+        if ordered:
+            entries = heapq.merge(*streams, key = itemgetter(0))
+        else:
+            entries = itertools.chain.from_iterable(streams)
+        for _, fragments in entries:
+            yield from fragments
+
+    def event_streams(self, components, cache = None, stats = None, prune = True,
+                      overrides = None, duplicates = None):
+        '''Given icalendar components, yield for each VEVENT an iterator over
+        its occurrences in the window as (start timestamp, org fragments), in
+        chronological order. The iterators are lazy and independent of each
+        other, so they can be merged. Arguments are as for
+        convert_components.'''
+        start, end = self.get_window()
+        for comp, _, partstats, excluded, expand, budget in self.window_events(
+                components, stats, prune, overrides, duplicates):
+            key = None
+            if cache is not None:
+                cache_start, cache_end = cache.window(start, end)
+                key = cache.key(comp, *self.settings_key(), cache_start, cache_end,
+                                sorted(partstats.items()), sorted(excluded or ()))
+            if key is None:
+                yield self.render_stream(comp, expand(comp, start, end), partstats, stats)
+            else:
+                yield self.cached_stream(comp, key, cache, expand, (start, end),
+                                         partstats, stats, budget)
+
+    def window_events(self, components, stats = None, prune = True, overrides = None,
+                      duplicates = None):
+        '''Given icalendar components, yield (comp, calendar, partstats,
+        excluded, expand, budget) for each VEVENT that may fall in the
+        window: the X-WR-CALNAME of its calendar, the participation status
+        of each of the user's invited addresses, the instant keys of its
+        excluded occurrences, a function expand(comp, start, end) returning
+        an iterator over its occurrences in the timeframe, without the
+        excluded ones, and the ExpansionBudget of its calendar they are
+        expanded within. Arguments are as for convert_components.'''
+        start, end = self.get_window()
+        local_tz = self.local_tz
+        expand = generate_event_iterator
+        if stats is not None:
+            components = stats.walk(components)
+            expand = stats.expand
+
+        identities = calendar_identities(None, self.default_attendee, self.identities)
+        calendar = ""
+        budget = ExpansionBudget(stats)
+        for comp in components:
+            if comp.name == 'VCALENDAR':
+                identities = calendar_identities(comp, self.default_attendee,
+                                                 self.identities)
+                calendar = str(comp.get('X-WR-CALNAME', ''))
+                budget = ExpansionBudget(stats)
+
+            if comp.name != 'VEVENT':
+                continue
+            if overrides is not None:
+                overrides.add(comp)
+            if duplicates is not None and not duplicates.keep(component_values(comp)):
+                if stats is not None:
+                    stats.duplicates += 1
+                continue
+            if prune and not component_may_intersect(comp, start, end):
+                if stats is not None:
+                    stats.pruned += 1
+                continue
+
+            # Check the attendee list once -- if the user has declined the
+            # event then it gets marked so.
+            partstats = attendee_partstats(comp, identities)
+
+            # Drop the instances overridden by another VEVENT or excluded.
+            # The event is expanded later on: bind its calendar budget now.
+            comp_expand = lambda comp, start, end, budget = budget: \
+                expand(comp, start, end, local_tz, budget)
+            excluded = overrides.excluded(comp) if overrides is not None else None
+            if excluded:
+                all_day = not isinstance(comp['DTSTART'].dt, datetime)
+                comp_expand = lambda comp, start, end, excluded = excluded, all_day = all_day, \
+                    budget = budget: \
+                    skip_excluded(expand(comp, start, end, local_tz, budget), excluded,
+                                  all_day, stats, local_tz)
+            yield (comp, calendar, partstats, excluded, comp_expand, budget)
+
+    def render_stream(self, comp, event_iter, partstats, stats = None):
+        '''Render the occurrences of event_iter, yielding (start timestamp,
+        org fragments) for each.'''
+        count = 0
+        entry = None
+        for occurrence in event_iter:
+            if stats is not None:
+                t0 = time.perf_counter()
+            if entry is None:
+                entry = OrgEntry(comp, partstats, self)
+            fragments = entry.render(occurrence)
+            if stats is not None:
+                stats.render += time.perf_counter() - t0
+            count += 1
+            yield (occurrence.start, fragments)
+        if stats is not None:
+            stats.occurrences += count
+            if not count:
+                stats.skipped += 1
+
+    def cached_stream(self, comp, key, cache, expand, window, partstats, stats = None,
+                      budget = None):
+        '''Like render_stream, taking the rendered occurrences from the cache,
+        after rendering and storing them if missing. An expansion cut short by
+        the ExpansionBudget of the calendar is not stored, and the cached
+        occurrences of a recurring event are charged to the budget as if it
+        had been expanded.'''
+        occurrences = cache.get(key)
+        if occurrences is None:
+            truncated = budget.truncated if budget is not None else 0
+            event_iter = expand(comp, *cache.window(*window))
+            occurrences = list()
+            entry = None
+            for occurrence in event_iter:
+                if stats is not None:
+                    t0 = time.perf_counter()
+                if entry is None:
+                    entry = OrgEntry(comp, partstats, self)
+                text = ''.join(entry.render(occurrence))
+                if stats is not None:
+                    stats.render += time.perf_counter() - t0
+                occurrences.append((occurrence.start, occurrence.end,
+                                    occurrence.recurring, text))
+            if budget is None or budget.truncated == truncated:
+                cache.put(key, occurrences)
+        else:
+            if stats is not None:
+                stats.cache_hits += 1
+            if budget is not None and 'RRULE' in comp:
+                budget.occurrences += len(occurrences)
+
+        # Cached occurrences cover the whole rounded window: keep the ones
+        # the iterators would have returned for the exact window.
+        start_ts = window[0].timestamp()
+        end_ts = window[1].timestamp()
+        count = 0
+        for comp_start, comp_end, rec_event, text in occurrences:
+            if rec_event:
+                if not start_ts <= comp_start <= end_ts:
+                    continue
+            elif not (comp_start < end_ts and comp_end > start_ts):
+                continue
+            count += 1
+            yield (comp_start, [text])
+        if stats is not None:
+            stats.occurrences += count
+            if not count:
+                stats.skipped += 1
+
+def convert_components(components, cache = None, stats = None, prune = True,
+                       ordered = False, overrides = None, duplicates = None):
+    '''Render org-mode text for the given icalendar components, with a
+    Converter on the module settings. See Converter.convert_components.'''
+    return Converter().convert_components(components, cache, stats, prune, ordered,
+                                          overrides, duplicates)
+
+def iter_org(components, cache = None, stats = None, prune = True,
+             ordered = False, overrides = None, duplicates = None):
+    '''Like convert_components, yielding the org text as it is rendered.'''
+    return Converter().iter_org(components, cache, stats, prune, ordered, overrides,
+                                duplicates)
+
+def convert_file(input_path, output_path, stream = True, cache_path = None,
+                 cache_size = CACHE_SIZE, stats = None, ordered = False,
+                 converter = None, update = False):
+    """Convert an ics file into an org file.
+
+    Arguments:
+    - input_path -- the ics file to read.
+    - output_path -- the org file to write.
+    - stream -- read the calendar one event at a time.
+    - cache_path -- optional RenderCache file.
+    - cache_size -- maximum number of events kept in the cache.
+    - stats -- optional ConvertStats to collect timings and counters in.
+    - ordered -- emit occurrences in chronological order.
+    - converter -- Converter to use (default: one on the module settings).
+    - update -- update the org file rather than write it again (see
+      update_org_file).
+
+    """
+    cache = None
+    if cache_path:
+        cache = RenderCache(cache_path, cache_size)
+    try:
+        with open(input_path, 'rb') as fh:
+            convert_to_file(fh, output_path, stream, cache, stats, ordered, converter,
+                            update)
+    finally:
+        if cache is not None:
+            cache.close()
+
+def convert_to_file(fh, output_path, stream = True, cache = None, stats = None,
+                    ordered = False, converter = None, update = False):
+    '''Convert the ics file object fh into the org file output_path. The
+    org text is written next to it and renamed over it once done, so that
+    the output is never seen half written. With update, the org file is
+    instead updated by update_org_file, which needs a converter with
+    drawers. Other arguments are as for convert_file, with cache an
+    open RenderCache.'''
+    if converter is None:
+        converter = Converter(drawers = update)
+    if update and not converter.drawers:
+        raise ValueError("updating an org file needs a Converter with drawers")
+    if update:
+        if stream:
+            fragments = converter.iter_ical_stream(fh, cache, stats, ordered)
+        else:
+            fragments = converter.iter_ical(fh.read(), cache, stats, ordered)
+        update_org_file(fragments, output_path)
+        return
+    with atomic_output(output_path) as fh_w:
+        if stream:
+            fragments = converter.iter_ical_stream(fh, cache, stats, ordered)
+        else:
+            fragments = converter.iter_ical(fh.read(), cache, stats, ordered)
+        write_org(fragments, fh_w)
+
+@contextlib.contextmanager
+def atomic_output(output_path, mode = 'w', keep_mode = False):
+    '''Return a context manager opening a temporary file next to
+    output_path, in text mode unless mode is 'wb', renamed over it once the
+    block completes and removed if it fails, so that the output is never
+    seen half written. With keep_mode, an existing output_path keeps its
+    permissions.'''
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(output_path)),
+                                    prefix = ".ical2org-", suffix = ".tmp")
+    try:
+        with open(fd, mode, encoding = None if 'b' in mode else "UTF-8") as fh_w:
+            yield fh_w
+        if keep_mode and os.path.exists(output_path):
+            os.chmod(tmp_path, os.stat(output_path).st_mode & 0o7777)
+        else:
+            # mkstemp leaves the file private: give it the usual mode.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def convert_file_job(paths, stats = False, **kwargs):
+    '''Run convert_file for an (input, output) pair in a batch worker,
+    returning the error message instead of raising, and the stats as a
+    dict if asked for.'''
+    file_stats = ConvertStats() if stats else None
+    try:
+        convert_file(*paths, stats = file_stats, **kwargs)
+    except Exception as e:
+        return ("{}: {}".format(type(e).__name__, e), None)
+    if file_stats is not None:
+        return (None, dict(file_stats.as_dict(), file = paths[0]))
+    return (None, None)
+
+def convert_files(pairs, jobs = None, stats = None, **kwargs):
+    """Convert many ics files in parallel worker processes. A file that
+    fails to convert does not stop the others.
+
+    Arguments:
+    - pairs -- list of (input path, output path).
+    - jobs -- number of worker processes (default: number of CPUs).
+    - stats -- optional list to append the stats dict of each file to.
+    - kwargs -- passed on to convert_file. A converter is sent along to
+      the workers, which otherwise use the module settings.
+
+    Returns:
+    - errors -- dict of input path to error message for the failed files.
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    errors = dict()
+    job = functools.partial(convert_file_job, stats = stats is not None, **kwargs)
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        for paths, (error, file_stats) in zip(pairs, executor.map(job, pairs)):
+            if error is not None:
+                errors[paths[0]] = error
+            elif stats is not None:
+                stats.append(file_stats)
+    return errors
+
+def shard_name(kind, start, calendar, local_tz = None):
+    '''Return the name of the shard of an occurrence starting at start (UTC
+    seconds): by "month", its local month as YYYY-MM; by "calendar", the
+    name of its calendar, made safe for a file name.'''
+    if kind == "month":
+        return date.fromordinal(local_ordinal(start, local_tz)).strftime("%Y-%m")
+    return SHARD_UNSAFE.sub("_", calendar).strip("._") or "calendar"
+
+def render_shard(path, entries, occurrences, converter = None, ordered = False):
+    '''Render a shard into the org file path in a batch worker, unless the
+    file already holds that text. entries is the list of the entry_fields
+    of its events, and occurrences a list of (start, end, recurring, entry
+    number). Return True if the file was written.'''
+    if ordered:
+        occurrences = sorted(occurrences, key = itemgetter(0))
+    org_entries = [OrgEntry.from_fields(fields, converter) for fields in entries]
+    text = ''.join(fragment for start, end, recurring, i in occurrences
+                   for fragment in org_entries[i].render(Occurrence(start, end, recurring)))
+    try:
+        with open(path, encoding = "UTF-8") as fh:
+            if fh.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with atomic_output(path) as fh_w:
+        fh_w.write(text)
+    return True
+
+def convert_shards(fh, index_path, kind = "month", jobs = None, stream = True,
+                   stats = None, ordered = False, converter = None):
+    """Convert ics files into one org file per shard of their occurrences,
+    by local month or by calendar, rendered in parallel worker processes.
+    The shards are named after index_path, which is written with an
+    #+INCLUDE line for each. Only the shards whose text changed are
+    written again, and the shards of an earlier run that are no longer
+    needed are removed.
+
+    Arguments:
+    - fh -- file object over the ics file, or a list of them.
+    - index_path -- org file including the shards.
+    - kind -- "month" or "calendar" (by X-WR-CALNAME).
+    - jobs -- number of worker processes (default: number of CPUs).
+    - stream -- read the calendars one event at a time.
+    - stats -- optional ConvertStats to collect timings and counters in.
+    - ordered -- emit the occurrences of a shard in chronological order.
+    - converter -- Converter to use (default: one on the module settings).
+
+    Returns:
+    - written -- list of the org files written, shards and index.
+
+    """
+    if converter is None:
+        converter = Converter()
+    if stream:
+        components, overrides = walk_ical_sources(fh, converter.get_window(), stats)
+        duplicates = None
+    else:
+        if not isinstance(fh, (list, tuple)):
+            fh = [fh]
+        components, overrides, duplicates = parse_ical_sources(
+            [f.read() for f in fh], stats)
+
+    # Expand here, and leave the rendering to the workers: a shard holds the
+    # entry_fields of its events and their occurrences.
+    start, end = converter.get_window()
+    shards = dict()
+    for event, (comp, calendar, partstats, _, expand, _) in enumerate(
+            converter.window_events(components, stats, not stream, overrides,
+                                    duplicates)):
+        fields = None
+        count = 0
+        for occurrence in expand(comp, start, end):
+            name = shard_name(kind, occurrence.start, calendar, converter.local_tz)
+            entries, numbers, occurrences = shards.setdefault(name, ([], {}, []))
+            if fields is None:
+                fields = entry_fields(comp, partstats)
+            number = numbers.get(event)
+            if number is None:
+                number = numbers[event] = len(entries)
+                entries.append(fields)
+            occurrences.append((occurrence.start, occurrence.end, occurrence.recurring,
+                                number))
+            count += 1
+        if stats is not None:
+            stats.occurrences += count
+            if not count:
+                stats.skipped += 1
 
-        event_iter = generate_event_iterator(comp, start, end)
-        for comp_start, comp_end, rec_event in event_iter:
-            SUMMARY = ""
-            if "SUMMARY" in comp:
-                SUMMARY = comp['SUMMARY'].to_ical().decode("UTF-8")
-                SUMMARY = SUMMARY.replace('\\,', ',')
-            if not len(SUMMARY):
-                SUMMARY = "(No title)"
-            if not is_attending:
-                SUMMARY = "Declined: {}".format(SUMMARY)
-            org_lines.append("* {}".format(SUMMARY))
-            if rec_event and len(RECUR_TAG):
-                org_lines.append("{}\n".format(RECUR_TAG))
-            org_lines.append("\n")
-            if isinstance(comp["DTSTART"].dt, datetime):
-                ev_start = orgDatetime(comp_start)
-                ev_end = orgDatetime(comp_end)
-                if ev_start != ev_end:
-                    org_lines.append("{}--{}\n".format(ev_start, ev_end))
+    directory = os.path.dirname(os.path.abspath(index_path))
+    stem = os.path.splitext(os.path.basename(index_path))[0]
+    names = sorted(shards)
+    files = ["{}-{}.org".format(stem, name) for name in names]
+    written = list()
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        futures = [executor.submit(render_shard, os.path.join(directory, file_name),
+                                   shards[name][0], shards[name][2], converter, ordered)
+                   for name, file_name in zip(names, files)]
+        for file_name, future in zip(files, futures):
+            if future.result():
+                written.append(os.path.join(directory, file_name))
+
+    index = ''.join('#+INCLUDE: "{}"\n'.format(file_name) for file_name in files)
+    try:
+        with open(index_path, encoding = "UTF-8") as fh_r:
+            old_index = fh_r.read()
+    except FileNotFoundError:
+        old_index = None
+    if index != old_index:
+        for file_name in SHARD_INCLUDE.findall(old_index or ""):
+            if file_name not in files and file_name.startswith(stem + "-") and \
+               os.path.dirname(file_name) == "":
+                try:
+                    os.remove(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    pass
+        with atomic_output(index_path) as fh_w:
+            fh_w.write(index)
+        written.append(index_path)
+    return written
+
+def batch_dir_pairs(src, dest):
+    '''Return the (input, output) pairs converting every .ics file in src
+    into an .org file of the same name in dest.'''
+    os.makedirs(dest, exist_ok = True)
+    pairs = list()
+    for name in sorted(os.listdir(src)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() == ".ics":
+            pairs.append((os.path.join(src, name), os.path.join(dest, stem + ".org")))
+    return pairs
+
+def is_feed_url(path):
+    '''Return True if path is the URL of a calendar feed.'''
+    return path.lower().startswith(FEED_SCHEMES)
+
+class FeedFetcher:
+    '''Fetch calendar feeds concurrently over HTTP(S) with asyncio.
+
+    Connections are kept alive and reused for the next feed from the same
+    host, with at most per_host requests to a host at once. The ETag and
+    Last-Modified validators of each feed are kept in a JSON file at
+    state_path, so that a feed that has not changed since is not downloaded
+    again.'''
+    def __init__(self, state_path = None, per_host = FETCH_PER_HOST,
+                 timeout = FETCH_TIMEOUT):
+        self.state_path = state_path
+        self.state = dict()
+        if state_path and os.path.exists(os.path.expanduser(state_path)):
+            with open(os.path.expanduser(state_path)) as fh:
+                self.state = json.load(fh)
+        self.per_host = per_host
+        self.timeout = timeout
+        self.limits = dict()
+        self.idle = dict()
+
+    async def fetch(self, url, conditional = True):
+        """Fetch a feed, if modified since its validators were committed.
+
+        Arguments:
+        - url -- http, https or webcal URL of the feed.
+        - conditional -- send the saved validators of the feed.
+
+        Returns:
+        - body -- the feed as bytes, or None if not modified.
+        - validators -- dict of the feed validators, to commit once the
+          feed has been converted.
+
+        """
+        saved = self.state.get(url, {}) if conditional else {}
+        headers = dict()
+        if 'etag' in saved:
+            headers['If-None-Match'] = saved['etag']
+        if 'last-modified' in saved:
+            headers['If-Modified-Since'] = saved['last-modified']
+        target = url
+        for _ in range(FETCH_REDIRECTS + 1):
+            status, resp_headers, body = await self.request(target, headers)
+            if status not in (301, 302, 303, 307, 308) or 'location' not in resp_headers:
+                break
+            target = urljoin(target, resp_headers['location'])
+        if status == 304:
+            return (None, saved)
+        if status != 200:
+            raise OSError("HTTP status {} fetching {}".format(status, url))
+        validators = {name: resp_headers[name] for name in ('etag', 'last-modified')
+                      if name in resp_headers}
+        return (body, validators)
+
+    async def fetch_all(self, requests):
+        '''Fetch the (url, conditional) requests concurrently, returning the
+        result of fetch, or the exception raised, for each.'''
+        import asyncio
+        try:
+            return await asyncio.gather(*(self.fetch(url, conditional)
+                                          for url, conditional in requests),
+                                        return_exceptions = True)
+        finally:
+            for connections in self.idle.values():
+                for _, writer in connections:
+                    writer.close()
+            self.idle.clear()
+            self.limits.clear()
+
+    async def request(self, url, headers):
+        '''GET url, reusing an idle connection to its host if there is one.
+        Return the status, the headers (with lowercase names) and the body.'''
+        import asyncio
+        if url.lower().startswith("webcal://"):
+            url = "http://" + url[len("webcal://"):]
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError("cannot fetch {}".format(url))
+        secure = parts.scheme == 'https'
+        port = parts.port or (443 if secure else 80)
+        host = parts.hostname if parts.port is None else parts.netloc.rpartition("@")[2]
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        key = (parts.scheme, parts.hostname, port)
+
+        limit = self.limits.setdefault(key, asyncio.Semaphore(self.per_host))
+        async with limit:
+            idle = self.idle.setdefault(key, [])
+            while True:
+                reused = bool(idle)
+                if reused:
+                    conn = idle.pop()
+                else:
+                    conn = await asyncio.wait_for(asyncio.open_connection(
+                        parts.hostname, port, ssl = True if secure else None), self.timeout)
+                try:
+                    status, resp_headers, body, keep = await asyncio.wait_for(
+                        self.exchange(conn, host, path, headers), self.timeout)
+                except (OSError, EOFError, ValueError):
+                    conn[1].close()
+                    # The host may have closed an idle connection: retry on
+                    # another one.
+                    if reused:
+                        continue
+                    raise
+                if keep:
+                    idle.append(conn)
                 else:
-                    org_lines.append("{}\n".format(ev_start))
-            else:  # all day event
-                org_lines.append("{}--{}\n".format(orgDate(comp_start), orgDate(comp_end - timedelta(days=1))))
+                    conn[1].close()
+                return (status, resp_headers, body)
 
-            org_lines.append("\n")
+    async def exchange(self, conn, host, path, headers):
+        '''Send a GET request over conn and read the response, returning
+        the status, headers, body and whether the connection can be
+        reused.'''
+        reader, writer = conn
+        lines = ["GET {} HTTP/1.1".format(path),
+                 "Host: {}".format(host),
+                 "User-Agent: ical2org",
+                 "Accept-Encoding: gzip",
+                 "Connection: keep-alive"]
+        lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
 
-            if 'DESCRIPTION' in comp:
-                description = '\n'.join(comp['DESCRIPTION'].to_ical().decode("UTF-8").split('\\n'))
-                description = description.replace('\\,', ',')
-                if len(description) > 0:
-                    org_lines.append("- {}\n".format(description))
-            if 'LOCATION' in comp:
-                location = '\n'.join(comp['LOCATION'].to_ical().decode("UTF-8").split('\\n'))
-                location = location.replace('\\,', ',')
-                if location.startswith('http'):
-                    org_lines.append("- [[{}]]\n".format(location))
-                elif len(location) > 0:
-                    org_lines.append("- {}\n".format(location))
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by {}".format(host))
+        version, status = status_line.split(None, 2)[:2]
+        status = int(status)
+        resp_headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            resp_headers[name.strip().lower()] = value.strip()
+
+        keep = version == b"HTTP/1.1" and \
+            resp_headers.get('connection', '').lower() != 'close'
+        if status in (204, 304) or status < 200:
+            body = b""
+        elif 'chunked' in resp_headers.get('transfer-encoding', '').lower():
+            chunks = list()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = b"".join(chunks)
+        elif 'content-length' in resp_headers:
+            body = await reader.readexactly(int(resp_headers['content-length']))
+        else:
+            body = await reader.read()
+            keep = False
+        if resp_headers.get('content-encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return (status, resp_headers, body, keep)
 
-            org_lines.append("\n")
+    def commit(self, url, validators):
+        '''Keep the validators of a feed once it has been converted.'''
+        if validators:
+            self.state[url] = validators
+        else:
+            self.state.pop(url, None)
 
-    return org_lines
+    def save(self):
+        '''Write the validators to state_path, if any.'''
+        if self.state_path:
+            with open(os.path.expanduser(self.state_path), 'w') as fh:
+                json.dump(self.state, fh, indent = 2)
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        fh = sys.stdin
+def written_today(path, local_tz):
+    '''Return True if the file at path was last written on the current
+    day in local_tz, False if it was written before or is missing.'''
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return False
+    return datetime.fromtimestamp(mtime, local_tz).date() == datetime.now(local_tz).date()
+
+def convert_feeds(pairs, state_path = None, per_host = FETCH_PER_HOST,
+                  cache_path = None, cache_size = CACHE_SIZE, stats = None,
+                  **kwargs):
+    """Fetch calendar feeds concurrently and convert them into org files.
+    A feed not modified since its last conversion, and whose org file is
+    still there and was written on the current local day, is neither parsed
+    nor rendered again: once the day changes, the window covers other days.
+    A feed that fails does not stop the others.
+
+    Arguments:
+    - pairs -- list of (feed URL, output path).
+    - state_path -- optional JSON file keeping the feed validators.
+    - per_host -- maximum number of feeds fetched at once from a host.
+    - cache_path -- optional RenderCache file.
+    - cache_size -- maximum number of events kept in the cache.
+    - stats -- optional list to append the stats dict of each feed to.
+    - kwargs -- passed on to convert_to_file.
+
+    Returns:
+    - errors -- dict of feed URL to error message for the failed feeds.
+
+    """
+    import asyncio
+    converter = kwargs.get('converter') or Converter()
+    fetcher = FeedFetcher(state_path, per_host)
+    requests = [(url, written_today(output_path, converter.local_tz))
+                for url, output_path in pairs]
+    results = asyncio.run(fetcher.fetch_all(requests))
+
+    cache = None
+    if cache_path:
+        cache = RenderCache(cache_path, cache_size)
+    errors = dict()
+    try:
+        for (url, output_path), result in zip(pairs, results):
+            if isinstance(result, Exception):
+                errors[url] = "{}: {}".format(type(result).__name__, result)
+                continue
+            body, validators = result
+            if body is None:
+                continue
+            feed_stats = ConvertStats() if stats is not None else None
+            try:
+                convert_to_file(io.BytesIO(body), output_path, cache = cache,
+                                stats = feed_stats, **kwargs)
+            except Exception as e:
+                errors[url] = "{}: {}".format(type(e).__name__, e)
+                continue
+            fetcher.commit(url, validators)
+            if feed_stats is not None:
+                stats.append(dict(feed_stats.as_dict(), file = url))
+    finally:
+        if cache is not None:
+            cache.close()
+        fetcher.save()
+    return errors
+
+def file_digest(path):
+    '''Return the SHA-1 hex digest of the content of a file.'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Watcher:
+    '''Keep the outputs of (input, output) pairs up to date.
+
+    An input is reconverted when its content changes, or when its output
+    is missing. Inputs are only hashed again once their modification time
+    or size changes. Every input is reconverted when the local day changes,
+    as the window then covers other days.'''
+    def __init__(self, pairs, **kwargs):
+        self.pairs = list(pairs)
+        if kwargs.get('converter') is None:
+            kwargs['converter'] = Converter()
+        self.kwargs = kwargs
+        self.local_tz = kwargs['converter'].local_tz
+        self.seen = dict()
+        self.day = None
+
+    def changed(self, path):
+        '''Return True if the content of path changed since last seen.'''
+        st = os.stat(path)
+        old = self.seen.get(path)
+        if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+            return False
+        digest = file_digest(path)
+        self.seen[path] = (st.st_mtime_ns, st.st_size, digest)
+        return old is None or old[2] != digest
+
+    def poll(self):
+        """Convert the inputs that need it.
+
+        Returns:
+        - results -- dict of input path to the (error, stats) returned by
+          convert_file_job, for the inputs converted or failing to be read.
+
+        """
+        day = datetime.now(self.local_tz).date()
+        new_day = day != self.day
+        self.day = day
+        results = dict()
+        for input_path, output_path in self.pairs:
+            try:
+                changed = self.changed(input_path)
+            except OSError as e:
+                results[input_path] = ("{}: {}".format(type(e).__name__, e), None)
+                continue
+            if changed or new_day or not os.path.exists(output_path):
+                results[input_path] = convert_file_job((input_path, output_path),
+                                                       **self.kwargs)
+                if results[input_path][0] is not None:
+                    # Try again on the next poll.
+                    del self.seen[input_path]
+        return results
+
+def watch(pairs, interval = WATCH_INTERVAL, stats_path = None, **kwargs):
+    '''Run a Watcher over pairs every interval seconds until interrupted,
+    reporting errors on stderr and the stats of each conversion to
+    stats_path if given. Other arguments are passed on to convert_file.'''
+    watcher = Watcher(pairs, stats = stats_path is not None, **kwargs)
+    try:
+        while True:
+            stats = list()
+            for path, (error, file_stats) in watcher.poll().items():
+                if error is not None:
+                    print("ERROR converting {}: {}".format(path, error), file=sys.stderr)
+                elif file_stats is not None:
+                    stats.append(file_stats)
+            if stats:
+                write_stats(stats, stats_path)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+def index_main(argv):
+    '''Run the index command: update an OccurrenceIndex with calendars.'''
+    parser = argparse.ArgumentParser(prog = "ical2org.py index",
+                                     description = "Store the occurrences of "
+                                     "calendars in an index, to query them "
+                                     "later with the query command.")
+    parser.add_argument("index", help = "SQLite index file, created if missing")
+    parser.add_argument("calendars", nargs = "+", metavar = "FILE",
+                        help = "ics file to index, under its name without "
+                        "extension; only its changed events are expanded again")
+    parser.add_argument("--identity", action = "append", default = [],
+                        metavar = "ADDRESS",
+                        help = "another address of yours; may be repeated")
+    args = parser.parse_args(argv)
+
+    converter = Converter(identities = IDENTITIES + args.identity)
+    index = OccurrenceIndex(args.index)
+    try:
+        for path in args.calendars:
+            name = os.path.splitext(os.path.basename(path))[0]
+            with open(path, 'rb') as fh:
+                index.update(name, fh, converter)
+    finally:
+        index.close()
+    return 0
+
+def query_main(argv):
+    '''Run the query command: render a range of days from an
+    OccurrenceIndex.'''
+    parser = argparse.ArgumentParser(prog = "ical2org.py query",
+                                     description = "Convert the occurrences "
+                                     "of a range of days from an index to "
+                                     "org-mode.")
+    parser.add_argument("index", help = "SQLite index file")
+    parser.add_argument("start", type = date.fromisoformat, metavar = "FROM",
+                        help = "first day, as YYYY-MM-DD")
+    parser.add_argument("end", type = date.fromisoformat, metavar = "TO",
+                        help = "last day, as YYYY-MM-DD")
+    parser.add_argument("--calendar", action = "append", default = [],
+                        metavar = "NAME",
+                        help = "only convert this calendar; may be repeated")
+    parser.add_argument("-o", "--output", metavar = "FILE",
+                        help = "org file to write (default: stdout)")
+    parser.add_argument("--template", metavar = "FILE",
+                        help = "layout of the org entries (see --template)")
+    args = parser.parse_args(argv)
+
+    index = OccurrenceIndex(args.index)
+    template = None
+    if args.template:
+        with open(args.template, encoding = "UTF-8") as fh:
+            template = fh.read()
+    try:
+        converter = Converter(local_tz = index.meta.get('tz'), template = template)
+    except ValueError as e:
+        parser.error("bad --template: {}".format(e))
+    start = get_datetime(args.start, converter.local_tz).timestamp()
+    end = get_datetime(args.end + timedelta( days = 1), converter.local_tz).timestamp()
+
+    try:
+        fragments = list(index.render(start, end, args.calendar, converter))
+    except ValueError as e:
+        print("ERROR querying {}: {}".format(args.index, e), file=sys.stderr)
+        return 1
+    finally:
+        index.close()
+    if args.output is not None:
+        with open(args.output, 'w', encoding = "UTF-8") as fh_w:
+            write_org(fragments, fh_w)
     else:
-        fh = open(sys.argv[1],'rb')
+        write_org(fragments, sys.stdout)
+        sys.stdout.flush()
+    return 0
+
+# Commands run instead of the conversion when given as first argument.
+COMMANDS = {"index": index_main, "query": query_main}
+
+def main(argv = None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    parser = argparse.ArgumentParser(description = "Convert ical to org-mode.")
+    parser.add_argument("input", nargs = "?",
+                        help = "ics file to read (default: stdin)")
+    parser.add_argument("output", nargs = "?",
+                        help = "org file to write (default: stdout)")
+    parser.add_argument("--no-stream", dest = "stream", action = "store_false",
+                        help = "parse the whole calendar with icalendar "
+                        "before converting, instead of one event at a time")
+    parser.add_argument("--cache", metavar = "FILE",
+                        help = "reuse the org text of unchanged events from "
+                        "this cache file, updating it")
+    parser.add_argument("--cache-size", type = int, default = CACHE_SIZE,
+                        help = "maximum number of events kept in the cache "
+                        "(default: %(default)s)")
+    parser.add_argument("--batch", nargs = 2, action = "append", default = [],
+                        metavar = ("INPUT", "OUTPUT"),
+                        help = "convert INPUT into OUTPUT in a worker process; "
+                        "may be repeated")
+    parser.add_argument("--batch-dir", nargs = 2, metavar = ("SRC", "DEST"),
+                        help = "convert every .ics file in SRC into an .org "
+                        "file in DEST in worker processes")
+    parser.add_argument("-j", "--jobs", type = int,
+                        help = "number of batch worker processes "
+                        "(default: number of CPUs)")
+    parser.add_argument("--stats", action = "store_const", const = "-",
+                        help = "write timings and counters as JSON to stderr")
+    parser.add_argument("--stats-file", dest = "stats", metavar = "FILE",
+                        help = "write timings and counters as JSON to FILE")
+    parser.add_argument("--ordered", action = "store_true",
+                        help = "emit occurrences in chronological order")
+    parser.add_argument("--merge", action = "append", default = [],
+                        metavar = "FILE",
+                        help = "also convert the ics FILE into the same output; "
+                        "may be repeated")
+    parser.add_argument("--feed", nargs = 2, action = "append", default = [],
+                        metavar = ("URL", "OUTPUT"),
+                        help = "fetch the calendar at URL and convert it into "
+                        "OUTPUT, unless not modified; may be repeated, the "
+                        "feeds are fetched concurrently")
+    parser.add_argument("--feed-state", metavar = "FILE",
+                        help = "keep the ETag and Last-Modified of the feeds in "
+                        "FILE, to only fetch them again once modified")
+    parser.add_argument("--per-host", type = int, default = FETCH_PER_HOST,
+                        help = "maximum number of feeds fetched at once from a "
+                        "host (default: %(default)s)")
+    parser.add_argument("--template", metavar = "FILE",
+                        help = "layout of the org entries, as a Python format "
+                        "string with the fields {summary}, {tags}, {timestamp}, "
+                        "{description}, {location}, {partstat} (your status) "
+                        "and {partstats} (the status of each of your "
+                        "addresses, or {partstats[ADDRESS]} of one)")
+    parser.add_argument("--identity", action = "append", default = [],
+                        metavar = "ADDRESS",
+                        help = "another address of yours, such as an alias or "
+                        "a delegate, to read your participation status from; "
+                        "may be repeated")
+    parser.add_argument("--watch", action = "store_true",
+                        help = "keep running, reconverting the input files "
+                        "when they change and every day")
+    parser.add_argument("--interval", type = float, default = WATCH_INTERVAL,
+                        help = "seconds between two checks of the input files "
+                        "with --watch (default: %(default)s)")
+    parser.add_argument("--shard", choices = SHARD_KINDS,
+                        help = "write one org file per month, or per calendar, "
+                        "named after the output file, which includes them; "
+                        "the files are rendered in worker processes and only "
+                        "written when changed")
+    parser.add_argument("--update", action = "store_true",
+                        help = "update the org files, only changing "
+                        "the entries of the events that changed and keeping "
+                        "your notes under entries")
+    args = parser.parse_args(argv)
+
+    template = None
+    if args.template:
+        with open(args.template, encoding = "UTF-8") as fh:
+            template = fh.read()
+    try:
+        converter = Converter(template = template,
+                              identities = IDENTITIES + args.identity,
+                              drawers = args.update)
+    except ValueError as e:
+        parser.error("bad --template: {}".format(e))
+
+    if args.shard:
+        if args.output is None:
+            parser.error("--shard needs an output file")
+        if args.watch or args.feed or args.batch or args.batch_dir or \
+           args.update or args.cache:
+            parser.error("--shard cannot be given with --watch, --feed, --batch, "
+                         "--update or --cache")
+
+    if args.watch:
+        if args.feed or (args.input is not None and is_feed_url(args.input)):
+            parser.error("--watch only watches local files")
+        pairs = list(args.batch)
+        if args.batch_dir:
+            pairs.extend(batch_dir_pairs(*args.batch_dir))
+        if args.input is not None:
+            if args.output is None or args.merge:
+                parser.error("--watch needs both input and output files, "
+                             "and no --merge")
+            pairs.append((args.input, args.output))
+        if not pairs:
+            parser.error("--watch needs input and output files")
+        watch(pairs, args.interval, args.stats, stream = args.stream,
+              cache_path = args.cache, cache_size = args.cache_size,
+              ordered = args.ordered, converter = converter, update = args.update)
+        return 0
 
-    if len(sys.argv) > 2:
-        fh_w = open(sys.argv[2],'wb')
+    if args.input is not None and is_feed_url(args.input) and \
+       args.output is not None and not args.merge:
+        args.feed.append((args.input, args.output))
+        args.input = args.output = None
+    if args.feed:
+        if args.input is not None or args.batch or args.batch_dir:
+            parser.error("input files and --batch cannot be given with --feed")
+        stats = list() if args.stats else None
+        errors = convert_feeds(args.feed, args.feed_state, args.per_host,
+                               cache_path = args.cache,
+                               cache_size = args.cache_size, stats = stats,
+                               stream = args.stream, ordered = args.ordered,
+                               converter = converter, update = args.update)
+        for url, error in errors.items():
+            print("ERROR converting {}: {}".format(url, error), file=sys.stderr)
+        if stats is not None:
+            write_stats(stats, args.stats)
+        return 1 if errors else 0
+
+    if args.batch or args.batch_dir:
+        if args.input is not None:
+            parser.error("input and output files cannot be given with --batch")
+        pairs = list(args.batch)
+        if args.batch_dir:
+            pairs.extend(batch_dir_pairs(*args.batch_dir))
+        stats = list() if args.stats else None
+        errors = convert_files(pairs, args.jobs, stats, stream = args.stream,
+                               cache_path = args.cache,
+                               cache_size = args.cache_size,
+                               ordered = args.ordered, converter = converter,
+                               update = args.update)
+        for path, error in errors.items():
+            print("ERROR converting {}: {}".format(path, error), file=sys.stderr)
+        if stats is not None:
+            write_stats(stats, args.stats)
+        return 1 if errors else 0
+
+    if args.update and args.output is None:
+        parser.error("--update needs an output file")
+    if args.input is None:
+        fh = sys.stdin.buffer
+    elif is_feed_url(args.input):
+        import asyncio
+        fetcher = FeedFetcher(per_host = args.per_host)
+        result, = asyncio.run(fetcher.fetch_all([(args.input, False)]))
+        if isinstance(result, Exception):
+            print("ERROR fetching {}: {}".format(args.input, result), file=sys.stderr)
+            return 1
+        fh = io.BytesIO(result[0])
     else:
-        fh_w = sys.stdout
+        fh = open(args.input,'rb')
+
+    stats = ConvertStats() if args.stats else None
 
-    org_lines = convert_ical(fh.read())
+    if args.merge:
+        fh = [fh] + [open(path, 'rb') for path in args.merge]
 
-    fh_w.write(''.join(org_lines))
+    if args.shard:
+        convert_shards(fh, args.output, args.shard, args.jobs, args.stream, stats,
+                       args.ordered, converter)
+        if stats is not None:
+            write_stats(dict(stats.as_dict(), file = args.input or "-"), args.stats)
+        return 0
+
+    cache = None
+    if args.cache:
+        cache = RenderCache(args.cache, args.cache_size)
+
+    if args.stream:
+        fragments = converter.iter_ical_stream(fh, cache, stats, args.ordered)
+    elif args.merge:
+        fragments = converter.iter_ical([f.read() for f in fh], cache, stats,
+                                        args.ordered)
+    else:
+        fragments = converter.iter_ical(fh.read(), cache, stats, args.ordered)
 
-    exit(0)
+    if args.update:
+        update_org_file(fragments, args.output)
+    elif args.output is not None:
+        # Leave the previous org file alone if the conversion fails.
+        with atomic_output(args.output) as fh_w:
+            write_org(fragments, fh_w)
+    else:
+        write_org(fragments, sys.stdout)
+        sys.stdout.flush()
+
+    if cache is not None:
+        cache.close()
+    if stats is not None:
+        write_stats(dict(stats.as_dict(), file = args.input or "-"), args.stats)
+
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,228 @@
+"""Benchmarks for ical2org on synthetic calendars.
+
+Run from the top of the repository, for instance:
+
+    python -m test.bench_ical2org --events 5000 --windows 30,90,365 -o bench.json
+
+Parsing, recurrence expansion and rendering are timed separately for each
+window size, and the results are written as JSON.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import io
+import json
+import platform
+import random
+import sys
+import time
+
+import icalendar as ical
+from pytz import utc
+
+import ical2org
+
+# Relative weight of each kind of event in the generated calendars.
+DEFAULT_MIX = {
+    "single": 40,
+    "daily": 5,
+    "weekly_byday": 15,
+    "weekly_count": 5,
+    "weekly_until": 5,
+    "yearly": 5,
+    "allday": 10,
+    "attendees": 10,
+    "long_description": 5,
+}
+
+CALENDAR_HEADER = """\
+BEGIN:VCALENDAR
+PRODID:-//ical2org//bench//EN
+VERSION:2.0
+CALSCALE:GREGORIAN
+METHOD:PUBLISH
+X-WR-CALNAME:bench@example.com
+X-WR-TIMEZONE:America/Los_Angeles
+"""
+
+TZIDS = ["America/Los_Angeles", "America/New_York", "Europe/Paris", "UTC"]
+
+def ical_time(dt):
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+def generate_event(kind, i, now, rng):
+    '''Return the lines of a synthetic VEVENT of the given kind.'''
+    start = now + timedelta(days = rng.randint(-1500, 400),
+                            hours = rng.randint(7, 19))
+    start = start.replace(minute = rng.choice([0, 15, 30, 45]), second = 0,
+                          microsecond = 0)
+    tzid = rng.choice(TZIDS)
+    duration = timedelta(minutes = rng.choice([15, 30, 60, 90]))
+    lines = ["BEGIN:VEVENT",
+             "UID:bench-{}-{}@example.com".format(kind, i),
+             "SEQUENCE:0",
+             "LAST-MODIFIED:20200101T000000Z",
+             "SUMMARY:{} event {}".format(kind, i)]
+    if kind == "allday":
+        lines.append("DTSTART;VALUE=DATE:{:%Y%m%d}".format(start))
+        lines.append("DTEND;VALUE=DATE:{:%Y%m%d}".format(start + timedelta(days = 1)))
+    else:
+        lines.append("DTSTART;TZID={}:{}".format(tzid, ical_time(start)))
+        lines.append("DTEND;TZID={}:{}".format(tzid, ical_time(start + duration)))
+
+    if kind == "daily":
+        lines.append("RRULE:FREQ=DAILY;INTERVAL={}".format(rng.choice([1, 1, 2, 3])))
+    elif kind == "weekly_byday":
+        days = sorted(rng.sample(range(7), rng.randint(1, 5)))
+        lines.append("RRULE:FREQ=WEEKLY;BYDAY={}".format(
+            ",".join(ical2org.DAY_TAGS[day] for day in days)))
+    elif kind == "weekly_count":
+        lines.append("RRULE:FREQ=WEEKLY;COUNT={}".format(rng.randint(5, 300)))
+    elif kind == "weekly_until":
+        until = start + timedelta(days = rng.randint(30, 2000))
+        lines.append("RRULE:FREQ=WEEKLY;INTERVAL={};UNTIL={:%Y%m%dT%H%M%SZ}".format(
+            rng.choice([1, 2]), until.astimezone(utc)))
+    elif kind == "yearly":
+        lines.append("RRULE:FREQ=YEARLY")
+    elif kind == "attendees":
+        for j in range(rng.randint(20, 300)):
+            lines.append("ATTENDEE;CN=Person {j};PARTSTAT=ACCEPTED:"
+                         "mailto:person{j}@example.com".format(j = j))
+        lines.append("ATTENDEE;PARTSTAT=DECLINED:mailto:bench@example.com")
+    elif kind == "long_description":
+        words = ["lorem", "ipsum", "dolor", "sit", "amet,", "agenda\\n", "notes\\,"]
+        lines.append("DESCRIPTION:" + " ".join(rng.choice(words) for _ in range(600)))
+        lines.append("LOCATION:https://example.com/meeting/{}".format(i))
+    lines.append("END:VEVENT")
+    return lines
+
+def generate_calendar(events, mix = DEFAULT_MIX, seed = 0, now = None):
+    """Generate a synthetic calendar.
+
+    Arguments:
+    - events -- number of VEVENTs.
+    - mix -- dict of event kind to relative weight.
+    - seed -- random seed, the same seed gives the same calendar.
+    - now -- datetime the events are spread around (default: now).
+
+    Returns:
+    - ics -- the calendar as bytes, with folded lines.
+
+    """
+    rng = random.Random(seed)
+    if now is None:
+        now = datetime.now(utc)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    lines = CALENDAR_HEADER.splitlines()
+    for i in range(events):
+        lines.extend(generate_event(rng.choices(kinds, weights)[0], i, now, rng))
+    lines.append("END:VCALENDAR")
+
+    out = io.BytesIO()
+    for line in lines:
+        data = line.encode("UTF-8")
+        out.write(data[:75])
+        for k in range(75, len(data), 74):
+            out.write(b"\r\n " + data[k:k + 74])
+        out.write(b"\r\n")
+    return out.getvalue()
+
+def best_of(repeat, func):
+    '''Run func repeat times, returning the best time and the last result.'''
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def run(events, windows, mix = DEFAULT_MIX, seed = 0, repeat = 3):
+    """Time parsing, expansion and rendering of a synthetic calendar.
+
+    Returns:
+    - results -- dict ready to be written as JSON.
+
+    """
+    ics = generate_calendar(events, mix, seed)
+    results = {
+        "python": platform.python_version(),
+        "events": events,
+        "bytes": len(ics),
+        "mix": mix,
+        "seed": seed,
+        "repeat": repeat,
+        "parse": {},
+        "windows": [],
+    }
+    results["parse"]["from_ical"], cal = best_of(
+        repeat, lambda: ical.Calendar.from_ical(ics))
+    results["parse"]["stream"], components = best_of(
+        repeat, lambda: list(ical2org.walk_ical_stream(io.BytesIO(ics))))
+
+    for window in windows:
+        # Expand and render as the conversion does, one OrgEntry per event.
+        converter = ical2org.Converter(window = window)
+        start, end = converter.get_window()
+
+        def expand():
+            return [(comp, partstats, list(expand_event(comp, start, end)))
+                    for comp, _, partstats, _, expand_event, _
+                    in converter.window_events(components)]
+
+        def render():
+            return [fragments
+                    for comp, partstats, event_occurrences in events
+                    for _, fragments in converter.render_stream(
+                        comp, iter(event_occurrences), partstats)]
+
+        expand_time, events = best_of(repeat, expand)
+        render_time, _ = best_of(repeat, render)
+        results["windows"].append({
+            "window": window,
+            "occurrences": sum(len(occurrences) for _, _, occurrences in events),
+            "expand": expand_time,
+            "render": render_time,
+        })
+    return results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark ical2org.")
+    parser.add_argument("--events", type = int, default = 2000,
+                        help = "number of events (default: %(default)s)")
+    parser.add_argument("--windows", default = "30,90,365",
+                        help = "comma separated window sizes in days "
+                        "(default: %(default)s)")
+    parser.add_argument("--mix", action = "append", default = [],
+                        metavar = "KIND=WEIGHT",
+                        help = "weight of an event kind, one of: {}".format(
+                            ", ".join(DEFAULT_MIX)))
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "keep the best of this many runs "
+                        "(default: %(default)s)")
+    parser.add_argument("-o", "--output",
+                        help = "JSON file to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    mix = dict(DEFAULT_MIX)
+    for item in args.mix:
+        kind, _, weight = item.partition("=")
+        if kind not in DEFAULT_MIX:
+            parser.error("unknown event kind: {}".format(kind))
+        mix[kind] = float(weight)
+    windows = [int(window) for window in args.windows.split(",")]
+
+    results = run(args.events, windows, mix, args.seed, args.repeat)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent = 2)
+    else:
+        json.dump(results, sys.stdout, indent = 2)
+        print()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,16 @@
 import datetime
+import http.server
+import io
+import itertools
+import os
 from freezegun import freeze_time
+import icalendar
 import pytz
 import sys
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
 try:
     import ical2org
@@ -337,3 +345,1298 @@ END:VALARM
         org_lines = ical2org.convert_ical(ics_string)
 
         self.assertEqual(org_lines[4].strip(), "- 1700 Stadium Way, Los Angeles, CA 90017")
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_stream_matches_full_parse(self):
+        """Converting one event at a time from a file gives the same output
+        as parsing the whole calendar.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/New_York:20200513T130000
+DTEND;TZID=America/New_York:20200513T140000
+RRULE:FREQ=WEEKLY;WKST=SU;UNTIL=20201008T035959Z;INTERVAL=2;BYDAY=WE
+UID:3v0tb4ra2fnk8cusgif78bu23n@google.com
+DESCRIPTION:Meeting number (access code): 909 070 777<br>Join by phone\\, or
+  by video
+LOCATION:Caf\xc3\xa9 Central
+SUMMARY:NASANavo Python WG
+BEGIN:VALARM
+ACTION:DISPLAY
+DESCRIPTION:This is an event reminder
+TRIGGER:-P0DT0H5M0S
+END:VALARM
+""")
+        ics_bytes = ics_string.encode("latin-1").replace(b"\n", b"\r\n")
+
+        org_lines = ical2org.convert_ical_stream(io.BytesIO(ics_bytes))
+
+        self.assertEqual(org_lines, ical2org.convert_ical(ics_bytes))
+        self.assertEqual(org_lines[4].strip(),
+                         "- Meeting number (access code): 909 070 777<br>Join by phone, or by video")
+        self.assertEqual(org_lines[5].strip(), "- Café Central")
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_stream_custom_timezone(self):
+        """A TZID defined only by a VTIMEZONE of the calendar, as in Outlook
+        exports, is known before the events are parsed when streaming.
+        """
+        ics_bytes = b"""\
+BEGIN:VCALENDAR
+PRODID:-//Microsoft Corporation//Outlook 16.0 MIMEDIR//EN
+VERSION:2.0
+BEGIN:VTIMEZONE
+TZID:Customized Time Zone
+BEGIN:STANDARD
+DTSTART:16011104T020000
+RRULE:FREQ=YEARLY;BYDAY=1SU;BYMONTH=11
+TZOFFSETFROM:-0600
+TZOFFSETTO:-0700
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:16010311T020000
+RRULE:FREQ=YEARLY;BYDAY=2SU;BYMONTH=3
+TZOFFSETFROM:-0700
+TZOFFSETTO:-0600
+END:DAYLIGHT
+END:VTIMEZONE
+BEGIN:VEVENT
+DTSTART;TZID="Customized Time Zone":20200513T020000
+DTEND;TZID="Customized Time Zone":20200513T030000
+UID:outlook@example.com
+SUMMARY:Outlook
+END:VEVENT
+END:VCALENDAR
+""".replace(b"\n", b"\r\n")
+        expected = "<2020-05-13 Wed 01:00>--<2020-05-13 Wed 02:00>\n"
+        for convert in (ical2org.convert_ical,
+                        lambda ics: ical2org.convert_ical_stream(io.BytesIO(ics)),
+                        lambda ics: ical2org.convert_ical_stream(iter(ics.splitlines(True)))):
+            # icalendar keeps the timezones it has read: forget them.
+            with mock.patch.dict(icalendar.cal._timezone_cache, clear = True):
+                self.assertIn(expected, convert(ics_bytes))
+
+    def test_unfold_split_multibyte(self):
+        """Folding may split a multi-byte UTF-8 character; it is rejoined
+        before decoding.
+        """
+        lines = list(ical2org.unfold_ical_lines(io.BytesIO(
+            b"SUMMARY:Caf\xc3\r\n \xa9\r\n\t Central\r\nUID:1\r\n")))
+
+        self.assertEqual(lines, ["SUMMARY:Café Central", "UID:1"])
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_rrule_byday_count_before_window(self):
+        """COUNT is applied from DTSTART even when the series starts before
+        the window.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200101T090000
+DTEND;TZID=America/Los_Angeles:20200101T100000
+RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=40
+SUMMARY:Standup
+""")
+
+        org_lines = ical2org.convert_ical(ics_string)
+        stamps = [line.strip() for line in org_lines if line.startswith("<")]
+
+        self.assertEqual(len(stamps), 28)
+        self.assertEqual(stamps[0], "<2020-02-12 Wed 09:00>--<2020-02-12 Wed 10:00>")
+        self.assertEqual(stamps[1], "<2020-02-17 Mon 09:00>--<2020-02-17 Mon 10:00>")
+        self.assertEqual(stamps[-1], "<2020-05-18 Mon 09:00>--<2020-05-18 Mon 10:00>")
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_rrule_daily_interval(self):
+        """Daily events repeat every INTERVAL days.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200101T090000
+DTEND;TZID=America/Los_Angeles:20200101T100000
+RRULE:FREQ=DAILY;INTERVAL=3;COUNT=60
+SUMMARY:Watering
+""")
+
+        org_lines = ical2org.convert_ical(ics_string)
+        stamps = [line.strip() for line in org_lines if line.startswith("<")]
+
+        self.assertEqual(len(stamps), 46)
+        self.assertEqual(stamps[0], "<2020-02-12 Wed 09:00>--<2020-02-12 Wed 10:00>")
+        self.assertEqual(stamps[1], "<2020-02-15 Sat 09:00>--<2020-02-15 Sat 10:00>")
+        self.assertEqual(stamps[-1], "<2020-06-26 Fri 09:00>--<2020-06-26 Fri 10:00>")
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_render_cache(self):
+        """Unchanged events are rendered from the cache; a new SEQUENCE
+        renders them again.
+        """
+        event = """\
+DTSTART;TZID=America/Los_Angeles:20200101T090000
+DTEND;TZID=America/Los_Angeles:20200101T100000
+RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=40
+UID:standup@example.com
+SEQUENCE:{sequence}
+SUMMARY:{summary}
+"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            first = ical2org.convert_ical(self.ics_string_tpl.format(
+                event = event.format(sequence = 0, summary = "Standup")))
+
+            for summary, sequence, expected in (("Standup", 0, "Standup"),
+                                                ("Renamed", 0, "Standup"),
+                                                ("Renamed", 1, "Renamed")):
+                cache = ical2org.RenderCache(path)
+                org_lines = ical2org.convert_ical(self.ics_string_tpl.format(
+                    event = event.format(sequence = sequence, summary = summary)), cache)
+                cache.close()
+                self.assertEqual(''.join(org_lines),
+                                 ''.join(first).replace("Standup", expected))
+
+            with freeze_time("2020-05-12 18:00:00"):
+                cache = ical2org.RenderCache(path)
+                org_lines = ical2org.convert_ical(self.ics_string_tpl.format(
+                    event = event.format(sequence = 1, summary = "Renamed")), cache)
+                cache.close()
+            self.assertNotIn("<2020-02-12 Wed", ''.join(org_lines))
+            self.assertIn("<2020-02-17 Mon", ''.join(org_lines))
+
+    def test_batch_error_isolation(self):
+        """A malformed calendar in a batch does not stop the others from
+        being converted.
+        """
+        now = datetime.datetime.utcnow()
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART:{:%Y%m%dT%H%M%SZ}
+SUMMARY:Batch event
+""".format(now))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "src")
+            os.mkdir(src)
+            with open(os.path.join(src, "good.ics"), "w") as fh:
+                fh.write(ics_string)
+            with open(os.path.join(src, "bad.ics"), "w") as fh:
+                fh.write(ics_string.replace("DTSTART:", "DTSTART:garbage"))
+
+            pairs = ical2org.batch_dir_pairs(src, os.path.join(tmp, "org"))
+            errors = ical2org.convert_files(pairs, jobs = 2)
+
+            self.assertEqual(list(errors), [os.path.join(src, "bad.ics")])
+            with open(os.path.join(tmp, "org", "good.org")) as fh:
+                self.assertEqual(fh.readline().strip(), "* Batch event")
+
+    def test_batch_shared_cache(self):
+        """Batch workers share a render cache without locking each other
+        out, and a second batch is rendered from it.
+        """
+        from test import bench_ical2org
+        with tempfile.TemporaryDirectory() as tmp:
+            pairs = list()
+            for i in range(4):
+                input_path = os.path.join(tmp, "cal{}.ics".format(i))
+                with open(input_path, "wb") as fh:
+                    fh.write(bench_ical2org.generate_calendar(200, seed = i))
+                pairs.append((input_path, os.path.join(tmp, "cal{}.org".format(i))))
+            cache_path = os.path.join(tmp, "cache.db")
+
+            # Another user of the cache, still open, does not hold it locked.
+            cache = ical2org.RenderCache(cache_path)
+            cache.put("other", [])
+            for run in range(2):
+                stats = list()
+                errors = ical2org.convert_files(pairs, jobs = 2, stats = stats,
+                                                cache_path = cache_path)
+                self.assertEqual(errors, {})
+            cache.close()
+            self.assertTrue(all(file_stats["cache_hits"] for file_stats in stats))
+
+    def test_tz_table_matches_pytz(self):
+        """Localizing and formatting through the transition table gives the
+        same results as pytz, including around DST changes.
+        """
+        amsterdam = pytz.timezone("Europe/Amsterdam")
+        table = ical2org.tz_table(amsterdam)
+        for naive in (datetime.datetime(2004, 10, 31, 2, 30),   # ambiguous
+                      datetime.datetime(2004, 3, 28, 2, 30),    # skipped
+                      datetime.datetime(2004, 7, 1, 12, 0),
+                      datetime.datetime(1900, 1, 1, 0, 0)):
+            expected = amsterdam.localize(naive)
+            localized = table.localize(naive)
+            self.assertEqual(localized, expected)
+            self.assertIs(localized.tzinfo, expected.tzinfo)
+            self.assertEqual(ical2org.orgDatetime(localized),
+                             expected.astimezone(ical2org.get_timezone(ical2org.LOCAL_TZ)).strftime("<%Y-%m-%d %a %H:%M>"))
+
+    def test_bench_generate_calendar(self):
+        """The benchmark calendars are valid and reproducible.
+        """
+        from test import bench_ical2org
+
+        now = datetime.datetime(2020, 5, 12, tzinfo = pytz.utc)
+        ics = bench_ical2org.generate_calendar(50, seed = 3, now = now)
+        components = list(ical2org.walk_ical_stream(io.BytesIO(ics)))
+
+        self.assertEqual(len(components), 51)
+        self.assertEqual(ics, bench_ical2org.generate_calendar(50, seed = 3, now = now))
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_convert_stats(self):
+        """Stats count the components walked, the occurrences emitted and
+        the events pruned outside the window.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200101T090000
+DTEND;TZID=America/Los_Angeles:20200101T100000
+RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=40
+UID:standup@example.com
+SUMMARY:Standup
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20100101T090000Z
+UID:old@example.com
+SUMMARY:Old
+""")
+        stats = ical2org.ConvertStats()
+
+        ical2org.convert_ical(ics_string, stats = stats)
+        result = stats.as_dict()
+
+        self.assertEqual(result["components"], 9)
+        self.assertEqual(result["occurrences"], 28)
+        self.assertEqual(result["skipped"], 0)
+        self.assertEqual(result["pruned"], 1)
+        self.assertEqual(result["iterators"]["EventRecurDaysIter"]["occurrences"], 28)
+        self.assertNotIn("EventSingleIter", result["iterators"])
+        self.assertEqual([entry["uid"] for entry in result["top_recurring"]],
+                         ["standup@example.com"])
+
+    def test_may_intersect(self):
+        """Events are pruned from their raw values only when none of their
+        occurrences can fall in the window.
+        """
+        start = datetime.datetime(2020, 2, 12, tzinfo = pytz.utc)
+        end = datetime.datetime(2020, 8, 10, tzinfo = pytz.utc)
+        cases = [
+            ("20200101T090000", "20200101T100000", None, False),
+            ("20200211T090000Z", "20200211T100000Z", None, True),
+            ("20200812", None, None, True),
+            ("20200901T090000", None, None, False),
+            ("20100101T090000", None, "FREQ=WEEKLY;UNTIL=20150101T000000Z", False),
+            ("20100101T090000", None, "FREQ=WEEKLY;UNTIL=20200301T000000Z", True),
+            ("20191201T090000", None, "FREQ=DAILY;COUNT=10", False),
+            ("20191201T090000", None, "FREQ=DAILY;BYDAY=MO;COUNT=10", True),
+            ("19800101T090000", None, "FREQ=YEARLY;COUNT=3", False),
+            ("20100101T090000", None, "FREQ=WEEKLY", True),
+            ("garbage", None, None, True),
+        ]
+        for dtstart, dtend, rrule, expected in cases:
+            self.assertEqual(ical2org.may_intersect(dtstart, dtend, rrule, start, end),
+                             expected, (dtstart, dtend, rrule))
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_stream_prunes_before_parsing(self):
+        """The stream drops events outside the window before parsing them.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID="America/Los_Angeles":20100101T090000
+RRULE:FREQ=WEEKLY;UNTIL=20150101T000000Z
+SUMMARY:Old
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20200512T090000Z
+SUMMARY:Current
+""")
+        stats = ical2org.ConvertStats()
+
+        with mock.patch.object(icalendar.Event, "from_ical",
+                               wraps = icalendar.Event.from_ical) as from_ical:
+            org_lines = ical2org.convert_ical_stream(
+                io.BytesIO(ics_string.encode("UTF-8")), stats = stats)
+
+        self.assertEqual(from_ical.call_count, 1)
+        self.assertEqual(stats.pruned, 1)
+        self.assertEqual(org_lines[0], "* Current")
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_ordered_merge_across_calendars(self):
+        """Occurrences of several events and calendars can be emitted in
+        chronological order.
+        """
+        weekly = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200511T090000
+DTEND;TZID=America/Los_Angeles:20200511T100000
+RRULE:FREQ=WEEKLY;COUNT=3
+SUMMARY:Weekly
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;TZID=America/Los_Angeles:20200513T090000
+DTEND;TZID=America/Los_Angeles:20200513T100000
+SUMMARY:Single
+""")
+        daily = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200512T080000
+DTEND;TZID=America/Los_Angeles:20200512T083000
+RRULE:FREQ=DAILY;INTERVAL=4;COUNT=3
+SUMMARY:Daily
+""")
+
+        for convert in (lambda icss: ical2org.convert_ical(icss, ordered = True),
+                        lambda icss: ical2org.convert_ical_stream(
+                            [io.BytesIO(ics.encode("UTF-8")) for ics in icss],
+                            ordered = True)):
+            org_lines = convert([weekly, daily])
+            summaries = [line for line in org_lines if line.startswith("* ")]
+
+            self.assertEqual(summaries, ["* Weekly", "* Daily", "* Single",
+                                         "* Daily", "* Weekly", "* Daily",
+                                         "* Weekly"])
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_write_through_output(self):
+        """The org text of the first event is written before the rest of
+        the calendar has been read.
+        """
+        event = """\
+DTSTART:20200512T090000Z
+SUMMARY:Event {}
+"""
+        ics_string = self.ics_string_tpl.format(event = "END:VEVENT\nBEGIN:VEVENT\n".join(
+            event.format(i) for i in range(3)))
+        lines = ics_string.encode("UTF-8").splitlines(True)
+        read = list()
+
+        def reader():
+            for line in lines:
+                read.append(line)
+                yield line
+
+        fragments = ical2org.iter_ical_stream(reader())
+        self.assertEqual(next(fragments), "* Event 0")
+        self.assertLess(len(read), len(lines))
+
+        out = io.StringIO()
+        ical2org.write_org(fragments, out)
+        self.assertEqual(len(read), len(lines))
+        self.assertIn("* Event 2", out.getvalue())
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_main_writes_output_file(self):
+        """The command line writes the org text into the output file.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T090000Z
+SUMMARY:Café
+""")
+        with tempfile.TemporaryDirectory() as tmp:
+            ics_path = os.path.join(tmp, "cal.ics")
+            org_path = os.path.join(tmp, "cal.org")
+            with open(ics_path, "w", encoding = "UTF-8") as fh:
+                fh.write(ics_string)
+
+            self.assertEqual(ical2org.main([ics_path, org_path]), 0)
+
+            with open(org_path, encoding = "UTF-8") as fh:
+                self.assertEqual(fh.read(), "* Café\n<2020-05-12 Tue 02:00>\n\n\n")
+
+            # --stats takes no value, and leaves the input alone.
+            stats_path = os.path.join(tmp, "stats.json")
+            with mock.patch("sys.stderr", new_callable = io.StringIO) as err:
+                self.assertEqual(ical2org.main(["--stats", ics_path, org_path]), 0)
+            self.assertIn('"occurrences": 1', err.getvalue())
+            self.assertEqual(ical2org.main(["--stats-file", stats_path, ics_path, org_path]), 0)
+            with open(stats_path) as fh:
+                self.assertIn('"occurrences": 1', fh.read())
+            with open(ics_path, encoding = "UTF-8") as fh:
+                self.assertEqual(fh.read(), ics_string)
+            os.unlink(stats_path)
+
+            # A failed conversion leaves the previous output untouched.
+            with open(ics_path, "w", encoding = "UTF-8") as fh:
+                fh.write(self.ics_string_tpl.format(event = "DTSTART:garbage\n"))
+            with self.assertRaises(Exception):
+                ical2org.main([ics_path, org_path])
+            with open(org_path, encoding = "UTF-8") as fh:
+                self.assertEqual(fh.read(), "* Café\n<2020-05-12 Tue 02:00>\n\n\n")
+            self.assertEqual(sorted(os.listdir(tmp)), ["cal.ics", "cal.org"])
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_rrule_monthly(self):
+        """Monthly events support BYDAY ordinals, BYMONTHDAY and BYSETPOS.
+        """
+        for rrule, expected in (
+                ("FREQ=MONTHLY;BYDAY=2TU",
+                 ["2020-05-12 Tue", "2020-06-09 Tue", "2020-07-14 Tue"]),
+                ("FREQ=MONTHLY;BYDAY=MO,TU,WE,TH,FR;BYSETPOS=-1",
+                 ["2020-05-29 Fri", "2020-06-30 Tue", "2020-07-31 Fri"]),
+                ("FREQ=MONTHLY;INTERVAL=2;BYMONTHDAY=-1",
+                 ["2020-04-30 Thu", "2020-06-30 Tue"]),
+                ("FREQ=MONTHLY;COUNT=8",
+                 ["2020-03-31 Tue", "2020-05-31 Sun", "2020-07-31 Fri"])):
+            ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20191031T090000
+DTEND;TZID=America/Los_Angeles:20191031T100000
+RRULE:{}
+SUMMARY:Monthly
+""".format(rrule))
+
+            org_lines = ical2org.convert_ical(ics_string)
+            stamps = [line[1:15] for line in org_lines if line.startswith("<")]
+
+            self.assertEqual(stamps[-len(expected):], expected, rrule)
+            self.assertTrue(all(stamp >= "2020-02-12" for stamp in stamps), rrule)
+
+        # The iterators refuse a rule with both COUNT and UNTIL.
+        comp = icalendar.Event.from_ical("""\
+BEGIN:VEVENT
+DTSTART:20200501T090000Z
+DTEND:20200501T100000Z
+RRULE:FREQ=MONTHLY;COUNT=3;UNTIL=20200801T000000Z
+END:VEVENT
+""")
+        start, end = ical2org.get_window()
+        with self.assertRaises(ValueError):
+            ical2org.EventRecurMonthlyIter(comp, start, end)
+        with self.assertRaises(ValueError):
+            ical2org.EventRecurDaysIter(7, comp, start, end)
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_rrule_yearly(self):
+        """Yearly events support BYMONTH with BYDAY ordinals and COUNT.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:19701126T120000
+DTEND;TZID=America/Los_Angeles:19701126T130000
+RRULE:FREQ=YEARLY;BYMONTH=11,5;BYDAY=4TH;COUNT=100
+SUMMARY:Yearly
+""")
+        with mock.patch.object(ical2org, "WINDOW", 365):
+            org_lines = ical2org.convert_ical(ics_string)
+        stamps = [line.strip() for line in org_lines if line.startswith("<")]
+
+        self.assertEqual(stamps, ["<2019-05-23 Thu 12:00>--<2019-05-23 Thu 13:00>",
+                                  "<2019-11-28 Thu 12:00>--<2019-11-28 Thu 13:00>",
+                                  "<2020-05-28 Thu 12:00>--<2020-05-28 Thu 13:00>"])
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_recurrence_overrides(self):
+        """Instances of a recurring event moved by a RECURRENCE-ID or listed
+        in its EXDATE are not repeated by the recurring event.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+UID:weekly@example.com
+DTSTART;TZID=America/Los_Angeles:20200505T090000
+DTEND;TZID=America/Los_Angeles:20200505T100000
+RRULE:FREQ=WEEKLY;COUNT=4
+EXDATE;TZID=America/Los_Angeles:20200519T090000
+SUMMARY:Weekly
+END:VEVENT
+BEGIN:VEVENT
+UID:weekly@example.com
+RECURRENCE-ID:20200512T160000Z
+DTSTART;TZID=America/Los_Angeles:20200513T140000
+DTEND;TZID=America/Los_Angeles:20200513T150000
+SUMMARY:Weekly moved
+""")
+        expected = ["* Weekly", "<2020-05-05 Tue 09:00>--<2020-05-05 Tue 10:00>\n",
+                    "* Weekly moved", "<2020-05-13 Wed 14:00>--<2020-05-13 Wed 15:00>\n",
+                    "* Weekly", "<2020-05-26 Tue 09:00>--<2020-05-26 Tue 10:00>\n"]
+
+        org_lines = ical2org.convert_ical(ics_string, ordered = True)
+        self.assertEqual([line for line in org_lines if line[:1] in "*<"], expected)
+
+        # The override comes after the event it overrides, in a file that
+        # cannot be read twice.
+        fh = io.BufferedReader(io.BytesIO(ics_string.encode("UTF-8")))
+        fh.seekable = lambda: False
+        org_lines = ical2org.convert_ical_stream(fh, ordered = True)
+        self.assertEqual([line for line in org_lines if line[:1] in "*<"], expected)
+
+        # A large one is copied to a temporary file rather than to memory.
+        fh = io.BufferedReader(io.BytesIO(ics_string.encode("UTF-8")))
+        fh.seekable = lambda: False
+        with mock.patch.object(ical2org, "SPOOL_SIZE", 64), \
+             mock.patch("ical2org.tempfile.TemporaryFile",
+                        wraps = tempfile.TemporaryFile) as spool:
+            org_lines = ical2org.convert_ical_stream(fh, ordered = True)
+        self.assertEqual(spool.call_count, 1)
+        self.assertEqual([line for line in org_lines if line[:1] in "*<"], expected)
+
+    def test_watcher(self):
+        """The watcher reconverts an input only when its content changes, or
+        when the day changes, and a failed conversion keeps the old output.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T090000Z
+SUMMARY:Watched
+""")
+        with tempfile.TemporaryDirectory() as tmp, \
+             freeze_time("2020-05-12 12:00:00") as frozen:
+            input_path = os.path.join(tmp, "cal.ics")
+            output_path = os.path.join(tmp, "cal.org")
+            with open(input_path, "w") as fh:
+                fh.write(ics_string)
+            watcher = ical2org.Watcher([(input_path, output_path)])
+
+            self.assertEqual(watcher.poll(), {input_path: (None, None)})
+            self.assertEqual(watcher.poll(), {})
+            os.utime(input_path, ns = (0, 0))
+            self.assertEqual(watcher.poll(), {})
+
+            with open(input_path, "w") as fh:
+                fh.write(ics_string.replace("DTSTART:", "DTSTART:garbage"))
+            error, _ = watcher.poll()[input_path]
+            self.assertIsNotNone(error)
+            self.assertEqual(sorted(os.listdir(tmp)), ["cal.ics", "cal.org"])
+            with open(output_path) as fh:
+                self.assertEqual(fh.readline().strip(), "* Watched")
+
+            with open(input_path, "w") as fh:
+                fh.write(ics_string.replace("Watched", "Changed"))
+            self.assertEqual(watcher.poll(), {input_path: (None, None)})
+            with open(output_path) as fh:
+                self.assertEqual(fh.readline().strip(), "* Changed")
+
+            frozen.move_to("2020-05-13 12:00:00")
+            self.assertEqual(watcher.poll(), {input_path: (None, None)})
+            self.assertEqual(watcher.poll(), {})
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_convert_feeds(self):
+        """Feeds are fetched over a reused connection, and not converted
+        again while the server answers they are not modified and their org
+        file is from today.
+        """
+        body = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T090000Z
+SUMMARY:Fetched
+""").encode("UTF-8")
+        requests = list()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                requests.append((self.client_address, self.path,
+                                 self.headers.get("If-None-Match")))
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = "http://127.0.0.1:{}".format(server.server_address[1])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            state = os.path.join(tmp, "feeds.json")
+            pairs = [(base + "/a.ics", os.path.join(tmp, "a.org")),
+                     (base + "/b.ics", os.path.join(tmp, "b.org"))]
+            self.assertEqual(ical2org.convert_feeds(pairs, state, per_host = 1), {})
+            for _, output_path in pairs:
+                with open(output_path) as fh:
+                    self.assertEqual(fh.readline().strip(), "* Fetched")
+            self.assertEqual(len(set(address for address, _, _ in requests)), 1)
+            # Written at the frozen time, as far as the day goes.
+            now = datetime.datetime.now().timestamp()
+            os.utime(pairs[0][1], (now, now))
+
+            os.remove(pairs[1][1])
+            with mock.patch.object(ical2org, "convert_to_file",
+                                   wraps = ical2org.convert_to_file) as convert:
+                self.assertEqual(ical2org.convert_feeds(pairs, state), {})
+            self.assertEqual(convert.call_count, 1)
+            self.assertEqual(sorted((path, etag) for _, path, etag in requests[2:]),
+                             [("/a.ics", '"v1"'), ("/b.ics", None)])
+            self.assertTrue(os.path.exists(pairs[1][1]))
+
+            # An org file written on an earlier day is converted again.
+            yesterday = now - 86400
+            os.utime(pairs[0][1], (yesterday, yesterday))
+            os.utime(pairs[1][1], (now, now))
+            self.assertEqual(ical2org.convert_feeds(pairs, state), {})
+            self.assertEqual(sorted((path, etag) for _, path, etag in requests[4:]),
+                             [("/a.ics", None), ("/b.ics", '"v1"')])
+            self.assertNotEqual(os.stat(pairs[0][1]).st_mtime, yesterday)
+
+    @freeze_time("2020-01-15 00:00:00")
+    def test_compact_occurrences(self):
+        """Expansion yields occurrences as UTC seconds, sorted across events
+        by the window_events of a Converter; all day events keep their date
+        in winter.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200113T090000
+DTEND;TZID=America/Los_Angeles:20200113T093000
+RRULE:FREQ=DAILY;COUNT=3
+SUMMARY:Daily
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20200114
+DTEND;VALUE=DATE:20200115
+SUMMARY:All day
+""")
+        components = icalendar.Calendar.from_ical(ics_string).walk()
+        converter = ical2org.Converter()
+        start, end = converter.get_window()
+        occurrences = [(comp, occurrence)
+                       for comp, _, _, _, expand, _ in converter.window_events(components)
+                       for occurrence in expand(comp, start, end)]
+
+        self.assertEqual(len(occurrences), 4)
+        self.assertEqual(occurrences[0][1], ical2org.Occurrence(1578934800, 1578936600, True))
+        self.assertEqual([(str(comp["SUMMARY"]), occurrence.start) for comp, occurrence in
+                          sorted(occurrences, key = lambda item: item[1].start)],
+                         [("Daily", 1578934800), ("All day", 1578988800),
+                          ("Daily", 1579021200), ("Daily", 1579107600)])
+
+        org_lines = ical2org.convert_ical(ics_string)
+        self.assertIn("<2020-01-14 Tue>--<2020-01-14 Tue>\n", org_lines)
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_org_template(self):
+        """Text escapes are undone, and the org entries follow the template,
+        leaving out lines whose fields are empty.
+        """
+        ics_string = self.ics_string_tpl.format(event = r"""DTSTART:20200512T090000Z
+DTEND:20200512T100000Z
+RRULE:FREQ=DAILY;COUNT=2
+SUMMARY:Stand-up\; daily
+DESCRIPTION:Notes\, agenda
+""")
+        with mock.patch.object(ical2org, "ORG_TEMPLATE",
+                               "** {summary} {{x}}\n{timestamp} {location}\n{description}\n"):
+            org_lines = ical2org.convert_ical(ics_string)
+
+        self.assertEqual(org_lines, [
+            "** Stand-up; daily {x}\n", "<2020-05-12 Tue 02:00>--<2020-05-12 Tue 03:00> \n",
+            "Notes, agenda\n",
+            "** Stand-up; daily {x}\n", "<2020-05-13 Wed 02:00>--<2020-05-13 Wed 03:00> \n",
+            "Notes, agenda\n"])
+        with self.assertRaises(ValueError):
+            ical2org.OrgTemplate("* {title}\n")
+
+    @freeze_time("2020-05-12 00:00:00")
+    def test_identities(self):
+        """The participation status is read from any of the user's
+        addresses, whatever their case, and exposed to the template.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T090000Z
+SUMMARY:Declined alone
+ATTENDEE;PARTSTAT=DECLINED:mailto:Alias@Example.com
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20200512T100000Z
+SUMMARY:Accepted by a delegate
+ATTENDEE;PARTSTAT=DECLINED:mailto:alias@example.com
+ATTENDEE;PARTSTAT=ACCEPTED:mailto:delegate@example.com
+ATTENDEE;PARTSTAT=DECLINED:mailto:someone@example.com
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20200512T110000Z
+SUMMARY:Maybe
+ATTENDEE;PARTSTAT=TENTATIVE:MAILTO:ALIAS@EXAMPLE.COM
+""")
+        with mock.patch.object(ical2org, "IDENTITIES",
+                               ["alias@example.com", "mailto:Delegate@example.com"]), \
+             mock.patch.object(ical2org, "ORG_TEMPLATE", "* {summary}\n{partstat}\n"):
+            org_lines = ical2org.convert_ical(ics_string)
+
+        self.assertEqual(org_lines, ["* Declined: Declined alone\n", "DECLINED\n",
+                                     "* Accepted by a delegate\n", "ACCEPTED\n",
+                                     "* Maybe\n", "TENTATIVE\n"])
+
+        # A reply from one address wins over no reply from another, and the
+        # status of each address is available to the template.
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T090000Z
+SUMMARY:Offsite
+ATTENDEE;PARTSTAT=DECLINED:mailto:me@example.com
+ATTENDEE:mailto:alias@example.com
+""")
+        with mock.patch.object(ical2org, "IDENTITIES", ["alias@example.com"]), \
+             mock.patch.object(ical2org, "DEFAULT_ATTENDEE", "me@example.com"), \
+             mock.patch.object(ical2org, "ORG_TEMPLATE",
+                               "* {summary}\n{partstat}: {partstats}\n"
+                               "{partstats[Alias@Example.com]}{partstats[other@example.com]}\n"):
+            org_lines = ical2org.convert_ical(ics_string)
+
+        self.assertEqual(org_lines, [
+            "* Declined: Offsite\n",
+            "DECLINED: alias@example.com NEEDS-ACTION, me@example.com DECLINED\n",
+            "NEEDS-ACTION", "\n"])
+
+    def test_converter_threads(self):
+        """Converters with their own settings run side by side in threads,
+        without reading or changing the module settings.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T090000Z
+DTEND:20200512T100000Z
+SUMMARY:Call
+""")
+        converters = [ical2org.Converter(local_tz = "America/Los_Angeles"),
+                      ical2org.Converter(local_tz = "Europe/Paris",
+                                         template = "* {summary} {timestamp}\n")]
+        with freeze_time("2020-05-10"), \
+             mock.patch.object(ical2org, "read_local_tz",
+                               side_effect = AssertionError("read")), \
+             ThreadPoolExecutor(max_workers = 4) as executor:
+            results = list(executor.map(lambda c: ''.join(c.convert_ical(ics_string)),
+                                        converters * 20))
+
+        self.assertEqual(set(results[0::2]), {
+            "* Call\n<2020-05-12 Tue 02:00>--<2020-05-12 Tue 03:00>\n\n\n"})
+        self.assertEqual(set(results[1::2]), {
+            "* Call <2020-05-12 Tue 11:00>--<2020-05-12 Tue 12:00>\n"})
+
+    @freeze_time("2020-05-10")
+    def test_mapped_file(self):
+        """A calendar file is memory mapped and walked in place, giving the
+        same output as reading it line by line.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;TZID=America/Los_Angeles:20200511T090000
+DTEND;TZID=America/Los_Angeles:20200511T100000
+RRULE:FREQ=DAILY;COUNT=4
+UID:daily@example.com
+SUMMARY:Caf\xc3
+ \xa9 daily
+BEGIN:VALARM
+ACTION:DISPLAY
+TRIGGER:-PT5M
+END:VALARM
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20100101T090000Z
+SUMMARY:Old
+END:VEVENT
+begin:VEVENT
+DTSTART;TZID=America/Los_Angeles:2020051
+ 2T150000
+RECURRENCE-ID;TZID=America/Los_Angeles:20200512T090000
+UID:daily@example.com
+SUMMARY:Moved
+""")
+        ics_bytes = ics_string.encode("latin-1").replace(b"\n", b"\r\n")
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "cal.ics")
+            output_path = os.path.join(tmp, "cal.org")
+            with open(input_path, 'wb') as fh:
+                fh.write(ics_bytes)
+            stats = ical2org.ConvertStats()
+            with mock.patch.object(ical2org, "walk_ical_buffer",
+                                   wraps = ical2org.walk_ical_buffer) as walk:
+                ical2org.convert_file(input_path, output_path, stats = stats)
+            self.assertIsInstance(walk.call_args[0][0], ical2org.mmap.mmap)
+            self.assertTrue(walk.call_args[0][0].closed)
+            with open(output_path, encoding = "UTF-8") as fh:
+                org = fh.read()
+
+        with mock.patch.object(ical2org, "map_ical", return_value = None):
+            lines = ''.join(ical2org.convert_ical_stream(io.BytesIO(ics_bytes)))
+        self.assertEqual(org, lines)
+        self.assertEqual(stats.pruned, 1)
+        self.assertEqual(org.count("* Café daily"), 3)
+        self.assertIn("* Moved\n<2020-05-12 Tue 15:00>", org)
+
+    @freeze_time("2020-05-10")
+    def test_occurrence_index(self):
+        """Occurrences are indexed once, rendered for any range from the
+        index, and only expanded again for events that changed.
+        """
+        event = """\
+DTSTART;TZID=America/Los_Angeles:20200504T090000
+DTEND;TZID=America/Los_Angeles:20200504T100000
+RRULE:FREQ=WEEKLY;BYDAY=MO,TH
+UID:weekly@example.com
+SEQUENCE:{sequence}
+SUMMARY:{summary}
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20200512T200000Z
+UID:single@example.com
+SUMMARY:Single
+"""
+        ics_string = self.ics_string_tpl.format(
+            event = event.format(sequence = 0, summary = "Weekly"))
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "work.ics")
+            index_path = os.path.join(tmp, "index.db")
+            output_path = os.path.join(tmp, "week.org")
+            with open(input_path, 'w') as fh:
+                fh.write(ics_string)
+
+            index = ical2org.OccurrenceIndex(index_path)
+            with open(input_path, 'rb') as fh:
+                self.assertEqual(index.update("work", fh), 2)
+            start, end = ical2org.get_window(7)
+            org = ''.join(index.render(start.timestamp(), end.timestamp()))
+            with mock.patch.object(ical2org, "WINDOW", 7):
+                self.assertEqual(org, ''.join(ical2org.convert_ical(ics_string,
+                                                                    ordered = True)))
+            with open(input_path, 'rb') as fh:
+                self.assertEqual(index.update("work", fh), 0)
+
+            with open(input_path, 'w') as fh:
+                fh.write(self.ics_string_tpl.format(event = event.format(
+                    sequence = 1, summary = "Moved weekly").split("END:VEVENT")[0]))
+            with open(input_path, 'rb') as fh:
+                self.assertEqual(index.update("work", fh), 1)
+
+            # An event given twice in a calendar is indexed once, from its
+            # copy with the highest SEQUENCE.
+            twice = self.ics_string_tpl.format(event = """\
+DTSTART:20200512T180000Z
+UID:twice@example.com
+SEQUENCE:2
+SUMMARY:New copy
+END:VEVENT
+BEGIN:VEVENT
+DTSTART:20200512T170000Z
+UID:twice@example.com
+SEQUENCE:1
+SUMMARY:Old copy
+""")
+            index.update("twice", io.BytesIO(twice.encode("UTF-8")))
+            org = ''.join(index.render(start.timestamp(), end.timestamp(), ["twice"]))
+            self.assertEqual(org.count("* New copy"), 1)
+            self.assertNotIn("Old copy", org)
+            self.assertEqual(index.db.execute(
+                "SELECT COUNT(*) FROM occurrences WHERE event NOT IN "
+                "(SELECT id FROM events)").fetchone()[0], 0)
+            index.close()
+
+            self.assertEqual(ical2org.main(["query", index_path, "2020-05-11",
+                                            "2020-05-17", "-o", output_path]), 0)
+            with open(output_path, encoding = "UTF-8") as fh:
+                org = fh.read()
+            self.assertEqual(ical2org.main(["query", index_path, "2030-01-01",
+                                            "2030-01-02"]), 1)
+
+        self.assertEqual(org.count("* Moved weekly"), 2)
+        self.assertIn("<2020-05-14 Thu 09:00>--<2020-05-14 Thu 10:00>", org)
+        self.assertNotIn("Single", org)
+
+    @freeze_time("2020-05-10")
+    def test_dedup_across_calendars(self):
+        """An event found in several calendars converted together is
+        expanded and rendered once, from its copy with the highest SEQUENCE,
+        without parsing the other copies when streaming.
+        """
+        meeting = """\
+DTSTART;TZID=America/Los_Angeles:20200511T{start}
+DTEND;TZID=America/Los_Angeles:20200511T{end}
+RRULE:FREQ=DAILY;COUNT=2
+UID:meeting@example.com
+SEQUENCE:{sequence}
+SUMMARY:{summary}
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;TZID=America/Los_Angeles:20200512T120000
+UID:{owner}@example.com
+SUMMARY:{owner}
+"""
+        calendars = [self.ics_string_tpl.format(event = meeting.format(
+            start = start, end = end, sequence = sequence, summary = summary,
+            owner = owner))
+            for start, end, sequence, summary, owner in [
+                ("090000", "100000", 0, "Standup", "alice"),
+                ("100000", "110000", 1, "Standup moved", "bob"),
+                ("100000", "110000", 1, "Standup moved", "carol")]]
+
+        for stream in (False, True):
+            stats = ical2org.ConvertStats()
+            with mock.patch.object(ical2org, "generate_event_iterator",
+                                   wraps = ical2org.generate_event_iterator) as expand, \
+                 mock.patch.object(icalendar.Event, "from_ical",
+                                   wraps = icalendar.Event.from_ical) as from_ical:
+                if stream:
+                    org = ''.join(ical2org.convert_ical_stream(
+                        [io.BytesIO(ics.encode("UTF-8")) for ics in calendars],
+                        stats = stats))
+                    self.assertEqual(from_ical.call_count, 4)
+                else:
+                    org = ''.join(ical2org.convert_ical(calendars, stats = stats))
+
+            self.assertEqual(expand.call_count, 4)
+            self.assertEqual(stats.duplicates, 2)
+            self.assertEqual(org.count("* Standup moved"), 2)
+            self.assertNotIn("* Standup\n", org)
+            self.assertIn("<2020-05-11 Mon 10:00>--<2020-05-11 Mon 11:00>", org)
+            for owner in ("alice", "bob", "carol"):
+                self.assertIn("* {}\n".format(owner), org)
+
+    @freeze_time("2020-05-10")
+    def test_update_org_file(self):
+        """An org file is updated: only the entries of changed, removed or
+        added events are touched, and notes are kept.
+        """
+        events = {
+            "weekly": """\
+DTSTART;TZID=America/Los_Angeles:20200511T090000
+DTEND;TZID=America/Los_Angeles:20200511T100000
+RRULE:FREQ=WEEKLY;COUNT=2
+UID:weekly@example.com
+SUMMARY:Weekly
+""",
+            "review": """\
+DTSTART;TZID=America/Los_Angeles:20200512T090000
+UID:review@example.com
+SUMMARY:{}
+""",
+            "lunch": """\
+DTSTART;TZID=America/Los_Angeles:20200513T120000
+UID:lunch@example.com
+SUMMARY:Lunch
+""",
+            "party": """\
+DTSTART;TZID=America/Los_Angeles:20200514T180000
+UID:party@example.com
+SUMMARY:Party
+""",
+        }
+        def calendar(*names, review = "Review"):
+            return self.ics_string_tpl.format(event = "END:VEVENT\nBEGIN:VEVENT\n".join(
+                events[name].format(review) for name in names))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "cal.ics")
+            output_path = os.path.join(tmp, "cal.org")
+            with open(input_path, 'w') as fh:
+                fh.write(calendar("weekly", "review", "lunch"))
+            # An org file written without drawers is not updated.
+            self.assertEqual(ical2org.main([input_path, output_path]), 0)
+            with open(output_path, encoding = "UTF-8") as fh:
+                plain = fh.read()
+            with self.assertRaises(ValueError):
+                ical2org.main([input_path, output_path, "--update"])
+            with open(output_path, encoding = "UTF-8") as fh:
+                self.assertEqual(fh.read(), plain)
+            os.unlink(output_path)
+
+            self.assertEqual(ical2org.main([input_path, output_path, "--update"]), 0)
+            with open(output_path, encoding = "UTF-8") as fh:
+                org = fh.read()
+            self.assertEqual(org.count(":ICAL_UID: weekly@example.com\n"), 2)
+            self.assertIn("* Review\n:PROPERTIES:\n:ICAL_UID: review@example.com\n"
+                          ":ICAL_START: 20200512T160000Z\n", org)
+
+            weekly_end = org.index("* Review")
+            org = "#+TITLE: Agenda\n" + org.replace(
+                "* Lunch", "Remember the slides.\n* Lunch")
+            with open(output_path, 'w', encoding = "UTF-8") as fh:
+                fh.write(org)
+
+            converter = ical2org.Converter(drawers = True)
+            counts = ical2org.update_org_file(
+                converter.convert_ical(calendar("weekly", "review", "party",
+                                                review = "Review moved")),
+                output_path)
+            with open(output_path, encoding = "UTF-8") as fh:
+                updated = fh.read()
+
+            self.assertEqual(counts["unchanged"], 2)
+            self.assertEqual((counts["changed"], counts["removed"], counts["added"]),
+                             (1, 1, 1))
+            self.assertEqual(counts["written"], len(updated.encode("UTF-8")))
+            self.assertTrue(updated.startswith(org[:len("#+TITLE: Agenda\n") + weekly_end]))
+            self.assertIn("* Review moved\n:PROPERTIES:", updated)
+            self.assertIn("Remember the slides.\n", updated)
+            self.assertNotIn("Lunch", updated)
+            self.assertTrue(updated.rstrip().endswith("<2020-05-14 Thu 18:00>"))
+
+            counts = ical2org.update_org_file(
+                converter.convert_ical(calendar("weekly", "review", "party",
+                                                review = "Review moved")),
+                output_path)
+            self.assertEqual(counts["written"], 0)
+
+            # Only adding entries appends them in place.
+            counts = ical2org.update_org_file(
+                converter.convert_ical(calendar("weekly", "review", "party", "lunch",
+                                                review = "Review moved")),
+                output_path)
+            with open(output_path, encoding = "UTF-8") as fh:
+                appended = fh.read()
+            self.assertEqual(counts["added"], 1)
+            self.assertEqual(counts["written"], len(appended) - len(updated))
+            self.assertTrue(appended.startswith(updated))
+
+            # A rewrite that fails leaves the file as it was.
+            with mock.patch("ical2org.os.replace", side_effect = OSError("disk full")):
+                with self.assertRaises(OSError):
+                    ical2org.update_org_file(
+                        converter.convert_ical(calendar("weekly", "party")), output_path)
+            with open(output_path, encoding = "UTF-8") as fh:
+                self.assertEqual(fh.read(), appended)
+            self.assertEqual(sorted(os.listdir(tmp)), ["cal.ics", "cal.org"])
+
+    @freeze_time("2020-05-10")
+    def test_convert_shards(self):
+        """Occurrences are split into one org file per month or calendar,
+        included by the output file, and only changed shards are written.
+        """
+        event = """\
+DTSTART;TZID=America/Los_Angeles:20200520T090000
+DTEND;TZID=America/Los_Angeles:20200520T100000
+RRULE:FREQ=WEEKLY;COUNT=3
+UID:weekly@example.com
+SUMMARY:Weekly
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;TZID=America/Los_Angeles:20200615T120000
+UID:lunch@example.com
+SUMMARY:{}
+"""
+        with tempfile.TemporaryDirectory() as tmp:
+            input_path = os.path.join(tmp, "cal.ics")
+            other_path = os.path.join(tmp, "work.ics")
+            index_path = os.path.join(tmp, "agenda.org")
+            def convert(summary, *args):
+                with open(input_path, 'w') as fh:
+                    fh.write(self.ics_string_tpl.format(event = event.format(summary)))
+                with open(input_path, 'rb') as fh:
+                    return ical2org.convert_shards(fh, index_path, *args, ordered = True)
+
+            self.assertEqual(len(convert("Lunch")), 3)
+            with open(index_path) as fh:
+                self.assertEqual(fh.read(), '#+INCLUDE: "agenda-2020-05.org"\n'
+                                 '#+INCLUDE: "agenda-2020-06.org"\n')
+            org = ''
+            for month in ("05", "06"):
+                with open(os.path.join(tmp, "agenda-2020-{}.org".format(month))) as fh:
+                    org += fh.read()
+            with open(input_path, 'rb') as fh:
+                self.assertEqual(org, ''.join(ical2org.convert_ical(fh.read(),
+                                                                    ordered = True)))
+            self.assertEqual(org.count("* Weekly"), 3)
+
+            self.assertEqual(convert("Lunch"), [])
+            self.assertEqual(convert("Late lunch"),
+                             [os.path.join(tmp, "agenda-2020-06.org")])
+
+            with open(other_path, 'w') as fh:
+                fh.write(self.ics_string_tpl.format(event = event.format("Lunch"))
+                         .replace("Personal", "Work / Team")
+                         .replace("@example.com", "@work.example.com"))
+            self.assertEqual(ical2org.main([input_path, index_path, "--merge", other_path,
+                                            "--shard", "calendar", "-j", "2"]), 0)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ["agenda-Personal.org", "agenda-Work_Team.org", "agenda.org",
+                              "cal.ics", "work.ics"])
+
+    @freeze_time("2020-03-01")
+    def test_tz_backends(self):
+        """The module loads without icalendar, pytz or asyncio, and both
+        timezone backends localize and convert alike across DST changes.
+        """
+        import subprocess
+        loaded = subprocess.run(
+            [sys.executable, "-c", "import sys, ical2org; "
+             "print(sorted({'icalendar', 'pytz', 'asyncio'} & set(sys.modules)))"],
+            cwd = os.path.dirname(os.path.abspath(ical2org.__file__)),
+            capture_output = True, text = True, check = True)
+        self.assertEqual(loaded.stdout.strip(), "[]")
+
+        from zoneinfo import ZoneInfo
+        amsterdam = pytz.timezone("Europe/Amsterdam")
+        for naive in (datetime.datetime(2004, 10, 31, 2, 30),   # ambiguous
+                      datetime.datetime(2004, 3, 28, 2, 30),    # skipped
+                      datetime.datetime(2004, 7, 1, 12, 0)):
+            self.assertEqual(
+                ical2org.tz_table(ZoneInfo("Europe/Amsterdam")).localize(naive).timestamp(),
+                amsterdam.localize(naive).timestamp())
+
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;VALUE=DATE:20200306
+DTEND;VALUE=DATE:20200309
+RRULE:FREQ=WEEKLY;COUNT=40
+SUMMARY:Long weekend
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;TZID=America/Los_Angeles:20200307T013000
+DTEND;TZID=America/Los_Angeles:20200307T023000
+RRULE:FREQ=DAILY;COUNT=300
+SUMMARY:Night shift
+""")
+        results = dict()
+        for backend in ("pytz", "zoneinfo"):
+            with mock.patch.object(ical2org, "TZ_BACKEND", backend):
+                converter = ical2org.Converter(local_tz = "America/Los_Angeles")
+                results[backend] = ''.join(converter.convert_ical(ics_string))
+        self.assertEqual(results["pytz"], results["zoneinfo"])
+        self.assertIn("<2020-03-06 Fri>--<2020-03-08 Sun>", results["zoneinfo"])
+        self.assertIn("<2020-03-08 Sun 01:30>--<2020-03-08 Sun 03:30>", results["zoneinfo"])
+
+        # LOCAL_TZ may be a tzinfo, as the Readme shows.
+        with mock.patch.object(ical2org, "LOCAL_TZ", ZoneInfo("America/Los_Angeles")), \
+             mock.patch.object(ical2org, "TIMEZONE_FILE", "/nonexistent"):
+            self.assertEqual(''.join(ical2org.convert_ical(ics_string)), results["zoneinfo"])
+
+    @freeze_time("2020-10-20")
+    def test_all_day_dst(self):
+        """A recurring all-day event ends on the right day when a DST change
+        falls on or inside one of its occurrences, with either backend.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+DTSTART;VALUE=DATE:20201025
+DTEND;VALUE=DATE:20201026
+RRULE:FREQ=WEEKLY;COUNT=3
+SUMMARY:Sunday
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20201001
+DTEND;VALUE=DATE:20201002
+RRULE:FREQ=MONTHLY;COUNT=3
+SUMMARY:First
+END:VEVENT
+BEGIN:VEVENT
+DTSTART;VALUE=DATE:20201024
+DTEND;VALUE=DATE:20201026
+RRULE:FREQ=WEEKLY;COUNT=3
+SUMMARY:Weekend
+""")
+        for backend in ("pytz", "zoneinfo"):
+            with mock.patch.object(ical2org, "TZ_BACKEND", backend):
+                converter = ical2org.Converter(local_tz = "America/Los_Angeles")
+                org = ''.join(converter.convert_ical(ics_string))
+            self.assertIn("* Sunday\n<2020-11-01 Sun>--<2020-11-01 Sun>\n", org)
+            self.assertIn("* First\n<2020-11-01 Sun>--<2020-11-01 Sun>\n", org)
+            self.assertIn("* Weekend\n<2020-10-31 Sat>--<2020-11-01 Sun>\n", org)
+            self.assertIn("* Weekend\n<2020-11-07 Sat>--<2020-11-08 Sun>\n", org)
+
+    @freeze_time("2020-05-10")
+    def test_expansion_budget(self):
+        """A recurring event is cut short once it, or its calendar, is over
+        its expansion budget, with a warning and a count in the stats.
+        """
+        ics_string = self.ics_string_tpl.format(event = """\
+UID:daily-1
+DTSTART:20200101T090000Z
+DTEND:20200101T100000Z
+RRULE:FREQ=DAILY
+SUMMARY:Daily one
+END:VEVENT
+BEGIN:VEVENT
+UID:single
+DTSTART:20200512T120000Z
+DTEND:20200512T130000Z
+SUMMARY:Single
+END:VEVENT
+BEGIN:VEVENT
+UID:daily-2
+DTSTART:20200101T110000Z
+DTEND:20200101T120000Z
+RRULE:FREQ=DAILY
+SUMMARY:Daily two
+""")
+        for budgets, counts, truncated in (
+                ({"EVENT_OCCURRENCES": None}, (180, 180), 0),
+                ({"EVENT_OCCURRENCES": 5}, (5, 5), 2),
+                ({"EVENT_OCCURRENCES": 5, "CALENDAR_OCCURRENCES": 7}, (5, 2), 2)):
+            stats = ical2org.ConvertStats()
+            with mock.patch.multiple(ical2org, **budgets), \
+                 mock.patch("sys.stderr", new_callable = io.StringIO) as stderr:
+                org = ''.join(ical2org.convert_ical(ics_string, stats = stats))
+            self.assertEqual((org.count("* Daily one"), org.count("* Daily two")), counts)
+            self.assertEqual(org.count("* Single"), 1)
+            self.assertEqual(stats.truncated, truncated)
+            self.assertEqual(stats.iterators["EventRecurDaysIter"]["occurrences"],
+                             sum(counts))
+            self.assertEqual(stderr.getvalue().count("WARNING truncated"), truncated)
+        self.assertIn("daily-2 after 2 occurrences", stderr.getvalue())
+
+        # Time budgets, with a clock a second later at each reading. They
+        # also stop a single call that keeps skipping non-matching periods.
+        never = ics_string.replace("UID:daily-2", "UID:never").replace(
+            "RRULE:FREQ=DAILY\nSUMMARY:Daily two",
+            "RRULE:FREQ=MONTHLY;BYMONTH=2;BYMONTHDAY=30\nSUMMARY:Never")
+        for calendar, truncated in ((ics_string, 2), (never, 2)):
+            stats = ical2org.ConvertStats()
+            with mock.patch.multiple(ical2org, EVENT_SECONDS = 2.5, CALENDAR_SECONDS = None), \
+                 mock.patch("time.perf_counter", side_effect = itertools.count()), \
+                 mock.patch("sys.stderr", new_callable = io.StringIO) as stderr:
+                org = ''.join(ical2org.convert_ical(calendar, stats = stats))
+            self.assertLess(org.count("* Daily one"), 3)
+            self.assertEqual(stats.truncated, truncated)
+        self.assertIn("never after 0 occurrences", stderr.getvalue())
+
+        # A truncated expansion is neither cached nor kept in the index, and
+        # cached events use up the calendar budget as expanded ones do.
+        changed = ics_string.replace("UID:daily-2", "UID:daily-2\nSEQUENCE:1")
+        with tempfile.TemporaryDirectory() as tmp, \
+             mock.patch("sys.stderr", new_callable = io.StringIO):
+            results = list()
+            for cache_name, calendar, budgets in (
+                    ("cache.db", ics_string, {}),
+                    ("cache.db", changed, {"CALENDAR_OCCURRENCES": 200}),
+                    ("empty.db", changed, {"CALENDAR_OCCURRENCES": 200}),
+                    ("cache.db", changed, {})):
+                cache = ical2org.RenderCache(os.path.join(tmp, cache_name))
+                with mock.patch.multiple(ical2org, EVENT_OCCURRENCES = None, **budgets):
+                    org = ''.join(ical2org.convert_ical(calendar, cache))
+                cache.close()
+                results.append((org.count("* Daily one"), org.count("* Daily two")))
+            self.assertEqual(results[0], (180, 180))
+            self.assertLess(results[1][1], 20)
+            self.assertEqual(results[1], results[2])
+            self.assertEqual(results[3], (180, 180))
+
+            counts = list()
+            for index_name, budgets, updated in (("index.db", {"EVENT_OCCURRENCES": 5}, 3),
+                                                 ("index.db", {}, 2),
+                                                 ("fresh.db", {}, 3)):
+                index = ical2org.OccurrenceIndex(os.path.join(tmp, index_name))
+                with mock.patch.multiple(ical2org, CALENDAR_OCCURRENCES = None,
+                                         **budgets):
+                    self.assertEqual(index.update(
+                        "cal", io.BytesIO(ics_string.encode("UTF-8"))), updated)
+                counts.append(index.db.execute(
+                    "SELECT COUNT(*) FROM occurrences").fetchone()[0])
+                index.close()
+            self.assertEqual(counts[0], 11)
+            self.assertEqual(counts[1], counts[2])
+
+        # Rules that cannot be expanded only skip their own event.
+        for rule, counter in (("FREQ=HOURLY;COUNT=3", "unsupported"),
+                              ("FREQ=DAILY;INTERVAL=0", "malformed"),
+                              ("FREQ=MONTHLY;INTERVAL=-1", "malformed"),
+                              ("FREQ=WEEKLY;BYDAY=XX", "malformed"),
+                              ("FREQ=DAILY;COUNT=2;UNTIL=20200601", "malformed")):
+            ics_string = self.ics_string_tpl.format(event = """\
+UID:bad
+DTSTART:20200501T090000Z
+DTEND:20200501T100000Z
+RRULE:{}
+SUMMARY:Bad rule
+END:VEVENT
+BEGIN:VEVENT
+UID:single
+DTSTART:20200512T120000Z
+DTEND:20200512T130000Z
+SUMMARY:Single
+""".format(rule))
+            for stream in (False, True):
+                stats = ical2org.ConvertStats()
+                with mock.patch("sys.stderr", new_callable = io.StringIO) as stderr:
+                    if stream:
+                        org = ''.join(ical2org.convert_ical_stream(
+                            io.BytesIO(ics_string.encode("UTF-8")), stats = stats))
+                    else:
+                        org = ''.join(ical2org.convert_ical(ics_string, stats = stats))
+                self.assertNotIn("* Bad rule", org)
+                self.assertIn("* Single", org)
+                self.assertEqual(stats.as_dict()[counter], 1)
+                self.assertIn("WARNING skipped recurring event bad", stderr.getvalue())